@@ -0,0 +1,341 @@
+# benchmark.py
+# Banco de pruebas reproducible: genera colecciones sinteticas (imagenes de
+# chapas + Excel) y mide importacion, embeddings, carga, busquedas y exportacion.
+# Cada etapa corre en un proceso aparte (tiempos y RSS sin contaminar) y el
+# resultado se guarda en JSON para comparar entre commits.
+#
+#   python benchmark.py medir --escalas 1000 10000
+#   python benchmark.py medir --escalas 100000 1000000 --sin-modelo
+#   python benchmark.py comparar benchmarks/antes.json benchmarks/despues.json
+#
+# --sin-modelo rellena la BD con embeddings aleatorios en lugar de importar con
+# el modelo (mide carga, busqueda y exportacion a escalas donde la inferencia
+# tardaria horas). Por encima de --max-imagenes las filas reutilizan imagenes;
+# la cache por contenido hace que el modelo solo procese las distintas.
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+import numpy as np
+
+RESULTS_DIR = "benchmarks"
+WORK_DIR = "bench_tmp"
+ESCALAS = (1000, 10000)
+MAX_IMAGENES = 10000
+TAM_IMAGEN = 256
+N_CONSULTAS = 200
+LOTES_EMBEDDING = (1, 8, 32, 64)
+DIM = 576               # MobileNetV3-Small pooled features
+UMBRAL_RSS = 0.10       # comparar: relative change in peak RSS flagged as worse/better
+
+_SILABAS = ["ma", "hei", "ne", "ken", "co", "la", "pe", "ro", "ni", "cru", "zca", "am",
+            "bel", "sa", "mi", "gu", "el", "sol", "ta", "ri", "fa", "ga", "ba", "lu"]
+_TIPOS = ["Corona", "Rosca", "Anilla", "Abre-facil"]
+
+# ----------------- Synthetic data -----------------
+def _marca(rng):
+    n = int(rng.integers(2, 4))
+    return "".join(_SILABAS[i] for i in rng.integers(0, len(_SILABAS), n)).capitalize()
+
+def _imagen_chapa(rng, tam):
+    from PIL import Image, ImageDraw
+    img = Image.new("RGB", (tam, tam), (235, 235, 235))
+    d = ImageDraw.Draw(img)
+    color = lambda: tuple(int(c) for c in rng.integers(0, 256, 3))
+    m = tam // 24
+    d.ellipse((m, m, tam - m, tam - m), fill=color(), outline=color(), width=max(2, tam // 32))
+    for _ in range(int(rng.integers(2, 6))):
+        x0, y0 = rng.integers(tam // 4, tam // 2, 2)
+        x1, y1 = rng.integers(tam // 2, 3 * tam // 4, 2)
+        if rng.random() < 0.5:
+            d.rectangle((x0, y0, x1, y1), fill=color())
+        else:
+            d.ellipse((x0, y0, x1, y1), fill=color())
+    return img
+
+def generar_datos(directorio, n, max_imagenes=MAX_IMAGENES, tam=TAM_IMAGEN, seed=0):
+    """
+    Crea en `directorio` imagenes/, consultas/ (imagenes que no estan en la
+    coleccion) y chapas.xlsx con `n` filas. Reutiliza lo ya generado si coincide.
+    """
+    from openpyxl import Workbook
+    marcador = os.path.join(directorio, "datos.json")
+    params = {"n": n, "max_imagenes": max_imagenes, "tam": tam, "seed": seed}
+    if os.path.exists(marcador):
+        with open(marcador) as f:
+            if json.load(f) == params:
+                return
+    rng = np.random.default_rng(seed)
+    n_img = min(n, max_imagenes)
+    for sub, cuantas in (("imagenes", n_img), ("consultas", min(N_CONSULTAS, n_img))):
+        os.makedirs(os.path.join(directorio, sub), exist_ok=True)
+        for i in range(cuantas):
+            _imagen_chapa(rng, tam).save(os.path.join(directorio, sub, f"cap_{i:07d}.jpg"), quality=85)
+    marcas = [_marca(rng) for _ in range(max(1, n // 20))]
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+    ws.append(["id", "marca", "tipo", "imagen"])
+    for i in range(n):
+        ws.append([i + 1, marcas[int(rng.integers(len(marcas)))], _TIPOS[i % len(_TIPOS)],
+                   f"cap_{i % n_img:07d}.jpg"])
+    wb.save(os.path.join(directorio, "chapas.xlsx"))
+    with open(marcador, "w") as f:
+        json.dump(params, f)
+
+def _borrar_bd(directorio):
+    # DB, WAL files, embedding sidecars and index files: every run starts cold
+    for f in os.listdir(directorio):
+        if f.startswith("chapas.") and f not in ("chapas.xlsx",):
+            os.remove(os.path.join(directorio, f))
+
+# ----------------- Stages (run inside the scale's directory) -----------------
+def _rss_pico_mb():
+    try:
+        import resource
+        kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return kb / 1024 / (1024 if sys.platform == "darwin" else 1)
+    except ImportError:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / 2**20
+        except (ImportError, AttributeError):
+            return None
+
+def _percentiles(tiempos):
+    ms = np.asarray(tiempos) * 1000
+    return {"n": len(ms), "p50_ms": float(np.percentile(ms, 50)),
+            "p99_ms": float(np.percentile(ms, 99)), "media_ms": float(ms.mean())}
+
+def _listar(sub):
+    return sorted(os.path.join(sub, f) for f in os.listdir(sub))
+
+def etapa_poblar():
+    # random unit vectors instead of the model, also stored in the content-hash cache
+    # so that searching with a collection image does not need the model either
+    from openpyxl import load_workbook
+    import funciones as fn
+    fn.crear_bd()
+    ws = load_workbook("chapas.xlsx", read_only=True).active
+    filas = list(ws.iter_rows(min_row=2, values_only=True))
+    paths = _listar("imagenes")
+    hashes = fn.hashes_de_ficheros(paths)
+    rng = np.random.default_rng(1)
+    emb = rng.standard_normal((len(paths), DIM)).astype(np.float32)
+    emb /= np.linalg.norm(emb, axis=1, keepdims=True)
+    blobs = {os.path.basename(p): e.astype(np.float16).tobytes() for p, e in zip(paths, emb)}
+    fn.guardar_embeddings_cache((hashes[p], blobs[os.path.basename(p)]) for p in paths)
+    t0 = time.perf_counter()
+    fn.insertar_chapas_bulk((int(id_), marca, tipo, os.path.join("imagenes", imagen), blobs[imagen])
+                            for id_, marca, tipo, imagen in filas)
+    return {"insertar_s": time.perf_counter() - t0, "filas": len(filas)}
+
+def etapa_embeddings():
+    import funciones_modelo as fm
+    paths = _listar("consultas")
+    fm.batch_imagenes_a_embeddings(paths[:1])  # model load is not throughput
+    res = {}
+    for bs in LOTES_EMBEDDING:
+        n = min(len(paths), max(4 * bs, 32))
+        t0 = time.perf_counter()
+        for s in range(0, n, bs):
+            fm.batch_imagenes_a_embeddings(paths[s:s+bs])
+        res[str(bs)] = {"imagenes_s": n / (time.perf_counter() - t0), "n": n}
+    return res
+
+def _etapa_carga(fria):
+    import funciones as fn
+    if fria:
+        for f in os.listdir("."):
+            if f.startswith("chapas.emb") or f.endswith(".npz"):
+                os.remove(f)
+    rss0 = _rss_pico_mb()
+    t0 = time.perf_counter()
+    fn._load_embeddings_to_ram()
+    t = time.perf_counter() - t0
+    rss1 = _rss_pico_mb()
+    return {"s": t, "filas": len(fn._emb_ids), "indice": fn._indice.tipo,
+            "rss_pico_mb": rss1, "rss_pico_delta_mb": None if rss0 is None else rss1 - rss0}
+
+def etapa_carga_fria():
+    return _etapa_carga(True)
+
+def etapa_carga():
+    return _etapa_carga(False)
+
+def _buscar_imagenes(paths):
+    import funciones as fn
+    fn._load_embeddings_to_ram()
+    fn.buscar_por_imagen(paths[0], top_k=8)  # warm-up (model load) excluded
+    tiempos = []
+    for p in paths[1:]:
+        t0 = time.perf_counter()
+        fn.buscar_por_imagen(p, top_k=8)
+        tiempos.append(time.perf_counter() - t0)
+    return _percentiles(tiempos)
+
+def etapa_imagen_cache():
+    # collection images: embedding comes from the content-hash cache, measures hash + index
+    return _buscar_imagenes(_listar("imagenes")[:N_CONSULTAS])
+
+def etapa_imagen():
+    # unseen images: decode + transform + forward + index
+    return _buscar_imagenes(_listar("consultas"))
+
+def etapa_marca():
+    import funciones as fn
+    marcas = [r[0] for r in fn._conectar().execute("SELECT DISTINCT marca FROM chapas LIMIT 1000")]
+    rng = np.random.default_rng(2)
+    consultas = {"corta": [], "subcadena": [], "typo": []}
+    for _ in range(N_CONSULTAS // 4):
+        m = marcas[int(rng.integers(len(marcas)))].lower()
+        consultas["corta"].append(m[:2])
+        s = int(rng.integers(0, max(1, len(m) - 4)))
+        consultas["subcadena"].append(m[s:s+4])
+        consultas["typo"].append(m[:-2] + "qx")  # no exact match -> typo-tolerant fallback
+    res = {}
+    for tipo, qs in consultas.items():
+        fn.buscar_por_marca(qs[0])
+        tiempos = []
+        for q in qs:
+            t0 = time.perf_counter()
+            fn.buscar_por_marca(q, limite=100)
+            tiempos.append(time.perf_counter() - t0)
+        res[tipo] = _percentiles(tiempos)
+    return res
+
+def etapa_exportar():
+    import funciones as fn
+    t0 = time.perf_counter()
+    archivo = fn.exportar_a_excel_version()
+    t = time.perf_counter() - t0
+    tam = os.path.getsize(archivo)
+    os.remove(archivo)
+    return {"s": t, "bytes": tam, "rss_pico_mb": _rss_pico_mb()}
+
+_ETAPAS = {"poblar": etapa_poblar, "embeddings": etapa_embeddings, "carga_fria": etapa_carga_fria,
+           "carga": etapa_carga, "imagen_cache": etapa_imagen_cache, "imagen": etapa_imagen,
+           "marca": etapa_marca, "exportar": etapa_exportar}
+
+# ----------------- Driver -----------------
+def _en_proceso(args, directorio):
+    # fresh interpreter per stage; the JSON result is the last stdout line
+    t0 = time.perf_counter()
+    r = subprocess.run([sys.executable, os.path.abspath(__file__)] + args, cwd=directorio,
+                       capture_output=True, text=True)
+    wall = time.perf_counter() - t0
+    if r.returncode != 0:
+        return {"error": (r.stderr.strip().splitlines() or ["?"])[-1]}, wall
+    lineas = r.stdout.strip().splitlines()
+    return (json.loads(lineas[-1]) if lineas else {}), wall
+
+def medir_escala(n, sin_modelo=False, max_imagenes=MAX_IMAGENES, tam=TAM_IMAGEN):
+    directorio = os.path.join(WORK_DIR, f"n{n}")
+    os.makedirs(directorio, exist_ok=True)
+    t0 = time.perf_counter()
+    generar_datos(directorio, n, max_imagenes, tam)
+    res = {"generar_s": time.perf_counter() - t0}
+    _borrar_bd(directorio)
+    if sin_modelo:
+        res["poblar"], _ = _en_proceso(["_etapa", "poblar"], directorio)
+        etapas = ["carga_fria", "carga", "imagen_cache", "marca", "exportar"]
+    else:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "importar_excel.py")
+        t0 = time.perf_counter()
+        r = subprocess.run([sys.executable, script], cwd=directorio, capture_output=True, text=True)
+        res["importar"] = {"s": time.perf_counter() - t0, "ok": r.returncode == 0}
+        etapas = ["embeddings", "carga_fria", "carga", "imagen_cache", "imagen", "marca", "exportar"]
+    for etapa in etapas:
+        print(f"  n={n}: {etapa}", flush=True)
+        res[etapa], _ = _en_proceso(["_etapa", etapa], directorio)
+    return res
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def medir(escalas, sin_modelo=False, max_imagenes=MAX_IMAGENES, tam=TAM_IMAGEN, salida=None):
+    """
+    Ejecuta todas las etapas para cada escala y guarda el JSON. Retorna la ruta.
+    """
+    informe = {"commit": _commit(), "fecha": datetime.now().isoformat(timespec="seconds"),
+               "python": platform.python_version(), "plataforma": platform.platform(),
+               "cpus": os.cpu_count(), "sin_modelo": sin_modelo, "max_imagenes": max_imagenes,
+               "tam_imagen": tam, "escalas": {}}
+    for n in escalas:
+        informe["escalas"][str(n)] = medir_escala(n, sin_modelo, max_imagenes, tam)
+    if salida is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        fecha_hora = datetime.now().strftime("%Y%m%d_%H%M%S")
+        salida = os.path.join(RESULTS_DIR, f"bench_{informe['commit'] or 'local'}_{fecha_hora}.json")
+    with open(salida, "w", encoding="utf-8") as f:
+        json.dump(informe, f, indent=2)
+    return salida
+
+def _metricas(d, prefijo=""):
+    # flatten to {"1000.carga.s": 0.12, ...}, only timings, throughputs (imagenes_s) and peak RSS
+    out = {}
+    for k, v in d.items():
+        clave = f"{prefijo}{k}"
+        if isinstance(v, dict):
+            out.update(_metricas(v, clave + "."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool) and k != "generar_s" and \
+                (k.endswith("_s") or k.endswith("_ms") or k == "s" or k.startswith("rss_pico")):
+            out[clave] = v
+    return out
+
+def comparar(a, b, umbral=0.10, umbral_rss=UMBRAL_RSS):
+    """
+    Imprime las metricas de b frente a a y marca cambios mayores que `umbral`
+    (tiempos) o `umbral_rss` (memoria pico).
+    """
+    with open(a) as f:
+        ma = _metricas(json.load(f)["escalas"])
+    with open(b) as f:
+        mb = _metricas(json.load(f)["escalas"])
+    for clave in sorted(ma.keys() & mb.keys()):
+        va, vb = ma[clave], mb[clave]
+        if not va:
+            continue
+        ratio = vb / va
+        u = umbral_rss if "rss_pico" in clave else umbral
+        # throughput: higher is better; everything else is a time or a memory peak
+        peor = ratio < 1 - u if clave.endswith("imagenes_s") else ratio > 1 + u
+        mejor = ratio > 1 + u if clave.endswith("imagenes_s") else ratio < 1 - u
+        marca = "  PEOR" if peor else ("  mejor" if mejor else "")
+        print(f"{clave:45s} {va:12.4f} -> {vb:12.4f}  x{ratio:.2f}{marca}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks de CapCollection")
+    sub = parser.add_subparsers(dest="modo", required=True)
+    p_m = sub.add_parser("medir", help="genera datos sinteticos y mide todas las etapas")
+    p_m.add_argument("--escalas", type=int, nargs="+", default=list(ESCALAS))
+    p_m.add_argument("--sin-modelo", action="store_true", help="embeddings aleatorios, sin inferencia")
+    p_m.add_argument("--max-imagenes", type=int, default=MAX_IMAGENES)
+    p_m.add_argument("--tam-imagen", type=int, default=TAM_IMAGEN)
+    p_m.add_argument("--salida")
+    p_c = sub.add_parser("comparar", help="compara dos resultados JSON")
+    p_c.add_argument("antes")
+    p_c.add_argument("despues")
+    p_c.add_argument("--umbral", type=float, default=0.10)
+    p_c.add_argument("--umbral-rss", type=float, default=UMBRAL_RSS, help="umbral para la memoria pico")
+    p_e = sub.add_parser("_etapa")  # internal: one stage in a fresh process
+    p_e.add_argument("etapa", choices=sorted(_ETAPAS))
+    args = parser.parse_args(argv)
+
+    if args.modo == "_etapa":
+        print(json.dumps(_ETAPAS[args.etapa]()))
+    elif args.modo == "comparar":
+        comparar(args.antes, args.despues, args.umbral, args.umbral_rss)
+    else:
+        salida = medir(args.escalas, args.sin_modelo, args.max_imagenes, args.tam_imagen, args.salida)
+        print(f"Resultados -> {salida}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# carga_imagenes.py
+# Shared image loading for the model preprocessing and the thumbnail cache. JPEGs
+# are decoded straight at a reduced DCT scale (1/2, 1/4 or 1/8) when the caller only
+# needs a small image, instead of decoding a 12 MP phone photo to throw most of it
+# away, and every image is turned upright according to its EXIF orientation.
+#
+#   python carga_imagenes.py   (self-check on generated JPEGs with every EXIF orientation)
+import os
+import sys
+import tempfile
+import numpy as np
+from PIL import Image, ImageOps
+
+_ORIENTACION = 0x0112
+_GIRADAS = (5, 6, 7, 8)  # EXIF orientations that swap width and height
+
+def orientacion(img):
+    try:
+        return img.getexif().get(_ORIENTACION, 1)
+    except Exception:
+        return 1  # broken EXIF block: treat the photo as upright
+
+def abrir(path, minimo=None, modo="RGB"):
+    """
+    Abre `path` derecha segun su EXIF. minimo=(w, h): tamano (ya orientado) que
+    la imagen debe seguir cubriendo; un JPEG se decodifica a la menor escala DCT
+    que lo cumple. modo=None conserva el modo del fichero.
+    """
+    img = Image.open(path)
+    giro = orientacion(img)
+    if minimo is not None and img.format == "JPEG":
+        w, h = minimo
+        if giro in _GIRADAS:
+            w, h = h, w  # the decoder works on the stored (unrotated) pixels
+        # only picks a scale that keeps both sides >= the request; no-op for other formats
+        img.draft(modo if modo in ("RGB", "L") else None, (w, h))
+    if giro != 1:
+        img = ImageOps.exif_transpose(img)  # before convert(), which may drop the EXIF block
+    if modo is not None and img.mode != modo:
+        img = img.convert(modo)
+    return img
+
+# ----------------- Self-check -----------------
+def _jpeg_orientado(path, giro, tam=(1600, 1200)):
+    # asymmetric test card (a colour per quadrant) so any wrong flip or rotation shows up
+    w, h = tam
+    px = np.zeros((h, w, 3), dtype=np.uint8)
+    px[:h // 2, :w // 2] = (220, 30, 30)
+    px[:h // 2, w // 2:] = (30, 200, 30)
+    px[h // 2:, :w // 2] = (30, 30, 220)
+    px[h // 2:, w // 2:] = (230, 230, 40)
+    exif = Image.Exif()
+    exif[_ORIENTACION] = giro
+    Image.fromarray(px).save(path, "JPEG", quality=92, exif=exif.tobytes())
+
+def _jpeg_foto(path, giro=1, tam=(4000, 3000), semilla=0):
+    # phone-photo stand-in: smooth shading, a few caps (rings with a printed rim) and fine
+    # texture, the detail a reduced DCT decode actually drops
+    w, h = tam
+    rng = np.random.default_rng(semilla)
+    y, x = np.mgrid[0:h, 0:w].astype(np.float32)
+    px = np.empty((h, w, 3), dtype=np.float32)
+    for c in range(3):
+        px[..., c] = 90 + 60 * np.sin(x / w * (2 + c)) * np.cos(y / h * (3 - c))
+    for _ in range(6):
+        cx, cy, r = rng.uniform(0.2, 0.8) * w, rng.uniform(0.2, 0.8) * h, rng.uniform(0.08, 0.2) * min(w, h)
+        d = np.hypot(x - cx, y - cy)
+        dentro = d < r
+        px[dentro] = rng.uniform(40, 230, 3)
+        borde = dentro & (d > 0.8 * r)
+        px[borde] += 40 * np.sign(np.sin(np.arctan2(y - cy, x - cx)[borde] * 60))[:, None]
+    px += rng.normal(0, 6, (h, w, 1))
+    exif = Image.Exif()
+    exif[_ORIENTACION] = giro
+    Image.fromarray(np.clip(px, 0, 255).astype(np.uint8)).save(path, "JPEG", quality=90, exif=exif.tobytes())
+
+def comprobar(minimos=((256, 256), (700, 250)), tolerancia=12.0):
+    """
+    Genera un JPEG por cada orientacion EXIF (1-8) y compara abrir(path, minimo)
+    con la decodificacion completa enderezada: misma proporcion, ambos lados >=
+    minimo y los mismos colores por cuadrante. Un minimo no cuadrado comprueba
+    que en las fotos giradas se pide el tamano ya girado. Retorna la lista de
+    fallos (vacia si todo va bien).
+    """
+    fallos = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for giro in range(1, 9):
+            path = os.path.join(tmp, f"orientacion_{giro}.jpg")
+            _jpeg_orientado(path, giro)
+            with Image.open(path) as img:
+                ref = ImageOps.exif_transpose(img).convert("RGB")
+            for minimo in minimos:
+                red = abrir(path, minimo)
+                if red.width < minimo[0] or red.height < minimo[1]:
+                    fallos.append(f"orientacion {giro}: {red.size} no cubre {minimo}")
+                elif abs(red.width / red.height - ref.width / ref.height) > 0.01:
+                    fallos.append(f"orientacion {giro}: {red.size} frente a {ref.size} completa")
+                else:
+                    a = np.asarray(red.resize((8, 8), Image.BILINEAR), dtype=np.float32)
+                    b = np.asarray(ref.resize((8, 8), Image.BILINEAR), dtype=np.float32)
+                    dif = float(np.abs(a - b).max())
+                    if dif > tolerancia:
+                        fallos.append(f"orientacion {giro}: diferencia {dif:.1f} con la completa")
+    return fallos
+
+if __name__ == "__main__":
+    fallos = comprobar()
+    import funciones_modelo  # the model input must survive the reduced decode too
+    fallos += funciones_modelo.comprobar_decodificacion()
+    for f in fallos:
+        print(f)
+    print("OK" if not fallos else f"{len(fallos)} fallos")
+    sys.exit(1 if fallos else 0)
@@ -1,19 +1,47 @@
 # chapas_gui.py — versión optimizada con scroll limitado arriba/abajo
-
-import threading
+#
+#   python chapas_gui.py [--perfil] [--vigilar]
+#   --perfil: tiempos de arranque y primera busqueda
+#   --vigilar: reindexa automaticamente las imagenes de la coleccion cuando cambian
+
+import time
+_T0 = time.perf_counter()  # before the heavy imports, for --perfil
+
+import os
+import sys
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from tkinter import *
 from tkinter import filedialog, messagebox
-from PIL import Image, ImageTk, ImageOps
+from PIL import ImageTk
 import funciones as fn
+import miniaturas
+import servidor_busqueda
+import vigilar_imagenes
 import theme_dark as theme
+import traza
+
+# stage order in the status-bar breakdown (CHAPAS_TRAZA=1); other stages follow by duration
+ETAPAS_BUSQUEDA = ("decodificar", "transformar", "forward", "listas", "pq_aprox", "producto",
+                   "ordenar", "mostrar")
+
+ANY_TYPE = "Any"
+
+ROW_H = 104  # card height (96) + vertical gap; every card has the same height
 
 # Inicializar base de datos
 fn.crear_bd()
 fn.ensure_embedding_column()
 
 class App:
-    def __init__(self, root):
+    def __init__(self, root, perfil=False, vigilar=False):
         self.root = root
+        self.perfil = perfil
+        self.vigilar = vigilar
+        self._t_busqueda = None   # click time of the first image search (--perfil)
+        self._servicio = None     # servidor_busqueda.Cliente when the search service is running
+        self._tipos_seq = None    # chapas_cambios seq the type filter menu was built from
+        self._search_pool = ThreadPoolExecutor(max_workers=1)
         self.root.title("CapCollection — Dark Mode Pro")
         self.root.geometry("980x700")
         self.root.minsize(900, 600)
@@ -34,6 +62,54 @@ class App:
         self.status_var = StringVar(value="Ready")
         Label(root, textvariable=self.status_var, bg=theme.BG, fg=theme.MUTED, anchor="w").pack(side=BOTTOM, fill=X)
 
+        # model, embeddings and a dummy inference load in the background once the window is up
+        self.root.bind("<Map>", self._on_window_shown)
+
+    # ---------------- Startup ----------------
+    def _perfil(self, evento, t):
+        if self.perfil:
+            print(f"[perfil] {evento}: {t:.3f} s", flush=True)
+
+    def _en_ui(self, func):
+        # worker threads never touch Tk: they queue callables for _poll_thumbs
+        self._ui_queue.put(func)
+
+    def _on_window_shown(self, event):
+        if event.widget is not self.root:
+            return
+        self.root.unbind("<Map>")
+        self._perfil("primera ventana", time.perf_counter() - _T0)
+        self.status_var.set("Loading model...")
+        # same single worker as the searches: a search clicked early queues behind the warm-up
+        self._search_pool.submit(self._warm_up)
+        if self.vigilar:
+            def aviso(ps):
+                def ui():
+                    self.status_var.set(f"Re-indexed {len(ps)} image(s)")
+                    self._actualizar_tipos()
+                self._en_ui(ui)
+            vigilar_imagenes.Vigilante(al_indexar=aviso).iniciar()
+
+    def _warm_up(self):
+        t0 = time.perf_counter()
+        cliente = servidor_busqueda.Cliente()
+        try:
+            if cliente.disponible():
+                # model and embeddings are already resident in the service
+                self._servicio = cliente
+                msg = "Ready (search service)"
+            else:
+                fn.calentar()
+                msg = "Ready"
+        except Exception as e:
+            msg = f"Model not available: {e}"
+        self._perfil("calentamiento", time.perf_counter() - t0)
+
+        def listo():
+            if self.status_var.get() == "Loading model...":
+                self.status_var.set(msg)
+        self._en_ui(listo)
+
     # ---------------- Sidebar ----------------
     def _build_sidebar(self):
         pad = 12
@@ -43,10 +119,44 @@ class App:
               fg=theme.MUTED, wraplength=180).pack(pady=(0, 16))
 
         theme.AccentButton(self.left, text="Search by Image", command=self._trigger_image_search, width=18).pack(pady=6, padx=pad)
+
+        # optional filters of the image search: only matching caps are scored
+        filtros = Frame(self.left, bg=theme.PANEL)
+        filtros.pack(padx=pad, pady=(0, 10), fill=X)
+        Label(filtros, text="Brand contains:", bg=theme.PANEL, fg=theme.MUTED).pack(anchor="w")
+        self.filter_brand_var = StringVar()
+        Entry(filtros, textvariable=self.filter_brand_var, bg=theme.CARD, fg=theme.TEXT,
+              insertbackground=theme.TEXT, relief=FLAT).pack(fill=X, pady=(0, 4))
+        Label(filtros, text="Type:", bg=theme.PANEL, fg=theme.MUTED).pack(anchor="w")
+        self.filter_type_var = StringVar(value=ANY_TYPE)
+        self.type_menu = OptionMenu(filtros, self.filter_type_var, ANY_TYPE)
+        self.type_menu.configure(bg=theme.CARD, fg=theme.TEXT, activebackground=theme.ACCENT, relief=FLAT,
+                                 highlightthickness=0, bd=0)
+        # rebuilt on opening if the collection changed since (imports, edits, the watcher)
+        self.type_menu["menu"].configure(bg=theme.CARD, fg=theme.TEXT, postcommand=self._actualizar_tipos)
+        self.type_menu.pack(fill=X)
+        self._actualizar_tipos()
+
+        theme.GhostButton(self.left, text="Recognize Video", command=self._trigger_video).pack(pady=6, padx=pad, fill=X)
         theme.GhostButton(self.left, text="Show All", command=self._show_all).pack(pady=6, padx=pad, fill=X)
         theme.GhostButton(self.left, text="Export to Excel", command=self._export).pack(pady=6, padx=pad, fill=X)
         theme.GhostButton(self.left, text="Clear Selection", command=self._clear_selection).pack(pady=6, padx=pad, fill=X)
 
+    def _actualizar_tipos(self):
+        # every write to chapas (here or in another process) moves the change log, so
+        # an unchanged MAX(seq) means the list of types is still current
+        seq = fn.ultimo_cambio()
+        if seq == self._tipos_seq:
+            return
+        self._tipos_seq = seq
+        tipos = [ANY_TYPE] + fn.tipos_distintos()
+        menu = self.type_menu["menu"]
+        menu.delete(0, END)
+        for t in tipos:
+            menu.add_command(label=t, command=lambda t=t: self.filter_type_var.set(t))
+        if self.filter_type_var.get() not in tipos:
+            self.filter_type_var.set(ANY_TYPE)  # the selected type no longer exists
+
     # ---------------- Main area ----------------
     def _build_main_area(self):
         # Search by Brand
@@ -60,39 +170,48 @@ class App:
         self.brand_entry.pack(side=LEFT, padx=(0, 6))
         theme.GhostButton(top, text="Search", command=self.search_brand).pack(side=LEFT, padx=(6, 6))
         self.brand_entry.bind("<Return>", lambda e: self.search_brand())
+        # search-as-you-type, debounced so a burst of keystrokes runs one query
+        self._brand_after = None
+        self.brand_entry.bind("<KeyRelease>", self._on_brand_key)
 
-        # Canvas con scroll
+        # Canvas con scroll: virtualized list, only the rows in the viewport have widgets
         container = Frame(self.main, bg=theme.BG)
         container.pack(fill=BOTH, expand=True, padx=16, pady=(8, 16))
 
-        self.canvas = Canvas(container, bg=theme.BG, highlightthickness=0)
+        self.canvas = Canvas(container, bg=theme.BG, highlightthickness=0, yscrollincrement=ROW_H // 4)
         self.canvas.pack(side=LEFT, fill=BOTH, expand=True)
         self.canvas.bind_all("<MouseWheel>", self._on_mousewheel)
+        self.canvas.bind("<Configure>", lambda e: [self._update_scrollregion(), self._render_visible()])
 
         # Scrollbar opcional
         self.scrollbar = Scrollbar(container, orient=VERTICAL, command=self.canvas.yview)
-        self.canvas.configure(yscrollcommand=self.scrollbar.set)
-
-        self._create_cards_frame()
+        self.canvas.configure(yscrollcommand=self._on_yscroll)
+
+        self._items = []          # rows currently listed (loaded so far)
+        self._total = 0           # rows in the listing, loaded or not
+        self._fuente = None       # iterator with the rows not loaded yet
+        self._pool = []           # recycled _Card widgets
+        self._fotos = miniaturas.LRU(512)        # PhotoImage per cached thumbnail
+        self._thumb_pool = ThreadPoolExecutor(max_workers=2)
+        self._thumb_queue = queue.Queue()        # (img_path, PIL image or None) from workers
+        self._thumb_pending = set()
+        self._ui_queue = queue.Queue()           # callables to run on the Tk thread
+        self._empty_label = Label(self.canvas, text="No results found.", bg=theme.BG, fg=theme.MUTED)
+        self._empty_win = self.canvas.create_window((0, 24), window=self._empty_label, anchor="n", state="hidden")
+        self.root.after(30, self._poll_thumbs)
 
         self._show_all()
 
-    def _create_cards_frame(self):
-        # Creamos el frame de cards desde cero para evitar espacio fantasma
-        self.canvas.delete("all")
-        self.cards_frame = Frame(self.canvas, bg=theme.BG)
-        self.cards_window = self.canvas.create_window((0, 0), window=self.cards_frame, anchor="nw")
-        self.cards_frame.bind("<Configure>", lambda e: self._update_scrollregion())
-
     def _update_scrollregion(self):
-        # Limitamos scroll para que no deje espacio vacío arriba/abajo
-        self.canvas.update_idletasks()
-        bbox = self.canvas.bbox("all")
-        if bbox:
-            x1, y1, x2, y2 = bbox
-            canvas_height = self.canvas.winfo_height()
-            scroll_height = max(y2, canvas_height)
-            self.canvas.configure(scrollregion=(x1, y1, x2, scroll_height))
+        # Limitamos scroll a las filas para que no deje espacio vacío arriba/abajo
+        width = max(self.canvas.winfo_width(), 1)
+        height = max(self._total * ROW_H, self.canvas.winfo_height())
+        self.canvas.configure(scrollregion=(0, 0, width, height))
+        self.canvas.coords(self._empty_win, width // 2, 24)
+
+    def _on_yscroll(self, first, last):
+        self.scrollbar.set(first, last)
+        self._render_visible()
 
     def _on_mousewheel(self, event):
         # Scroll limitado arriba/abajo
@@ -104,9 +223,7 @@ class App:
     # ---------------- Actions ----------------
     def _clear_selection(self):
         self.brand_var.set("")
-        self._create_cards_frame()
-        Label(self.cards_frame, text="No results found.", bg=theme.BG, fg=theme.MUTED).pack(pady=24)
-        self.canvas.yview_moveto(0)
+        self._display_cards([])
 
     def _export(self):
         try:
@@ -120,11 +237,51 @@ class App:
         if path:
             self._search_by_image(path)
 
+    def _trigger_video(self):
+        # a video file, or any frame of a folder of sequential frames
+        path = filedialog.askopenfilename(filetypes=[("Video or frame", "*.mp4;*.avi;*.mov;*.mkv;*.png;*.jpg;*.jpeg")])
+        if not path:
+            return
+        fuente = os.path.dirname(path) if path.lower().endswith((".png", ".jpg", ".jpeg")) else path
+        self.status_var.set("Recognizing video...")
+        self._search_pool.submit(self._do_video, fuente)
+
+    def _do_video(self, fuente):
+        # search worker thread; imported here so the model code stays off the startup path
+        import reconocer_video
+        try:
+            segmentos, stats = reconocer_video.reconocer(fuente)
+            log = reconocer_video.guardar_log(segmentos, reconocer_video.ruta_log(fuente))
+        except Exception as e:
+            def error(msg=str(e)):
+                self.status_var.set("Error recognizing video")
+                messagebox.showerror("Error", msg)
+            self._en_ui(error)
+            return
+        filas = [s["fila"] for s in segmentos if s["fila"]]
+
+        def mostrar():
+            self._display_cards(filas)
+            self.status_var.set(f"Recognized {len(filas)} caps in {stats['proceso_s']:.1f} s "
+                                f"({stats['analizados']} of {stats['leidos']} frames analysed)  Log: {log}")
+        self._en_ui(mostrar)
+
     def _show_all(self):
-        rows = fn.obtener_todas_chapas()
-        self._display_cards(rows)
+        # rows are pulled page by page as the list scrolls (no embedding BLOBs)
+        self._display_cards([], total=fn.contar_chapas(),
+                            fuente=fn.iterar_chapas(("id", "marca", "tipo", "imagen")))
+
+    def _on_brand_key(self, event):
+        if event.keysym == "Return":
+            return
+        if self._brand_after is not None:
+            self.root.after_cancel(self._brand_after)
+        self._brand_after = self.root.after(150, self.search_brand)
 
     def search_brand(self):
+        if self._brand_after is not None:
+            self.root.after_cancel(self._brand_after)
+            self._brand_after = None
         text = self.brand_var.get().strip()
         if not text:
             self._show_all()
@@ -136,61 +293,188 @@ class App:
     def _search_by_image(self, path):
         self.status_var.set("Searching by image...")
         self.root.update_idletasks()
-        threading.Thread(target=self._do_search_image, args=(path,), daemon=True).start()
-
-    def _do_search_image(self, path):
+        if self.perfil and self._t_busqueda is None:
+            self._t_busqueda = time.perf_counter()
+        # filters are read here, on the Tk thread
+        marca = self.filter_brand_var.get().strip() or None
+        tipo = self.filter_type_var.get()
+        tipo = None if tipo == ANY_TYPE else tipo
+        self._search_pool.submit(self._do_search_image, path, marca, tipo)
+
+    def _buscar_imagen(self, path, top_k, marca=None, tipo=None):
+        if self._servicio is not None:
+            try:
+                return self._servicio.buscar_por_imagen(path, top_k=top_k, marca=marca, tipo=tipo)
+            except OSError:
+                self._servicio = None  # service stopped: search in-process from now on
+        return fn.buscar_por_imagen(path, top_k=top_k, marca=marca, tipo=tipo)
+
+    def _do_search_image(self, path, marca=None, tipo=None):
+        # search worker thread: results reach Tk through _en_ui
+        t0 = time.perf_counter()
         try:
-            results = fn.buscar_por_imagen(path, top_k=5)
-            self.status_var.set(f"Found {len(results)} results")
-            self.root.after(50, lambda: [self._display_cards(results), self.canvas.yview_moveto(0)])
+            with traza.consulta() as desglose:
+                results = self._buscar_imagen(path, top_k=5, marca=marca, tipo=tipo)
         except Exception as e:
-            self.status_var.set("Error searching image")
-            messagebox.showerror("Error", str(e))
+            def error(msg=str(e)):
+                self.status_var.set("Error searching image")
+                messagebox.showerror("Error", msg)
+            self._en_ui(error)
+            return
+        if self._t_busqueda:
+            t = time.perf_counter()
+            self._perfil("primera busqueda", t - self._t_busqueda)
+            self._perfil("arranque hasta primera busqueda", t - _T0)
+            self._t_busqueda = False
+
+        def mostrar():
+            t1 = time.perf_counter()
+            with traza.tramo("mostrar"):
+                self._display_cards(results)
+            msg = f"Found {len(results)} results"
+            if marca or tipo:
+                msg += " (filtered: " + ", ".join(f for f in (marca, tipo) if f) + ")"
+            if desglose is not None:
+                desglose["mostrar"] = time.perf_counter() - t1
+                msg += f"  ({(t1 - t0) * 1000:.0f} ms: {traza.resumen(desglose, ETAPAS_BUSQUEDA)})"
+            self.status_var.set(msg)
+        self._en_ui(mostrar)
 
     # ---------------- Display cards ----------------
-    def _display_cards(self, items):
-        self._create_cards_frame()  # recrea frame para eliminar cualquier espacio fantasma
-
-        if not items:
-            Label(self.cards_frame, text="No results found.", bg=theme.BG, fg=theme.MUTED).pack(pady=24)
-            self.canvas.yview_moveto(0)
+    def _display_cards(self, items, total=None, fuente=None):
+        """
+        items: filas ya cargadas. Con `fuente` (iterador) y `total`, el resto de
+        filas se piden a medida que entran en la vista.
+        """
+        self._items = [item[0] if isinstance(item, tuple) and len(item) == 2 else item for item in items]
+        self._fuente = fuente
+        self._total = len(self._items) if total is None else total
+        self._update_scrollregion()
+        self.canvas.itemconfigure(self._empty_win, state="normal" if not self._items else "hidden")
+        self.canvas.yview_moveto(0)
+        self._render_visible()
+
+    def _render_visible(self):
+        # place recycled cards on the rows inside the viewport, hide the rest
+        width = max(self.canvas.winfo_width() - 12, 1)
+        top = self.canvas.canvasy(0)
+        first = max(0, int(top // ROW_H))
+        last = min(self._total, int((top + self.canvas.winfo_height()) // ROW_H) + 1)
+        self._cargar_hasta(last)
+        last = min(last, len(self._items))
+        while len(self._pool) < last - first:
+            self._pool.append(_Card(self))
+        for k, card in enumerate(self._pool):
+            i = first + k
+            if i < last:
+                self.canvas.coords(card.win, 6, i * ROW_H)
+                self.canvas.itemconfigure(card.win, width=width, state="normal")
+                card.mostrar(self._items[i])
+            else:
+                self.canvas.itemconfigure(card.win, state="hidden")
+                card.fila = None
+
+    def _cargar_hasta(self, n):
+        # pull pages from the source until row n is available, plus one page of read-ahead
+        if self._fuente is None or n <= len(self._items):
             return
+        objetivo = n + fn.TAM_PAGINA
+        for fila in self._fuente:
+            self._items.append(fila)
+            if len(self._items) >= objetivo:
+                return
+        self._fuente = None
+        self._total = len(self._items)  # rows deleted meanwhile: shrink the list
+        self._update_scrollregion()
 
-        for i, item in enumerate(items):
-            fila = item[0] if isinstance(item, tuple) and len(item) == 2 else item
-
-            card = Frame(self.cards_frame, bg=theme.CARD, relief=FLAT)
-            pad_top = 0 if i == 0 else 4
-            card.pack(fill=X, pady=(pad_top, 4), padx=6)
-
-            thumb_frame = Frame(card, width=120, height=96, bg=theme.CARD)
-            thumb_frame.pack_propagate(False)
-            thumb_frame.pack(side=LEFT)
-
+    def _thumbnail(self, img_path):
+        """
+        PhotoImage de la miniatura si ya esta en memoria; si no, la pide a un hilo
+        (cache de disco o render) y devuelve None hasta que llegue.
+        """
+        try:
+            key = miniaturas.ruta_miniatura(img_path)
+        except OSError:
+            return False
+        foto = self._fotos.get(key)
+        if foto is not None:
+            return foto
+        if img_path not in self._thumb_pending:
+            self._thumb_pending.add(img_path)
+            self._thumb_pool.submit(self._load_thumb, img_path)
+        return None
+
+    def _load_thumb(self, img_path):
+        # worker thread: PIL only, Tk objects are created in _poll_thumbs
+        try:
+            with traza.tramo("miniatura_cargar"):
+                img = miniaturas.cargar_miniatura(img_path)
+        except Exception:
+            img = None
+        self._thumb_queue.put((img_path, img))
+
+    def _poll_thumbs(self):
+        while True:
             try:
-                img_path = fila[3]
-                img = Image.open(img_path)
-                img.thumbnail((92, 92), Image.LANCZOS)
-                thumb = ImageOps.expand(img, border=2, fill="#151515")
-                tkimg = ImageTk.PhotoImage(thumb)
-                lbl_img = Label(thumb_frame, image=tkimg, bg=theme.CARD)
-                lbl_img.image = tkimg
-                lbl_img.pack(expand=True, pady=6, padx=6)
-            except:
-                Label(thumb_frame, text="No image", bg=theme.CARD, fg=theme.MUTED).pack(expand=True)
-
-            info_frame = Frame(card, bg=theme.CARD)
-            info_frame.pack(side=LEFT, fill=BOTH, expand=True, padx=12)
-
-            marca = fila[1] if len(fila) > 1 else "N/A"
-            tipo = fila[2] if len(fila) > 2 else "N/A"
-            Label(info_frame, text=f"{marca}", bg=theme.CARD, fg=theme.TEXT, font=("Segoe UI", 11, "bold")).pack(anchor="w")
-            Label(info_frame, text=f"Type: {tipo}", bg=theme.CARD, fg=theme.MUTED).pack(anchor="w", pady=(2, 8))
-
-        self._update_scrollregion()
-        self.canvas.yview_moveto(0)
+                self._ui_queue.get_nowait()()
+            except queue.Empty:
+                break
+        llegadas = False
+        while True:
+            try:
+                img_path, img = self._thumb_queue.get_nowait()
+            except queue.Empty:
+                break
+            self._thumb_pending.discard(img_path)
+            try:
+                with traza.tramo("miniatura_tk"):
+                    foto = ImageTk.PhotoImage(img) if img is not None else False
+                self._fotos.put(miniaturas.ruta_miniatura(img_path), foto)
+            except OSError:
+                pass
+            llegadas = True
+        if llegadas:
+            for card in self._pool:
+                if card.fila is not None:
+                    card.mostrar(card.fila)
+        self.root.after(30, self._poll_thumbs)
+
+
+class _Card:
+    """
+    Widget de una fila de la lista virtual; se reutiliza al hacer scroll.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.fila = None
+        self.frame = Frame(app.canvas, bg=theme.CARD, relief=FLAT, height=ROW_H - 8)
+        self.frame.pack_propagate(False)
+        thumb_frame = Frame(self.frame, width=120, height=96, bg=theme.CARD)
+        thumb_frame.pack_propagate(False)
+        thumb_frame.pack(side=LEFT)
+        self.lbl_img = Label(thumb_frame, bg=theme.CARD, fg=theme.MUTED)
+        self.lbl_img.pack(expand=True, pady=6, padx=6)
+        info_frame = Frame(self.frame, bg=theme.CARD)
+        info_frame.pack(side=LEFT, fill=BOTH, expand=True, padx=12)
+        self.lbl_marca = Label(info_frame, bg=theme.CARD, fg=theme.TEXT, font=("Segoe UI", 11, "bold"))
+        self.lbl_marca.pack(anchor="w")
+        self.lbl_tipo = Label(info_frame, bg=theme.CARD, fg=theme.MUTED)
+        self.lbl_tipo.pack(anchor="w", pady=(2, 8))
+        self.win = app.canvas.create_window((6, 0), window=self.frame, anchor="nw", state="hidden")
+
+    def mostrar(self, fila):
+        self.fila = fila
+        marca = fila[1] if len(fila) > 1 else "N/A"
+        tipo = fila[2] if len(fila) > 2 else "N/A"
+        self.lbl_marca.configure(text=f"{marca}")
+        self.lbl_tipo.configure(text=f"Type: {tipo}")
+        foto = self.app._thumbnail(fila[3]) if len(fila) > 3 and fila[3] else False
+        if foto:
+            self.lbl_img.configure(image=foto, text="")
+        else:
+            self.lbl_img.configure(image="", text="Loading..." if foto is None else "No image")
 
 if __name__ == "__main__":
     root = Tk()
-    app = App(root)
+    app = App(root, perfil="--perfil" in sys.argv[1:], vigilar="--vigilar" in sys.argv[1:])
     root.mainloop()
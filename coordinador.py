@@ -0,0 +1,292 @@
+# coordinador.py
+# Busqueda repartida (scatter-gather) sobre varias colecciones, o trozos de una:
+# cada base de datos la sirve su propio proceso servidor_busqueda.py con su matriz
+# de embeddings residente, y el coordinador reparte cada consulta, mezcla los
+# top-k y sigue respondiendo aunque un shard vaya lento o se caiga. Las imagenes
+# de consulta se embeben una sola vez, aqui, y a los shards solo les llega el
+# vector. Habla el mismo protocolo HTTP que servidor_busqueda, asi la GUI lo usa
+# sin cambios.
+#
+#   python coordinador.py servir --db tienda1/chapas.db tienda2/chapas.db [--puerto 8765]
+#   python coordinador.py servir --remotos 10.0.0.2:8765 10.0.0.3:8765
+#   python coordinador.py repartir chapas.db --partes 4
+import argparse
+import heapq
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.server import ThreadingHTTPServer
+import numpy as np
+import funciones as fn
+import funciones_modelo as fm
+import servidor_busqueda as sb
+import traza
+
+PUERTO_BASE = sb.PUERTO + 1  # local workers listen on PUERTO_BASE, PUERTO_BASE + 1, ...
+TIMEOUT_S = 2.0     # a shard that has not answered by then is left out of the result (embedding not included)
+ARRANQUE_S = 300.0  # local workers load their collection and the model before answering
+REINTENTO_S = 10.0  # a shard that failed is not asked again for this long
+
+def _es_timeout(e):
+    # urllib raises the socket timeout bare or wrapped in URLError
+    return isinstance(e, TimeoutError) or isinstance(getattr(e, "reason", None), TimeoutError)
+
+class Shard:
+    """
+    Un servidor_busqueda. `directorio` (workers locales) resuelve las rutas de
+    imagen relativas de su base de datos.
+    """
+    def __init__(self, nombre, host, puerto, timeout=TIMEOUT_S, directorio=None, proceso=None):
+        self.nombre = nombre
+        self.cliente = sb.Cliente(host, puerto, timeout=timeout)
+        self.directorio = directorio
+        self.proceso = proceso
+        self.caido_hasta = 0.0
+
+    def fila(self, fila):
+        id_, marca, tipo, imagen = fila
+        if self.directorio and imagen and not os.path.isabs(imagen):
+            imagen = os.path.join(self.directorio, imagen)
+        return (id_, marca, tipo, imagen)
+
+class Coordinador:
+    """
+    Reparte las consultas entre shards y mezcla las respuestas. Los resultados
+    tienen la misma forma que los de servidor_busqueda.Cliente; los ids solo son
+    unicos dentro de cada coleccion. Tras cada consulta, `fallidos` lista los
+    shards que no respondieron a tiempo.
+    """
+    def __init__(self, shards, timeout=TIMEOUT_S):
+        self.shards = list(shards)
+        self.timeout = timeout
+        self.fallidos = []
+        self._pool = ThreadPoolExecutor(max_workers=max(4 * len(self.shards), 1))
+
+    @classmethod
+    def local(cls, dbs, puerto_base=PUERTO_BASE, timeout=TIMEOUT_S, arranque=ARRANQUE_S, vigilar=False):
+        """
+        Lanza un servidor_busqueda por base de datos (en la carpeta de la base,
+        donde se resuelven sus rutas relativas) y espera a que respondan.
+        """
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "servidor_busqueda.py")
+        shards = []
+        for i, db in enumerate(dbs):
+            db = os.path.abspath(db)
+            puerto = puerto_base + i
+            cmd = [sys.executable, script, "--db", db, "--puerto", str(puerto)] + (["--vigilar"] if vigilar else [])
+            proc = subprocess.Popen(cmd, cwd=os.path.dirname(db))
+            shards.append(Shard(db, sb.HOST, puerto, timeout, os.path.dirname(db), proc))
+        coord = cls(shards, timeout)
+        limite = time.monotonic() + arranque
+        pendientes = list(shards)
+        while pendientes:
+            for s in [s for s in pendientes if s.proceso.poll() is not None]:
+                coord.detener()
+                raise RuntimeError(f"el shard {s.nombre} termino al arrancar (codigo {s.proceso.returncode})")
+            pendientes = [s for s in pendientes if not s.cliente.disponible()]
+            if pendientes and time.monotonic() > limite:
+                coord.detener()
+                raise RuntimeError(f"shards sin responder tras {arranque:.0f} s: "
+                                   f"{', '.join(s.nombre for s in pendientes)}")
+            if pendientes:
+                time.sleep(0.2)
+        return coord
+
+    @classmethod
+    def remoto(cls, destinos, timeout=TIMEOUT_S):
+        """
+        Shards ya en marcha, como "host:puerto".
+        """
+        shards = []
+        for d in destinos:
+            host, _, puerto = d.rpartition(":")
+            shards.append(Shard(d, host or sb.HOST, int(puerto), timeout))
+        return cls(shards, timeout)
+
+    def detener(self):
+        for s in self.shards:
+            if s.proceso is not None and s.proceso.poll() is None:
+                s.proceso.terminate()
+        for s in self.shards:
+            if s.proceso is not None:
+                try:
+                    s.proceso.wait(5)
+                except subprocess.TimeoutExpired:
+                    s.proceso.kill()
+        self._pool.shutdown(wait=False)
+
+    def _repartir(self, llamada):
+        """
+        llamada(shard) en paralelo en los shards disponibles; retorna
+        [(shard, resultado)] de los que respondieron antes del timeout.
+        """
+        ahora = time.monotonic()
+        vivos = [s for s in self.shards if s.caido_hasta <= ahora]
+        futs = {self._pool.submit(llamada, s): s for s in vivos}
+        hechos, _ = wait(futs, timeout=self.timeout)
+        respuestas, fallidos = [], [s.nombre for s in self.shards if s not in vivos]
+        for fut, s in futs.items():
+            if fut not in hechos or _es_timeout(fut.exception()):
+                fallidos.append(s.nombre)  # slow: left out of this query only
+            elif fut.exception() is not None:
+                fallidos.append(s.nombre)
+                s.caido_hasta = time.monotonic() + REINTENTO_S
+                print(f"Shard {s.nombre}: {fut.exception()}")
+            else:
+                respuestas.append((s, fut.result()))
+        self.fallidos = fallidos
+        if not respuestas:
+            raise RuntimeError("ningun shard respondio a tiempo")
+        return respuestas
+
+    def buscar_por_imagenes(self, paths, top_k=8, nprobe=None, marca=None, tipo=None):
+        # one forward pass here, before the shard timeout starts; rounded like the shards'
+        # embedding cache so the scores match what a single server would return
+        Q = fm.batch_imagenes_a_embeddings(list(paths)).astype(fn._emb_dtype).astype(np.float32)
+        return self.buscar_por_embeddings(Q, top_k, nprobe, marca, tipo)
+
+    def buscar_por_embeddings(self, Q, top_k=8, nprobe=None, marca=None, tipo=None):
+        respuestas = self._repartir(lambda s: s.cliente.buscar_por_embeddings(Q, top_k, nprobe, marca, tipo))
+        out = []
+        for i in range(len(Q)):
+            # every shard returns its own top-k sorted desc: merge and keep the global top-k
+            listas = [[(s.fila(fila), sim) for fila, sim in res[i]] for s, res in respuestas]
+            out.append(list(heapq.merge(*listas, key=lambda r: -r[1]))[:top_k])
+        return out
+
+    def buscar_por_imagen(self, path, top_k=8, nprobe=None, marca=None, tipo=None):
+        return self.buscar_por_imagenes([path], top_k, nprobe, marca, tipo)[0]
+
+    def buscar_por_marca(self, texto, limite=None):
+        respuestas = self._repartir(lambda s: s.cliente.buscar_por_marca(texto, limite))
+        # same order as funciones.buscar_por_marca: brands starting with the text first,
+        # then each shard's own relevance order
+        q = fn.sin_acentos(texto.strip())
+        filas = [s.fila(f) for s, res in respuestas for f in res]
+        filas.sort(key=lambda f: not (fn.sin_acentos(f[1]) or "").startswith(q))
+        return filas if limite is None else filas[:int(limite)]
+
+    def estado(self):
+        respuestas = self._repartir(lambda s: s.cliente.estado())
+        return {"filas": sum(r["filas"] for _, r in respuestas), "indice": "shards",
+                "shards": [{"nombre": s.nombre, **r} for s, r in respuestas], "fallidos": self.fallidos}
+
+    def recargar(self):
+        self._repartir(lambda s: s.cliente.recargar())
+        return self.estado()
+
+# ----------------- HTTP front end (same protocol as servidor_busqueda) -----------------
+class _ManejadorCoordinador(sb._Manejador):
+    coordinador = None
+
+    def _estado(self):
+        return self.coordinador.estado()
+
+    def imagen(self, pet):
+        # the breakdown covers the work done here (decode, forward); shards answer in parallel
+        with traza.consulta() as desglose:
+            res = self.coordinador.buscar_por_imagenes(pet["paths"], int(pet.get("top_k", 8)), pet.get("nprobe"),
+                                                       pet.get("marca"), pet.get("tipo"))
+        return {"resultados": [[[list(fila), s] for fila, s in r] for r in res],
+                "tiempos": desglose or {}, "fallidos": self.coordinador.fallidos}
+
+    def embeddings(self, pet):
+        Q = np.asarray(pet["embeddings"], dtype=np.float32).reshape(len(pet["embeddings"]), -1)
+        with traza.consulta() as desglose:
+            res = self.coordinador.buscar_por_embeddings(Q, int(pet.get("top_k", 8)), pet.get("nprobe"),
+                                                         pet.get("marca"), pet.get("tipo"))
+        return {"resultados": [[[list(fila), s] for fila, s in r] for r in res],
+                "tiempos": desglose or {}, "fallidos": self.coordinador.fallidos}
+
+    def marca(self, pet):
+        return {"filas": [list(f) for f in self.coordinador.buscar_por_marca(pet["texto"], pet.get("limite"))],
+                "fallidos": self.coordinador.fallidos}
+
+    def recargar(self, pet):
+        return self.coordinador.recargar()
+
+def servir(coordinador, host=sb.HOST, puerto=sb.PUERTO, verbose=False):
+    _ManejadorCoordinador.coordinador = coordinador
+    _ManejadorCoordinador.verbose = verbose
+    t0 = time.perf_counter()
+    fm.calentar()  # the coordinator embeds the query images itself
+    print(f"Modelo cargado en {time.perf_counter() - t0:.1f} s")
+    servidor = ThreadingHTTPServer((host, puerto), _ManejadorCoordinador)
+    servidor.daemon_threads = True
+    print(f"Coordinando {len(coordinador.shards)} shards en http://{host}:{puerto}")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+        coordinador.detener()
+
+# ----------------- Splitting one collection into row shards -----------------
+def repartir(db, partes):
+    """
+    Reparte las chapas de `db` en `partes` bases (chapas.0.db, chapas.1.db...) en
+    la misma carpeta, por id modulo partes. Retorna las rutas.
+    """
+    base, ext = os.path.splitext(db)
+    destinos = [f"{base}.{i}{ext}" for i in range(partes)]
+    for d in destinos:
+        if os.path.exists(d):
+            raise FileExistsError(f"ya existe {d}")
+    anterior = fn.DB_FILE
+    try:
+        for i, d in enumerate(destinos):
+            fn.DB_FILE = d
+            fn.crear_bd()
+            fn.ensure_embedding_column()
+            conn = fn._conectar()
+            conn.execute("ATTACH DATABASE ? AS origen", (db,))
+            with conn:
+                # the triggers fill the change log and the brand index of each shard
+                conn.execute("INSERT INTO chapas (id, marca, tipo, imagen, embedding) "
+                             "SELECT id, marca, tipo, imagen, embedding FROM origen.chapas "
+                             "WHERE ((id % ?) + ?) % ? = ?", (partes, partes, partes, i))
+            conn.execute("DETACH DATABASE origen")
+            conn.close()
+    except sqlite3.Error:
+        for d in destinos:
+            if os.path.exists(d):
+                os.remove(d)
+        raise
+    finally:
+        fn.DB_FILE = anterior
+    return destinos
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Busqueda repartida entre varias colecciones")
+    sub = parser.add_subparsers(dest="orden", required=True)
+    p = sub.add_parser("servir", help="coordina varios servidores de busqueda")
+    origen = p.add_mutually_exclusive_group(required=True)
+    origen.add_argument("--db", nargs="+", help="bases de datos: un proceso local por cada una")
+    origen.add_argument("--remotos", nargs="+", metavar="HOST:PUERTO", help="servidores ya en marcha")
+    p.add_argument("--host", default=sb.HOST)
+    p.add_argument("--puerto", type=int, default=sb.PUERTO)
+    p.add_argument("--puerto-base", type=int, default=PUERTO_BASE, help="primer puerto de los procesos locales")
+    p.add_argument("--timeout", type=float, default=TIMEOUT_S, help="espera maxima por shard (s)")
+    p.add_argument("--vigilar", action="store_true", help="cada proceso local reindexa sus imagenes cuando cambian")
+    p.add_argument("--verbose", action="store_true", help="registra cada peticion")
+    p = sub.add_parser("repartir", help="divide una coleccion en varias bases por id")
+    p.add_argument("db")
+    p.add_argument("--partes", type=int, required=True)
+    args = parser.parse_args(argv)
+
+    if args.orden == "repartir":
+        for d in repartir(args.db, args.partes):
+            print(d)
+        return
+    if args.db:
+        coord = Coordinador.local(args.db, args.puerto_base, args.timeout, vigilar=args.vigilar)
+    else:
+        coord = Coordinador.remoto(args.remotos, args.timeout)
+    servir(coord, args.host, args.puerto, args.verbose)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# exportar.py
+# Exporta la coleccion a .xlsx, .csv o .parquet en streaming: las filas salen de
+# SQLite pagina a pagina hacia un escritor incremental, con memoria constante.
+# Con --cambios solo se escriben las chapas tocadas desde la ultima exportacion
+# al mismo destino y formato (log chapas_cambios), para copias nocturnas rapidas.
+#
+#   python exportar.py [--formato xlsx|csv|parquet] [--destino export_excel] [--cambios]
+import argparse
+import csv
+import os
+import time
+from datetime import datetime
+from itertools import islice
+import funciones as fn
+
+DESTINO = "export_excel"
+FORMATOS = ("xlsx", "csv", "parquet")
+COLUMNAS = ("id", "marca", "tipo", "imagen")
+FILAS_LOTE = 4096  # rows handed to the writer at a time (one Parquet row group)
+
+# ----------------- Writers: escribir(filas) any number of times, then cerrar() -----------------
+class _EscritorXlsx:
+    def __init__(self, path, cabecera):
+        from openpyxl import Workbook
+        self.path = path
+        # write-only workbook: rows go to a temporary file, memory does not grow with the table
+        self.wb = Workbook(write_only=True)
+        self.ws = self.wb.create_sheet("Sheet1")  # same sheet name pandas used
+        self.ws.append(list(cabecera))
+
+    def escribir(self, filas):
+        for f in filas:
+            self.ws.append(list(f))
+
+    def cerrar(self):
+        self.wb.save(self.path)
+
+
+class _EscritorCsv:
+    def __init__(self, path, cabecera):
+        # utf-8-sig: Excel opens it with the right accents, and importar_excel reads it back
+        self.f = open(path, "w", newline="", encoding="utf-8-sig")
+        self.w = csv.writer(self.f)
+        self.w.writerow(cabecera)
+
+    def escribir(self, filas):
+        self.w.writerows(filas)
+
+    def cerrar(self):
+        self.f.close()
+
+
+class _EscritorParquet:
+    def __init__(self, path, cabecera):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        tipos = {"id": pa.int64(), "borrada": pa.int8()}
+        self.schema = pa.schema([(c, tipos.get(c, pa.string())) for c in cabecera])
+        self.w = pq.ParquetWriter(path, self.schema)
+
+    def escribir(self, filas):
+        columnas = list(zip(*filas))
+        arrays = []
+        for campo, valores in zip(self.schema, columnas):
+            if campo.type == self.pa.string():
+                # SQLite is typeless: a brand typed as a number in Excel comes back as int
+                valores = [None if v is None else str(v) for v in valores]
+            arrays.append(self.pa.array(valores, type=campo.type))
+        self.w.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def cerrar(self):
+        self.w.close()
+
+
+_ESCRITORES = {"xlsx": _EscritorXlsx, "csv": _EscritorCsv, "parquet": _EscritorParquet}
+
+# ----------------- Export -----------------
+def exportar(formato="xlsx", destino=DESTINO, cambios=False):
+    """
+    Escribe una instantanea en `destino` y retorna (archivo, filas); archivo es
+    None si cambios=True y nada cambio desde la ultima exportacion. Con
+    cambios=True el fichero lleva una columna extra "borrada" (1 = la chapa ya no
+    existe) y la primera exportacion a un destino es completa.
+    """
+    if formato not in _ESCRITORES:
+        raise ValueError(f"formato no soportado: {formato} (usa {', '.join(FORMATOS)})")
+    fn.crear_bd()
+    clave = os.path.abspath(destino)
+    # read before streaming: a change made during the export also lands in the next snapshot
+    hasta = fn.ultimo_cambio()
+    desde = fn.marca_exportacion(clave, formato) if cambios else None
+    if desde is not None and desde >= hasta:
+        return None, 0
+    if desde is not None and not fn.cambios_conservados(desde):
+        desde = None  # the log no longer reaches back to that mark: full snapshot
+
+    os.makedirs(destino, exist_ok=True)
+    fecha_hora = datetime.now().strftime("%Y%m%d_%H%M%S")
+    if desde is None:
+        archivo = os.path.join(destino, f"chapas_{fecha_hora}.{formato}")
+        cabecera = COLUMNAS
+        filas = fn.iterar_chapas(COLUMNAS)
+    else:
+        archivo = os.path.join(destino, f"chapas_cambios_{fecha_hora}.{formato}")
+        cabecera = COLUMNAS + ("borrada",)
+        filas = (fila + (int(borrada),) for fila, borrada in fn.iterar_cambios(desde, hasta, COLUMNAS))
+
+    # written under a temporary name: an interrupted export never looks like a finished one
+    tmp = archivo + ".tmp"
+    n = 0
+    escritor = _ESCRITORES[formato](tmp, cabecera)
+    try:
+        while True:
+            lote = list(islice(filas, FILAS_LOTE))
+            if not lote:
+                break
+            escritor.escribir(lote)
+            n += len(lote)
+        escritor.cerrar()
+        os.replace(tmp, archivo)
+    except BaseException:
+        try:
+            escritor.cerrar()
+        except Exception:
+            pass
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    fn.guardar_marca_exportacion(clave, formato, hasta, archivo)
+    return archivo, n
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Exporta la coleccion de chapas")
+    parser.add_argument("--formato", choices=FORMATOS, default="xlsx")
+    parser.add_argument("--destino", default=DESTINO, help="carpeta de las exportaciones")
+    parser.add_argument("--cambios", action="store_true",
+                        help="solo las chapas cambiadas desde la ultima exportacion a este destino")
+    args = parser.parse_args(argv)
+    t0 = time.perf_counter()
+    archivo, n = exportar(args.formato, args.destino, args.cambios)
+    if archivo is None:
+        print("Sin cambios desde la ultima exportacion.")
+    else:
+        print(f"{n} filas exportadas a {archivo} en {time.perf_counter() - t0:.1f} s")
+
+if __name__ == "__main__":
+    main()
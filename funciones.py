@@ -1,22 +1,65 @@
 # funciones.py
 import sqlite3
 import os
+import json
+import time
+import hashlib
+import threading
+import unicodedata
+import uuid
+from difflib import SequenceMatcher
 import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
-import pandas as pd
+from itertools import islice
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+import indice_vectorial as iv
+import traza
 
 DB_FILE = "chapas.db"
 IMAGES_DIR = "imagenes"
 _EMBEDDINGS_LOADED = False
-_emb_matrix = None      # numpy float32 (N, D)
+_emb_matrix = None      # (N, D) view of the embedding buffer: float16 memmap or float32
 _emb_ids = None         # list of row tuples (id, marca, tipo, imagen)
 _emb_paths = None       # list of image paths
 _emb_dtype = np.float16 # storage dtype
+INDICE_TIPO = "flat"    # "flat" (exact, default), opt-in approximate "ivf", "pq" or "auto" (ivf for large collections)
+NPROBE = iv.NPROBE_DEFECTO
+_indice = None          # iv.IndiceFlat / iv.IndiceIVF bound to _emb_matrix
+_emb_lock = threading.RLock()  # the GUI warm-up thread and searches share the store
 
 # ----------------- DB helpers -----------------
-def crear_bd():
+LOTE_ESCRITURA = 5000   # rows per transaction in insertar_chapas_bulk
+ID_AUTOMATICO = 1_000_000_000  # caps created by the watch mode (vigilar_imagenes --crear) get ids from here on
+
+def _conectar():
+    # WAL is persistent in the file (set in crear_bd); synchronous=NORMAL is safe under WAL
+    # and avoids an fsync per commit; cache_size < 0 is in KiB (64 MB)
     conn = sqlite3.connect(DB_FILE)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.create_function("sin_acentos", 1, sin_acentos, deterministic=True)
+    return conn
+
+def sin_acentos(texto):
+    """
+    Minusculas sin diacriticos: "Mahóu" -> "mahou". Se registra como funcion SQL
+    en cada conexion (la usan los triggers del indice FTS en SQLite < 3.45).
+    """
+    if texto is None:
+        return None
+    texto = unicodedata.normalize("NFKD", str(texto))
+    return "".join(c for c in texto if not unicodedata.combining(c)).casefold()
+
+def crear_bd():
+    conn = _conectar()
     cur = conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
     cur.execute("""
     CREATE TABLE IF NOT EXISTS chapas (
         id INTEGER PRIMARY KEY,
@@ -26,12 +69,165 @@ def crear_bd():
         embedding BLOB
     )
     """)
+    _crear_log_cambios(cur)
+    _crear_cache_embeddings(cur)
+    _crear_indice_marcas(cur)
+    _crear_progreso_importacion(cur)
+    _crear_marcas_exportacion(cur)
+    # type filter of the hybrid image search
+    cur.execute("CREATE INDEX IF NOT EXISTS chapas_tipo ON chapas (tipo COLLATE NOCASE)")
     conn.commit()
     conn.close()
 
+def _crear_log_cambios(cur):
+    # change log fed by triggers: every insert/replace/update/delete on chapas appends
+    # (seq, chapa_id) so readers can apply deltas instead of rereading the table
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS chapas_cambios (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        chapa_id INTEGER NOT NULL
+    )
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS chapas_log_ins AFTER INSERT ON chapas
+    BEGIN INSERT INTO chapas_cambios (chapa_id) VALUES (NEW.id); END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS chapas_log_upd AFTER UPDATE ON chapas
+    BEGIN INSERT INTO chapas_cambios (chapa_id) VALUES (OLD.id), (NEW.id); END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS chapas_log_del AFTER DELETE ON chapas
+    BEGIN INSERT INTO chapas_cambios (chapa_id) VALUES (OLD.id); END
+    """)
+
+def _crear_indice_marcas(cur):
+    # FTS5 trigram index over marca/tipo (rowid = chapas.id). SQLite >= 3.45 strips
+    # accents in the tokenizer and triggers keep the index in sync. Older versions store
+    # the text normalized by sin_acentos(), which only exists in our own connections: a
+    # trigger calling it would break every other writer, so _actualizar_fts() indexes
+    # the rows changed since chapas_fts_estado.seq from Python before each query.
+    existia = cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'chapas_fts'").fetchone()
+    en_python = cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'chapas_fts_estado'").fetchone()
+    nativo = sqlite3.sqlite_version_info >= (3, 45, 0) and not (existia and en_python)
+    tokenize = "trigram remove_diacritics 1" if nativo else "trigram"
+    try:
+        cur.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS chapas_fts USING fts5(marca, tipo, tokenize='{tokenize}')")
+    except sqlite3.OperationalError:
+        return  # SQLite built without FTS5: buscar_por_marca falls back to LIKE
+    if not nativo:
+        for trigger in ("chapas_fts_ins", "chapas_fts_del", "chapas_fts_upd"):
+            cur.execute(f"DROP TRIGGER IF EXISTS {trigger}")  # databases indexed by the old UDF triggers
+        cur.execute("CREATE TABLE IF NOT EXISTS chapas_fts_estado (seq INTEGER NOT NULL)")
+        if cur.execute("SELECT 1 FROM chapas_fts_estado").fetchone() is None:
+            if not existia:
+                cur.execute("INSERT INTO chapas_fts (rowid, marca, tipo) "
+                            "SELECT id, sin_acentos(marca), sin_acentos(tipo) FROM chapas")
+            # an index kept by the old triggers is already up to date
+            cur.execute("INSERT INTO chapas_fts_estado (seq) SELECT COALESCE(MAX(seq), 0) FROM chapas_cambios")
+        return
+    ins = "INSERT INTO chapas_fts (rowid, marca, tipo) VALUES (NEW.id, NEW.marca, NEW.tipo);"
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS chapas_fts_ins AFTER INSERT ON chapas BEGIN {ins} END")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS chapas_fts_del AFTER DELETE ON chapas
+    BEGIN DELETE FROM chapas_fts WHERE rowid = OLD.id; END
+    """)
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS chapas_fts_upd AFTER UPDATE OF id, marca, tipo ON chapas
+    BEGIN DELETE FROM chapas_fts WHERE rowid = OLD.id; {ins} END
+    """)
+    if not existia:
+        # existing database: index the rows already there
+        cur.execute("INSERT INTO chapas_fts (rowid, marca, tipo) SELECT id, marca, tipo FROM chapas")
+
+def _crear_cache_embeddings(cur):
+    # embeddings keyed by content hash + preprocessing version, plus a (path, size, mtime) -> hash pre-check
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS embeddings_cache (
+        hash TEXT PRIMARY KEY,
+        embedding BLOB NOT NULL
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ficheros_hash (
+        path TEXT PRIMARY KEY,
+        size INTEGER,
+        mtime_ns INTEGER,
+        hash TEXT
+    )
+    """)
+
+def _crear_progreso_importacion(cur):
+    # checkpoint of importar_excel: rows of `fuente` already committed, valid while the
+    # file signature (size + mtime) does not change
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS importaciones (
+        fuente TEXT PRIMARY KEY,
+        firma TEXT NOT NULL,
+        filas INTEGER NOT NULL,
+        actualizado TEXT
+    )
+    """)
+
+def progreso_importacion(fuente, firma):
+    """
+    Filas de `fuente` ya importadas en una ejecucion anterior (0 si no hay
+    checkpoint o el fichero cambio desde entonces).
+    """
+    conn = _conectar()
+    fila = conn.execute("SELECT firma, filas FROM importaciones WHERE fuente = ?", (fuente,)).fetchone()
+    conn.close()
+    return fila[1] if fila and fila[0] == firma else 0
+
+def guardar_progreso_importacion(fuente, firma, filas):
+    conn = _conectar()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO importaciones (fuente, firma, filas, actualizado) VALUES (?, ?, ?, ?)",
+                     (fuente, firma, filas, datetime.now().isoformat(timespec="seconds")))
+    conn.close()
+
+def terminar_importacion(fuente):
+    conn = _conectar()
+    with conn:
+        conn.execute("DELETE FROM importaciones WHERE fuente = ?", (fuente,))
+    conn.close()
+
+def _crear_marcas_exportacion(cur):
+    # last chapas_cambios.seq covered by the exports written to each destination/format:
+    # the next incremental snapshot starts right after it
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS exportaciones (
+        destino TEXT NOT NULL,
+        formato TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        archivo TEXT,
+        actualizado TEXT,
+        PRIMARY KEY (destino, formato)
+    )
+    """)
+
+def marca_exportacion(destino, formato):
+    """
+    seq del log de cambios cubierto por la ultima exportacion a (destino,
+    formato); None si nunca se exporto ahi.
+    """
+    conn = _conectar()
+    fila = conn.execute("SELECT seq FROM exportaciones WHERE destino = ? AND formato = ?",
+                        (destino, formato)).fetchone()
+    conn.close()
+    return fila[0] if fila else None
+
+def guardar_marca_exportacion(destino, formato, seq, archivo):
+    conn = _conectar()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO exportaciones (destino, formato, seq, archivo, actualizado) "
+                     "VALUES (?, ?, ?, ?, ?)",
+                     (destino, formato, seq, archivo, datetime.now().isoformat(timespec="seconds")))
+    conn.close()
+
 def ensure_embedding_column():
     # safe add column if not exists (sqlite doesn't support IF NOT EXISTS for ALTER)
-    conn = sqlite3.connect(DB_FILE)
+    conn = _conectar()
     cur = conn.cursor()
     cur.execute("PRAGMA table_info(chapas)")
     cols = [r[1] for r in cur.fetchall()]
@@ -44,115 +240,968 @@ def insertar_chapa(id_, marca, tipo, imagen_path, emb_bytes=None):
     """
     inserta o reemplaza. emb_bytes es None o blob (np.array.tobytes of float16)
     """
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT OR REPLACE INTO chapas (id, marca, tipo, imagen, embedding)
-        VALUES (?, ?, ?, ?, ?)
-    """, (id_, marca, tipo, imagen_path, emb_bytes))
-    conn.commit()
-    conn.close()
+    insertar_chapas_bulk([(id_, marca, tipo, imagen_path, emb_bytes)])
+    if _EMBEDDINGS_LOADED:
+        # apply the row to the buffer and the index now, so it is searchable right away
+        reload_embeddings()
+
+def insertar_chapas_bulk(filas, lote=LOTE_ESCRITURA):
+    """
+    Inserta o actualiza muchas filas (id, marca, tipo, imagen, emb_bytes) con una
+    sola conexion, executemany y una transaccion por lote. Las filas identicas a
+    las ya guardadas no se reescriben (ni generan cambios en chapas_cambios).
+    Retorna el numero de filas realmente escritas.
+    """
+    filas = iter(filas)
+    escritas = 0
+    conn = _conectar()
+    try:
+        while True:
+            bloque = list(islice(filas, lote))
+            if not bloque:
+                break
+            with conn:  # one transaction per batch
+                cur = conn.executemany("""
+                    INSERT INTO chapas (id, marca, tipo, imagen, embedding)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET
+                        marca = excluded.marca, tipo = excluded.tipo,
+                        imagen = excluded.imagen, embedding = excluded.embedding
+                    WHERE chapas.marca IS NOT excluded.marca
+                       OR chapas.tipo IS NOT excluded.tipo
+                       OR chapas.imagen IS NOT excluded.imagen
+                       OR chapas.embedding IS NOT excluded.embedding
+                """, bloque)
+                escritas += cur.rowcount
+    finally:
+        conn.close()
+    return escritas
 
 def obtener_todas_chapas():
-    conn = sqlite3.connect(DB_FILE)
+    conn = _conectar()
     cur = conn.cursor()
     cur.execute("SELECT id, marca, tipo, imagen, embedding FROM chapas ORDER BY id")
     datos = cur.fetchall()
     conn.close()
     return datos
 
+COLUMNAS = ("id", "marca", "tipo", "imagen", "embedding")
+TAM_PAGINA = 1000
+
+def _columnas_sql(columnas):
+    for c in columnas:
+        if c not in COLUMNAS:
+            raise ValueError(f"columna desconocida: {c}")
+    # id always comes first: it is the pagination key
+    return ["id"] + [c for c in columnas if c != "id"]
+
+def pagina_chapas(columnas=("id", "marca", "tipo", "imagen"), despues_de=None, limite=TAM_PAGINA):
+    """
+    Una pagina de filas con id > despues_de, ordenadas por id (paginacion por
+    clave: coste constante por pagina, sin OFFSET). Solo lee las columnas pedidas.
+    """
+    cols = _columnas_sql(columnas)
+    conn = _conectar()
+    cur = conn.cursor()
+    if despues_de is None:
+        cur.execute(f"SELECT {', '.join(cols)} FROM chapas ORDER BY id LIMIT ?", (limite,))
+    else:
+        cur.execute(f"SELECT {', '.join(cols)} FROM chapas WHERE id > ? ORDER BY id LIMIT ?",
+                    (despues_de, limite))
+    datos = cur.fetchall()
+    conn.close()
+    return datos
+
+def iterar_chapas(columnas=("id", "marca", "tipo", "imagen"), tam_pagina=TAM_PAGINA):
+    """
+    Generador sobre toda la tabla pagina a pagina; memoria constante y ninguna
+    transaccion abierta entre paginas.
+    """
+    despues_de = None
+    while True:
+        pagina = pagina_chapas(columnas, despues_de, tam_pagina)
+        yield from pagina
+        if len(pagina) < tam_pagina:
+            return
+        despues_de = pagina[-1][0]
+
+def contar_chapas():
+    conn = _conectar()
+    n = conn.execute("SELECT COUNT(*) FROM chapas").fetchone()[0]
+    conn.close()
+    return n
+
+def ultimo_cambio():
+    """
+    seq mas alto de chapas_cambios (0 con el log vacio).
+    """
+    conn = _conectar()
+    seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM chapas_cambios").fetchone()[0]
+    conn.close()
+    return seq
+
+def cambios_conservados(desde):
+    """
+    True si el log conserva todos los cambios con seq > desde. El log se poda
+    al publicar el sidecar; una marca mas antigua obliga a releer la tabla.
+    """
+    conn = _conectar()
+    cubre = _log_cubre(conn, desde)
+    conn.close()
+    return cubre
+
+def _log_cubre(conn, desde):
+    minimo = conn.execute("SELECT MIN(seq) FROM chapas_cambios").fetchone()[0]
+    return minimo is None or desde >= minimo - 1
+
+def _podar_cambios(seq_sidecar):
+    # the log only has to reach back to its slowest reader: the published sidecar, the FTS
+    # catch-up mark and the incremental export marks. The newest row always stays, so
+    # MAX(seq) keeps counting from where it was
+    conn = _conectar()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        marcas = [seq_sidecar]
+        tablas = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if "exportaciones" in tablas:
+            marcas += [r[0] for r in conn.execute("SELECT seq FROM exportaciones")]
+        if "chapas_fts_estado" in tablas:
+            marcas += [r[0] for r in conn.execute("SELECT seq FROM chapas_fts_estado")]
+        conn.execute("DELETE FROM chapas_cambios WHERE seq <= ? "
+                     "AND seq < (SELECT MAX(seq) FROM chapas_cambios)", (min(marcas),))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def iterar_cambios(desde, hasta, columnas=("id", "marca", "tipo", "imagen"), tam_pagina=500):
+    """
+    Generador de (fila, borrada) para las chapas tocadas con desde < seq <= hasta,
+    por id. La fila es el estado actual; una chapa borrada sale como
+    (id, None, ...) con borrada=True.
+    """
+    cols = _columnas_sql(columnas)
+    conn = _conectar()
+    ids = np.fromiter((r[0] for r in conn.execute(
+        "SELECT DISTINCT chapa_id FROM chapas_cambios WHERE seq > ? AND seq <= ? ORDER BY chapa_id",
+        (desde, hasta))), dtype=np.int64)
+    conn.close()
+    # pages of ids stay under SQLite's bound-parameter limit
+    for i in range(0, len(ids), tam_pagina):
+        pagina = ids[i:i + tam_pagina].tolist()
+        conn = _conectar()
+        cur = conn.execute(f"SELECT {', '.join(cols)} FROM chapas WHERE id IN "
+                           f"({', '.join('?' * len(pagina))})", pagina)
+        filas = {f[0]: f for f in cur}
+        conn.close()
+        for id_ in pagina:
+            fila = filas.get(id_)
+            if fila is None:
+                yield (id_,) + (None,) * (len(cols) - 1), True
+            else:
+                yield fila, False
+
+def siguiente_id_chapa(desde=1):
+    """
+    Primer id libre a partir de `desde` (tras el mayor id >= desde).
+    """
+    conn = _conectar()
+    n = conn.execute("SELECT COALESCE(MAX(id) + 1, ?) FROM chapas WHERE id >= ?", (desde, desde)).fetchone()[0]
+    conn.close()
+    return n
+
+# ----------------- Content-hash embedding cache -----------------
+def _hash_fichero(path, bloque=1 << 20):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(bloque), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def hashes_de_ficheros(paths, guardar=True):
+    """
+    Retorna {path: hash del contenido}. Solo se leen los ficheros cuyo tamano o
+    mtime cambiaron desde la ultima vez; el resto sale de ficheros_hash.
+    guardar=False solo consulta ficheros_hash (imagenes de una busqueda). Las
+    rutas que no se pueden leer (borradas, renombradas) no salen en el resultado.
+    """
+    paths = list(dict.fromkeys(paths))
+    conn = _conectar()
+    conocidos = {}
+    for s in range(0, len(paths), 500):
+        lote = paths[s:s+500]
+        cur = conn.execute(f"SELECT path, size, mtime_ns, hash FROM ficheros_hash "
+                           f"WHERE path IN ({','.join('?' * len(lote))})", lote)
+        conocidos.update((r[0], r[1:]) for r in cur.fetchall())
+    out = {}
+    nuevos = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            prev = conocidos.get(p)
+            if prev is not None and prev[0] == st.st_size and prev[1] == st.st_mtime_ns:
+                out[p] = prev[2]
+            else:
+                out[p] = _hash_fichero(p)
+                nuevos.append((p, st.st_size, st.st_mtime_ns, out[p]))
+        except OSError:
+            continue  # gone since it was listed: the caller decides what that means
+    if nuevos and guardar:
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO ficheros_hash (path, size, mtime_ns, hash) VALUES (?, ?, ?, ?)",
+                             nuevos)
+    conn.close()
+    return out
+
+def _sufijo_cache():
+    # entries are keyed "<content hash>:<preprocessing version>": vectors computed with an
+    # older decode no longer match and are recomputed on next use
+    import funciones_modelo as fm
+    return f":{fm.VERSION_PREPROCESO}"
+
+def embeddings_cacheados(hashes):
+    """
+    Retorna {hash: emb_bytes} para los hashes ya embebidos con el
+    preprocesado actual.
+    """
+    sufijo = _sufijo_cache()
+    claves = list({h + sufijo for h in hashes})
+    out = {}
+    conn = _conectar()
+    for s in range(0, len(claves), 500):
+        lote = claves[s:s+500]
+        cur = conn.execute(f"SELECT hash, embedding FROM embeddings_cache WHERE hash IN ({','.join('?' * len(lote))})",
+                           lote)
+        out.update((clave[:-len(sufijo)], emb) for clave, emb in cur.fetchall())
+    conn.close()
+    return out
+
+def guardar_embeddings_cache(pares):
+    """
+    Guarda pares (hash, emb_bytes) en la cache.
+    """
+    sufijo = _sufijo_cache()
+    conn = _conectar()
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO embeddings_cache (hash, embedding) VALUES (?, ?)",
+                         ((h + sufijo, emb) for h, emb in pares))
+    conn.close()
+
+# Query images (searches) never write to the persistent caches: a photo taken to look a
+# cap up is usually not in the collection. They may reuse a stored vector and otherwise
+# go through this small in-memory LRU, keyed by (path, size, mtime).
+CONSULTAS_MAX = 256
+_consultas = OrderedDict()
+_consultas_lock = threading.Lock()
+
+def _firma_consulta(path):
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+def embedding_de_imagen(path, guardar=False):
+    """
+    Embedding float32 de una imagen: reutiliza la cache si esos bytes ya se
+    procesaron (aunque fuera con otro nombre); si no, ejecuta el modelo.
+    guardar=True (importacion, vigilancia) lo deja en la cache persistente.
+    """
+    return embeddings_de_imagenes([path], guardar)[0]
+
+def embeddings_de_imagenes(paths, guardar=False):
+    """
+    Como embedding_de_imagen para muchas rutas: las que no estan en cache pasan
+    por el modelo en lotes (una vez por contenido distinto). Retorna (N, D) float32.
+    """
+    paths = list(paths)
+    if not paths:
+        return np.empty((0,0), dtype=np.float32)
+    blobs, firmas = {}, {}
+    if not guardar:
+        with _consultas_lock:
+            for p in dict.fromkeys(paths):
+                firmas[p] = _firma_consulta(p)
+                blob = _consultas.get(firmas[p])
+                if blob is not None:
+                    _consultas.move_to_end(firmas[p])
+                    blobs[p] = blob
+    faltan = [p for p in dict.fromkeys(paths) if p not in blobs]
+    if faltan:
+        with traza.tramo("hash"):
+            hashes = hashes_de_ficheros(faltan, guardar)
+            for p in faltan:
+                if p not in hashes:
+                    raise FileNotFoundError(f"no se pudo leer la imagen {p}")
+            cache = embeddings_cacheados(hashes.values())
+        pendientes = list({hashes[p]: p for p in faltan if hashes[p] not in cache}.values())
+        traza.contar("embedding_cache_acierto", len(faltan) - len(pendientes))
+        if pendientes:
+            traza.contar("embedding_cache_fallo", len(pendientes))
+            import funciones_modelo as fm
+            for lote, emb in fm.iter_embeddings(pendientes):
+                pares = [(hashes[p], e.astype(_emb_dtype).tobytes()) for p, e in zip(lote, emb)]
+                if guardar:
+                    guardar_embeddings_cache(pares)
+                cache.update(pares)
+        for p in faltan:
+            blobs[p] = cache[hashes[p]]
+        if not guardar:
+            with _consultas_lock:
+                for p in faltan:
+                    _consultas[firmas[p]] = blobs[p]
+                while len(_consultas) > CONSULTAS_MAX:
+                    _consultas.popitem(last=False)
+    return _decode_blobs([blobs[p] for p in paths]).astype(np.float32)
+
 # ----------------- Embeddings in-memory (lazy) -----------------
+# The store is a preallocated, growable buffer; _emb_matrix is a view of its first N
+# rows. _emb_seq is the high-water mark of chapas_cambios already applied, so
+# reload_embeddings only touches rows inserted, replaced or deleted since then.
+# With USAR_MEMMAP the buffer is a float16 .npy sidecar next to the DB opened with
+# np.memmap (shared by every process through the page cache); otherwise it is a
+# float32 array in RAM. A generation listed in chapas.emb.json is never written
+# again: it is mapped copy-on-write, so a process's deltas stay private, and changes
+# are shared by publishing a new generation file.
+USAR_MEMMAP = True
+SIDECAR_DELTA_MAX = 5000  # change-log entries applied privately before publishing a new generation
+_emb_buf = None         # float32 ndarray or float16 memmap (capacity, D)
+_emb_pos = {}           # chapa id -> row in _emb_matrix
+_emb_seq = 0            # last chapas_cambios.seq applied
+_emb_version = 0        # bumped whenever rows may have moved (cached filter positions expire)
+_sidecar_gen = 0        # generation of the sidecar data file currently mapped
+_sidecar_publicado = False  # _emb_buf maps a published generation (copy-on-write)
+_sidecar_seq = 0        # seq of that generation: the private delta starts after it
+_sidecar_de = None      # absolute _sidecar_base() of the mapped files (DB_FILE may change in-process)
+_CHUNK_FILAS = 4096     # rows fetched/decoded per step during a full load
+
+def _decode_blobs(blobs):
+    # one frombuffer over the concatenated BLOBs instead of one per row
+    return np.frombuffer(b"".join(blobs), dtype=_emb_dtype).reshape(len(blobs), -1)
+
+# ---- sidecar files: chapas.emb.json (seq/n/gen/bd), chapas.emb.ids.npy, chapas.emb.<gen>.npy
+def _sidecar_base():
+    return os.path.splitext(DB_FILE)[0] + ".emb"
+
+def _sidecar_datos(gen):
+    return f"{_sidecar_base()}.{gen}.npy"
+
+def _bloquear(fd, bloquear=True):
+    # non-blocking exclusive lock on the first byte; raises OSError while another process holds it
+    if fcntl is not None:
+        fcntl.flock(fd, (fcntl.LOCK_EX | fcntl.LOCK_NB) if bloquear else fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_NBLCK if bloquear else msvcrt.LK_UNLCK, 1)
+
+@contextmanager
+def _bloqueo_sidecar():
+    # OS lock on a lock file that is never deleted: the OS drops it if the holder dies, so
+    # waiting is safe however long a full load takes and no lock is ever judged stale
+    fd = os.open(_sidecar_base() + ".lock", os.O_CREAT | os.O_RDWR)
+    try:
+        while True:
+            try:
+                _bloquear(fd)
+                break
+            except OSError:
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            _bloquear(fd, False)
+    finally:
+        os.close(fd)
+
+def _leer_meta():
+    try:
+        with open(_sidecar_base() + ".json", encoding="utf-8") as f:
+            meta = json.load(f)
+        if os.path.exists(_sidecar_datos(meta["gen"])):
+            return meta
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+def _identidad_bd(conn):
+    # random token created with the database: the sidecar records it, so files written for
+    # a chapas.db that was deleted and recreated (or copied over) are never mapped again
+    conn.execute("CREATE TABLE IF NOT EXISTS identidad (uuid TEXT NOT NULL)")
+    fila = conn.execute("SELECT uuid FROM identidad").fetchone()
+    if fila is None:
+        conn.execute("BEGIN IMMEDIATE")
+        fila = conn.execute("SELECT uuid FROM identidad").fetchone()
+        if fila is None:
+            fila = (uuid.uuid4().hex,)
+            conn.execute("INSERT INTO identidad (uuid) VALUES (?)", fila)
+        conn.commit()
+    return fila[0]
+
+def _sidecar_de_esta_bd(meta):
+    """
+    True si el sidecar se escribio para esta BD y encaja con su log: seq no
+    posterior al ultimo cambio y, si no hay delta, mismo numero de filas.
+    """
+    conn = _conectar()
+    try:
+        if meta.get("bd") != _identidad_bd(conn):
+            return False
+        seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM chapas_cambios").fetchone()[0]
+        if meta["seq"] > seq:
+            return False
+        if meta["seq"] == seq:
+            n = conn.execute("SELECT COUNT(*) FROM chapas WHERE embedding IS NOT NULL").fetchone()[0]
+            return meta["n"] == n
+        return True
+    finally:
+        conn.close()
+
+def _guardar_sidecar():
+    # ids first, then meta: meta is the commit point other processes look at
+    global _emb_buf, _sidecar_publicado, _sidecar_seq, _sidecar_de
+    base = _sidecar_base()
+    if _sidecar_publicado:
+        # private deltas over a published file: they go to a new generation
+        nuevo = _nuevo_buffer(_emb_buf.shape[0], _emb_buf.shape[1])
+        nuevo[:len(_emb_ids)] = _emb_buf[:len(_emb_ids)]
+        _emb_buf = nuevo
+    _emb_buf.flush()
+    ids = np.fromiter((r[0] for r in _emb_ids), dtype=np.int64, count=len(_emb_ids))
+    with open(base + ".ids.tmp", "wb") as f:
+        np.save(f, ids)
+    os.replace(base + ".ids.tmp", base + ".ids.npy")
+    conn = _conectar()
+    bd = _identidad_bd(conn)
+    conn.close()
+    meta = {"seq": _emb_seq, "n": len(_emb_ids), "gen": _sidecar_gen, "dim": int(_emb_buf.shape[1]), "bd": bd}
+    with open(base + ".json.tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(base + ".json.tmp", base + ".json")
+    # from now on this file is shared: later changes must not touch it
+    _emb_buf = np.load(_sidecar_datos(_sidecar_gen), mmap_mode="c")
+    _sidecar_publicado = True
+    _sidecar_seq = _emb_seq
+    _sidecar_de = os.path.abspath(base)
+    _ajustar_vista()
+    _podar_cambios(_sidecar_seq)
+    # drop older generations; on Windows a file still mapped elsewhere stays until next time
+    for gen in range(_sidecar_gen):
+        try:
+            os.remove(_sidecar_datos(gen))
+        except OSError:
+            pass
+
+def _nuevo_buffer(cap, dim):
+    global _sidecar_gen, _sidecar_publicado
+    if not USAR_MEMMAP:
+        return np.empty((cap, dim), dtype=np.float32)
+    _sidecar_publicado = False
+    # a new generation file instead of resizing in place: other processes keep their mapping
+    meta = _leer_meta()
+    _sidecar_gen = max(_sidecar_gen, meta["gen"] if meta else 0) + 1
+    return np.lib.format.open_memmap(_sidecar_datos(_sidecar_gen), mode="w+",
+                                     dtype=_emb_dtype, shape=(cap, dim))
+
+def _reservar(n_total, dim):
+    # grow the buffer geometrically so appends are amortized O(1)
+    global _emb_buf
+    n = len(_emb_ids)
+    if _emb_buf is not None and _emb_buf.shape[1] == dim:
+        if n_total <= _emb_buf.shape[0]:
+            return
+        nuevo = _nuevo_buffer(max(n_total, 2 * _emb_buf.shape[0]), dim)
+        nuevo[:n] = _emb_buf[:n]
+    else:
+        nuevo = _nuevo_buffer(max(n_total, 1024), dim)
+    _emb_buf = nuevo
+
+def _set_vacio():
+    global _emb_matrix, _emb_ids, _emb_paths, _emb_pos, _emb_buf, _emb_version
+    _emb_version += 1
+    _emb_matrix = np.empty((0,0), dtype=np.float32)
+    _emb_ids = []
+    _emb_paths = []
+    _emb_pos = {}
+    _emb_buf = None
+
+def _ajustar_vista():
+    global _emb_matrix
+    _emb_matrix = _emb_buf[:len(_emb_ids)] if _emb_ids else np.empty((0,0), dtype=np.float32)
+
+def _carga_completa():
+    global _emb_seq
+    _set_vacio()
+    conn = _conectar()
+    cur = conn.cursor()
+    # snapshot: the change-log mark and the rows must come from the same read transaction
+    cur.execute("BEGIN")
+    cur.execute("SELECT COALESCE(MAX(seq), 0) FROM chapas_cambios")
+    seq = cur.fetchone()[0]
+    cur.execute("SELECT COUNT(*) FROM chapas WHERE embedding IS NOT NULL")
+    total = cur.fetchone()[0]
+    cur.execute("SELECT id, marca, tipo, imagen, embedding FROM chapas WHERE embedding IS NOT NULL ORDER BY id")
+    n = 0
+    while True:
+        rows = cur.fetchmany(_CHUNK_FILAS)
+        if not rows:
+            break
+        block = _decode_blobs([r[4] for r in rows])
+        _reservar(total, block.shape[1])
+        _emb_buf[n:n+len(rows)] = block
+        for id_, marca, tipo, imagen, _ in rows:
+            _emb_pos[id_] = n
+            _emb_ids.append((id_, marca, tipo, imagen))
+            _emb_paths.append(imagen)
+            n += 1
+    conn.rollback()
+    conn.close()
+    _emb_seq = seq
+    _ajustar_vista()
+
+def _adjuntar_sidecar(meta):
+    """
+    Abre el sidecar existente sin leer ningun BLOB: la matriz se mapea y de la BD
+    solo se leen las columnas de texto. Las filas cambiadas despues de meta["seq"]
+    las pone al dia _aplicar_cambios.
+    """
+    global _emb_buf, _emb_seq, _sidecar_gen, _sidecar_publicado, _sidecar_seq, _sidecar_de
+    _set_vacio()
+    _sidecar_de = os.path.abspath(_sidecar_base())
+    _sidecar_gen = meta["gen"]
+    # copy-on-write: deltas applied here never reach the file other processes map
+    _emb_buf = np.load(_sidecar_datos(_sidecar_gen), mmap_mode="c")
+    _sidecar_publicado = True
+    ids = np.load(_sidecar_base() + ".ids.npy")[:meta["n"]].tolist()
+    conn = _conectar()
+    cur = conn.cursor()
+    cur.execute("SELECT id, marca, tipo, imagen FROM chapas WHERE embedding IS NOT NULL")
+    filas = {r[0]: r for r in cur.fetchall()}
+    conn.close()
+    for pos, id_ in enumerate(ids):
+        # rows deleted since the sidecar was written keep a placeholder until the delta drops them
+        row = filas.get(id_, (id_, None, None, None))
+        _emb_pos[id_] = pos
+        _emb_ids.append(row)
+        _emb_paths.append(row[3])
+    _emb_seq = _sidecar_seq = meta["seq"]
+    _ajustar_vista()
+
+def _quitar_fila(id_):
+    # swap-remove: move the last row into the hole so the matrix stays contiguous
+    pos = _emb_pos.pop(id_)
+    last = len(_emb_ids) - 1
+    if pos != last:
+        _emb_buf[pos] = _emb_buf[last]
+        _emb_ids[pos] = _emb_ids[last]
+        _emb_paths[pos] = _emb_paths[last]
+        _emb_pos[_emb_ids[pos][0]] = pos
+    _emb_ids.pop()
+    _emb_paths.pop()
+
+def _aplicar_cambios():
+    """
+    Aplica al buffer solo las filas cambiadas desde _emb_seq.
+    Retorna la lista de ids afectados, o None si el log ya se podo por
+    encima de _emb_seq y hay que recargar el buffer.
+    """
+    global _emb_seq, _emb_version
+    conn = _conectar()
+    cur = conn.cursor()
+    cur.execute("BEGIN")
+    if not _log_cubre(conn, _emb_seq):
+        conn.rollback()
+        conn.close()
+        return None
+    cur.execute("SELECT DISTINCT chapa_id FROM chapas_cambios WHERE seq > ?", (_emb_seq,))
+    cambiados = [r[0] for r in cur.fetchall()]
+    if cambiados:
+        _emb_version += 1
+    cur.execute("SELECT COALESCE(MAX(seq), 0) FROM chapas_cambios")
+    seq = cur.fetchone()[0]
+    filas = {}
+    for s in range(0, len(cambiados), 500):
+        lote = cambiados[s:s+500]
+        cur.execute(f"SELECT id, marca, tipo, imagen, embedding FROM chapas WHERE embedding IS NOT NULL "
+                    f"AND id IN ({','.join('?' * len(lote))})", lote)
+        for r in cur.fetchall():
+            filas[r[0]] = r
+    conn.rollback()
+    conn.close()
+
+    for id_ in cambiados:
+        if id_ in _emb_pos and id_ not in filas:
+            _quitar_fila(id_)
+    nuevos = [r for r in filas.values() if r[0] not in _emb_pos]
+    if filas:
+        block = _decode_blobs([r[4] for r in filas.values()])
+        _reservar(len(_emb_ids) + len(nuevos), block.shape[1])
+        for r, vec in zip(filas.values(), block):
+            id_, marca, tipo, imagen, _ = r
+            pos = _emb_pos.get(id_)
+            if pos is None:
+                pos = len(_emb_ids)
+                _emb_pos[id_] = pos
+                _emb_ids.append((id_, marca, tipo, imagen))
+                _emb_paths.append(imagen)
+            else:
+                _emb_ids[pos] = (id_, marca, tipo, imagen)
+                _emb_paths[pos] = imagen
+            _emb_buf[pos] = vec
+    _ajustar_vista()
+    _emb_seq = seq
+    return cambiados
+
+def _adoptar_sidecar(meta):
+    if not _sidecar_de_esta_bd(meta):
+        _carga_completa()  # left by a replaced database or ahead of its log: rebuild
+        return
+    try:
+        _adjuntar_sidecar(meta)
+    except (OSError, ValueError):
+        _carga_completa()  # unreadable sidecar: rebuild it from the BLOBs
+    if _aplicar_cambios() is None:
+        _carga_completa()
+
+def _sincronizar(completo=False):
+    """
+    Pone el buffer al dia con la BD y devuelve los ids cambiados, o None si
+    hubo que reconstruir/readjuntar el buffer entero.
+    """
+    if not USAR_MEMMAP:
+        if completo or _emb_buf is None:
+            _carga_completa()
+            return None
+        cambiados = _aplicar_cambios()
+        if cambiados is None:
+            _carga_completa()  # the log was pruned past our mark
+        return cambiados
+    with _bloqueo_sidecar():
+        meta = _leer_meta()
+        if completo or meta is None:
+            _carga_completa()
+            cambiados = None
+        elif _emb_buf is None or _sidecar_de != os.path.abspath(_sidecar_base()):
+            # first open (or another DB): map the published generation and catch up from its seq
+            _adoptar_sidecar(meta)
+            cambiados = None
+        else:
+            # our mapping stays valid even if another process published a newer generation
+            cambiados = _aplicar_cambios()
+            if cambiados is None:
+                # that process pruned the log past our mark: switch to its generation
+                _adoptar_sidecar(meta)
+        # publish a fresh buffer (full load, growth) or a long private delta; small deltas
+        # stay private and later readers replay them from the change log
+        if _emb_buf is not None and (not _sidecar_publicado or _emb_seq - _sidecar_seq > SIDECAR_DELTA_MAX):
+            _guardar_sidecar()
+    return cambiados
+
 def _load_embeddings_to_ram():
-    global _EMBEDDINGS_LOADED, _emb_matrix, _emb_ids, _emb_paths
+    global _EMBEDDINGS_LOADED, _indice
     if _EMBEDDINGS_LOADED:
         return
-    rows = obtener_todas_chapas()
-    if not rows:
-        _emb_matrix = np.empty((0,0), dtype=np.float32)
-        _emb_ids = []
-        _emb_paths = []
+    with _emb_lock:
+        if _EMBEDDINGS_LOADED:
+            return
+        _sincronizar()
+        _indice = _construir_indice()
         _EMBEDDINGS_LOADED = True
+
+def _construir_indice():
+    return iv.construir_indice(INDICE_TIPO, [r[0] for r in _emb_ids], _emb_matrix,
+                               DB_FILE, nprobe=NPROBE)
+
+def reload_embeddings(completo=False):
+    """
+    Sincroniza la matriz con la BD. Por defecto aplica solo el delta registrado
+    en chapas_cambios; completo=True fuerza la recarga total desde los BLOBs.
+    """
+    global _indice
+    if not _EMBEDDINGS_LOADED:
+        _load_embeddings_to_ram()
         return
-    embs = []
-    ids_list = []
-    paths = []
-    for r in rows:
-        id_, marca, tipo, imagen, blob = r
-        ids_list.append((id_, marca, tipo, imagen))
-        paths.append(imagen)
-        if blob is None:
-            embs.append(None)
-        else:
-            arr = np.frombuffer(blob, dtype=np.float16).astype(np.float32)
-            embs.append(arr)
-    # Filter only non-None embeddings
-    valid = [e for e in embs if e is not None]
-    if valid:
-        _emb_matrix = np.vstack(valid)  # float32
-    else:
-        _emb_matrix = np.empty((0,0), dtype=np.float32)
-    # We keep mapping of ids to embeddings by index: we'll rebuild index list of rows that have embedding
-    # Build a parallel list of rows that correspond to rows with embeddings
-    rows_with_emb = []
-    paths_with_emb = []
-    idx = 0
-    for i, e in enumerate(embs):
-        if e is not None:
-            rows_with_emb.append(ids_list[i])
-            paths_with_emb.append(paths[i])
-            idx += 1
-    _emb_ids = rows_with_emb
-    _emb_paths = paths_with_emb
-    _EMBEDDINGS_LOADED = True
-
-def reload_embeddings():
-    global _EMBEDDINGS_LOADED
-    _EMBEDDINGS_LOADED = False
+    with _emb_lock:
+        cambiados = _sincronizar(completo)
+        ids = [r[0] for r in _emb_ids]
+        if cambiados is None or (INDICE_TIPO == "auto" and _indice.tipo == "flat"
+                                 and len(_emb_ids) >= iv.IVF_MIN_FILAS):
+            # buffer rebuilt, or the collection just crossed the IVF threshold
+            _indice = _construir_indice()
+        elif cambiados:
+            _indice.olvidar(cambiados)
+            _indice.enlazar(ids, _emb_matrix)
+            _indice.guardar(iv.ruta_indice(DB_FILE, _indice.tipo))
+
+def reconstruir_indice(tipo=None):
+    """
+    Fuerza un reentrenamiento del indice (p.ej. tras una importacion grande).
+    """
+    global INDICE_TIPO, _indice
+    if tipo is not None:
+        INDICE_TIPO = tipo
+    for t in iv._CLASES:
+        path = iv.ruta_indice(DB_FILE, t)
+        if os.path.exists(path):
+            os.remove(path)
+    if not _EMBEDDINGS_LOADED:
+        _load_embeddings_to_ram()  # builds the index from scratch
+        return
+    with _emb_lock:
+        reload_embeddings()
+        _indice = _construir_indice()
+
+def medir_recall_indice(tipo=None, n_consultas=200, top_k=8, ruido=0.05, seed=0):
+    """
+    Mide sobre la coleccion real el recall@k y la latencia del indice `tipo`
+    (por defecto INDICE_TIPO) frente a la busqueda exacta. Las consultas son
+    embeddings de la coleccion con algo de ruido, como fotos nuevas de chapas
+    ya catalogadas. Retorna (recall, ms_indice, ms_exacto).
+    """
     _load_embeddings_to_ram()
+    if _emb_matrix.size == 0:
+        return None
+    idx = _indice if tipo is None else iv.construir_indice(tipo, [r[0] for r in _emb_ids], _emb_matrix,
+                                                           DB_FILE, nprobe=NPROBE)
+    rng = np.random.default_rng(seed)
+    sel = rng.choice(_emb_matrix.shape[0], min(n_consultas, _emb_matrix.shape[0]), replace=False)
+    Q = np.asarray(_emb_matrix[np.sort(sel)], dtype=np.float32)
+    Q += ruido * rng.standard_normal(Q.shape).astype(np.float32) / np.sqrt(Q.shape[1])
+    Q /= np.linalg.norm(Q, axis=1, keepdims=True)
+    return iv.medir_recall(idx, _emb_matrix, Q, top_k)
 
 # ----------------- Search utilities -----------------
-def buscar_por_marca(texto):
-    conn = sqlite3.connect(DB_FILE)
+_hay_fts = None
+SIMILITUD_TYPO = 0.6    # minimum SequenceMatcher ratio for the typo-tolerant fallback
+
+def _fts_disponible(conn):
+    global _hay_fts
+    if _hay_fts is None:
+        _hay_fts = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'chapas_fts'").fetchone() is not None
+    return _hay_fts
+
+def _actualizar_fts(conn):
+    # SQLite < 3.45 (no FTS triggers): index the rows changed since the last catch-up
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'chapas_fts_estado'").fetchone() is None:
+        return
+    desde = conn.execute("SELECT seq FROM chapas_fts_estado").fetchone()[0]
+    if conn.execute("SELECT 1 FROM chapas_cambios WHERE seq > ? LIMIT 1", (desde,)).fetchone() is None:
+        return
+    conn.execute("BEGIN IMMEDIATE")  # one catch-up at a time; reread the mark inside the transaction
+    try:
+        desde = conn.execute("SELECT seq FROM chapas_fts_estado").fetchone()[0]
+        hasta = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM chapas_cambios").fetchone()[0]
+        ids = [r[0] for r in conn.execute("SELECT DISTINCT chapa_id FROM chapas_cambios WHERE seq > ? AND seq <= ?",
+                                          (desde, hasta))]
+        for s in range(0, len(ids), 500):
+            lote = ids[s:s+500]
+            marcas = ",".join("?" * len(lote))
+            conn.execute(f"DELETE FROM chapas_fts WHERE rowid IN ({marcas})", lote)
+            conn.execute(f"INSERT INTO chapas_fts (rowid, marca, tipo) "
+                         f"SELECT id, sin_acentos(marca), sin_acentos(tipo) FROM chapas WHERE id IN ({marcas})", lote)
+        conn.execute("UPDATE chapas_fts_estado SET seq = ?", (hasta,))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+def _fts_frase(texto):
+    # FTS5 string literal: the whole input is one phrase (substring match with trigram)
+    return '"' + texto.replace('"', '""') + '"'
+
+def buscar_por_marca(texto, limite=None, tolerante=True):
+    """
+    Busca por marca sin distinguir mayusculas ni acentos: subcadena/prefijo con el
+    indice FTS5 trigram, primero las marcas que empiezan por el texto y despues por
+    relevancia (bm25). Si no hay resultados y tolerante=True, prueba coincidencias
+    aproximadas (errores de tecleo).
+    """
+    q = sin_acentos(texto.strip())
+    if not q:
+        return []
+    lim = -1 if limite is None else int(limite)
+    conn = _conectar()
     cur = conn.cursor()
-    cur.execute("SELECT id, marca, tipo, imagen FROM chapas WHERE LOWER(marca) LIKE ?", (f"%{texto.lower()}%",))
+    fts = _fts_disponible(conn)
+    if fts:
+        _actualizar_fts(conn)
+    if not fts:
+        cur.execute("SELECT id, marca, tipo, imagen FROM chapas WHERE sin_acentos(marca) LIKE ? LIMIT ?",
+                    (f"%{q}%", lim))
+    elif len(q) >= 3:
+        cur.execute("""
+            SELECT c.id, c.marca, c.tipo, c.imagen
+            FROM chapas_fts f JOIN chapas c ON c.id = f.rowid
+            WHERE chapas_fts MATCH ?
+            ORDER BY sin_acentos(c.marca) LIKE ? DESC, f.rank
+            LIMIT ?
+        """, ("marca : " + _fts_frase(q), f"{q}%", lim))
+    else:
+        # 1-2 characters are shorter than a trigram: scan the small FTS text instead
+        cur.execute("""
+            SELECT c.id, c.marca, c.tipo, c.imagen
+            FROM chapas_fts f JOIN chapas c ON c.id = f.rowid
+            WHERE sin_acentos(f.marca) LIKE ?
+            ORDER BY sin_acentos(f.marca) LIKE ? DESC, c.marca
+            LIMIT ?
+        """, (f"%{q}%", f"{q}%", lim))
     datos = cur.fetchall()
+    if not datos and tolerante and len(q) >= 4 and fts:
+        datos = _buscar_marca_aproximada(cur, q, limite)
     conn.close()
     return datos
 
-def buscar_por_imagen(path_query, top_k=8):
+def _buscar_marca_aproximada(cur, q, limite, candidatos=200):
+    # candidates share at least one trigram with the query, best bm25 first;
+    # then re-rank by edit similarity against the brand (or its best-matching window)
+    trigramas = {q[i:i+3] for i in range(len(q) - 2)}
+    cur.execute("""
+        SELECT c.id, c.marca, c.tipo, c.imagen
+        FROM chapas_fts f JOIN chapas c ON c.id = f.rowid
+        WHERE chapas_fts MATCH ?
+        ORDER BY f.rank
+        LIMIT ?
+    """, ("marca : (" + " OR ".join(_fts_frase(t) for t in trigramas) + ")", candidatos))
+    puntuados = []
+    for fila in cur.fetchall():
+        m = sin_acentos(fila[1] or "")
+        ventanas = [m[i:i+len(q)] for i in range(max(1, len(m) - len(q) + 1))]
+        ratio = max(SequenceMatcher(None, q, v).ratio() for v in ventanas)
+        if ratio >= SIMILITUD_TYPO:
+            puntuados.append((ratio, fila))
+    puntuados.sort(key=lambda x: -x[0])
+    return [f for _, f in puntuados[:limite]]
+
+# ----------------- Hybrid search: metadata filters -----------------
+_filtros = {}           # (marca, tipo) -> (_emb_version, sorted matrix positions)
+
+def _hay_filtro(marca, tipo):
+    return bool((marca or "").strip() or (tipo or "").strip())
+
+def _ids_filtro(marca, tipo):
+    # ids with an embedding whose brand contains `marca` (FTS index, as buscar_por_marca)
+    # and whose type is `tipo` (chapas_tipo index); no typo tolerance here
+    conds, params = ["embedding IS NOT NULL"], []
+    conn = _conectar()
+    q = sin_acentos((marca or "").strip())
+    if q and _fts_disponible(conn) and len(q) >= 3:
+        _actualizar_fts(conn)
+        conds.append("id IN (SELECT rowid FROM chapas_fts WHERE chapas_fts MATCH ?)")
+        params.append("marca : " + _fts_frase(q))
+    elif q:
+        conds.append("sin_acentos(marca) LIKE ?")
+        params.append(f"%{q}%")
+    if (tipo or "").strip():
+        conds.append("tipo = ? COLLATE NOCASE")
+        params.append(tipo.strip())
+    ids = [r[0] for r in conn.execute(f"SELECT id FROM chapas WHERE {' AND '.join(conds)}", params)]
+    conn.close()
+    return ids
+
+def _posiciones_filtro(marca, tipo):
+    """
+    Filas de _emb_matrix que cumplen el filtro (int64 ordenadas), cacheadas
+    hasta que la matriz cambie.
+    """
+    clave = (sin_acentos((marca or "").strip()), (tipo or "").strip().lower())
+    hit = _filtros.get(clave)
+    if hit is not None and hit[0] == _emb_version:
+        return hit[1]
+    with traza.tramo("filtro"):
+        ids = _ids_filtro(marca, tipo)
+        pos = np.fromiter((_emb_pos.get(i, -1) for i in ids), dtype=np.int64, count=len(ids))
+        pos = np.sort(pos[pos >= 0])
+    if len(_filtros) >= 64:
+        _filtros.clear()
+    _filtros[clave] = (_emb_version, pos)
+    return pos
+
+def tipos_distintos():
+    conn = _conectar()
+    tipos = [r[0] for r in conn.execute(
+        "SELECT DISTINCT tipo FROM chapas WHERE tipo IS NOT NULL ORDER BY tipo COLLATE NOCASE")]
+    conn.close()
+    return tipos
+
+def buscar_por_imagen(path_query, top_k=8, nprobe=None, marca=None, tipo=None):
     """
     Retorna lista [(row_tuple, similarity_score), ...], score in [0,1], sorted desc
+    nprobe: listas IVF a recorrer (mas = mas recall, mas latencia); ignorado en flat.
+    marca/tipo: restringen la busqueda a las chapas cuya marca contiene `marca`
+    y cuyo tipo es `tipo` (sin distinguir mayusculas); solo se puntuan esas filas.
     """
     # lazy load embeddings
     _load_embeddings_to_ram()
-    import funciones_modelo as fm
     if _emb_matrix.size == 0:
         # No embeddings in DB yet: fallback to compute embedding and return empty
-        emb_q = fm.imagen_a_embedding(path_query).astype(np.float32)
+        emb_q = embedding_de_imagen(path_query)
         return []
-    # compute query embedding
-    emb_q = fm.imagen_a_embedding(path_query).astype(np.float32)
+    # compute query embedding (repeated query images come from the content-hash cache)
+    traza.contar("busquedas_imagen")
+    emb_q = embedding_de_imagen(path_query)
     # emb_q normalized in model function
-    # compute dot product with matrix (vectorized). _emb_matrix is float32 shape (N,D)
-    sims = (_emb_matrix @ emb_q)  # because vectors are L2-normalized -> dot = cos similarity
-    # clamp
-    sims = sims.astype(np.float32)
-    # get top indices
-    idxs = np.argsort(sims)[::-1][:top_k]
-    results = []
-    for i in idxs:
-        row = _emb_ids[i]  # (id, marca, tipo, imagen)
-        score = float(sims[i])
-        results.append((row, score))
+    # vectors are L2-normalized -> dot = cos similarity; the index decides which rows to score
+    with _emb_lock:
+        if _hay_filtro(marca, tipo):
+            idxs, sims = iv.buscar_filtrado(_indice, _emb_matrix, emb_q, top_k,
+                                            _posiciones_filtro(marca, tipo), nprobe=nprobe)
+        else:
+            idxs, sims = _indice.buscar(_emb_matrix, emb_q, top_k, nprobe=nprobe)
+        results = []
+        for i, score in zip(idxs, sims):
+            row = _emb_ids[i]  # (id, marca, tipo, imagen)
+            results.append((row, float(score)))
     return results
 
+def buscar_por_imagenes(paths, top_k=8, nprobe=None, marca=None, tipo=None):
+    """
+    Busqueda por lotes: retorna una lista por consulta, cada una como en
+    buscar_por_imagen. Las consultas se embeben juntas y se puntuan con un
+    producto matriz-matriz por bloques.
+    """
+    paths = list(paths)
+    _load_embeddings_to_ram()
+    return buscar_por_embeddings(embeddings_de_imagenes(paths), top_k, nprobe, marca, tipo)
+
+def buscar_por_embeddings(Q, top_k=8, nprobe=None, marca=None, tipo=None):
+    """
+    Como buscar_por_imagenes a partir de embeddings ya calculados (N, D)
+    L2-normalizados, p.ej. fotogramas de video embebidos fuera de la cache.
+    """
+    _load_embeddings_to_ram()
+    if _emb_matrix.size == 0 or len(Q) == 0:
+        return [[] for _ in range(len(Q))]
+    with _emb_lock:
+        if _hay_filtro(marca, tipo):
+            posiciones = _posiciones_filtro(marca, tipo)
+            res = [iv.buscar_filtrado(_indice, _emb_matrix, q, top_k, posiciones, nprobe=nprobe) for q in Q]
+            return [[(_emb_ids[i], float(sc)) for i, sc in zip(p, s)] for p, s in res]
+        pos, sims = _indice.buscar_lote(_emb_matrix, Q, top_k, nprobe=nprobe)
+        return [[(_emb_ids[i], float(sc)) for i, sc in zip(fila_p, fila_s) if i >= 0]
+                for fila_p, fila_s in zip(pos, sims)]
+
+def calentar():
+    """
+    Deja listo todo lo que la primera busqueda por imagen tendria que cargar:
+    matriz de embeddings e indice, backend del modelo y una inferencia de prueba.
+    Pensado para llamarse desde un hilo en segundo plano al arrancar.
+    """
+    _load_embeddings_to_ram()
+    import funciones_modelo as fm
+    fm.calentar()
+
+def buscar_duplicados(umbral=0.95):
+    """
+    Pares de chapas de la coleccion con similitud >= umbral:
+    [(row_a, row_b, similarity_score), ...] ordenados desc.
+    """
+    _load_embeddings_to_ram()
+    if _emb_matrix.size == 0:
+        return []
+    pares = [(_emb_ids[i], _emb_ids[j], s) for i, j, s in iv.pares_similares(_emb_matrix, umbral)]
+    pares.sort(key=lambda p: -p[2])
+    return pares
+
 # ----------------- Export to Excel (timestamped) -----------------
 def exportar_a_excel_version():
-    os.makedirs("export_excel", exist_ok=True)
-    fecha_hora = datetime.now().strftime("%Y%m%d_%H%M%S")
-    archivo = os.path.join("export_excel", f"chapas_{fecha_hora}.xlsx")
-    conn = sqlite3.connect(DB_FILE)
-    df = pd.read_sql_query("SELECT id, marca, tipo, imagen FROM chapas ORDER BY id", conn)
-    conn.close()
-    df.to_excel(archivo, index=False)
-    return archivo
+    # streaming writer in exportar.py; also moves the mark used by `exportar.py --cambios`
+    import exportar
+    return exportar.exportar("xlsx", "export_excel")[0]
@@ -1,71 +1,364 @@
 # funciones_modelo.py
-import torch
-from torchvision import transforms, models
-from torchvision.models import MobileNet_V3_Small_Weights
+import copy
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from PIL import Image
 import numpy as np
+import carga_imagenes
+import traza
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
+# Inference backend:
+#   "eager"       torchvision MobileNetV3-Small, features + avg pool (original path)
+#   "torchscript" features-only module traced, frozen and saved to MODELS_DIR
+#   "onnx"        same graph exported to ONNX and run with onnxruntime (no torch import
+#                 once the .onnx file exists)
+#   "onnx-int8"   ONNX graph with dynamic int8 quantization (Conv -> ConvInteger); 4x
+#                 smaller, speed depends on the CPU's int8 support, and embeddings drift
+#                 slightly from the stored fp32 ones (cos ~0.999) -- measure before using
+#   "auto"        onnx if onnxruntime is installed, otherwise torchscript
+BACKEND = "auto"
+MODELS_DIR = "modelos"
+HILOS = None            # intra-op threads (None = all cores)
 
-# Lazy model holder
+# Lazy model holders
 _model = None
-_transform = transforms.Compose([
-    transforms.Resize(256),
-    transforms.CenterCrop(224),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485,0.456,0.406], std=[0.229,0.224,0.225])
-])
+_backend = None
+_device = None
+_backend_lock = threading.Lock()  # warm-up thread vs. first search
+
+# Preprocessing, numpy/PIL only (same as torchvision Resize(256) + CenterCrop(224) +
+# ToTensor + Normalize on a PIL image), so decode workers and the ONNX path never import torch
+_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32).reshape(3, 1, 1)
+_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32).reshape(3, 1, 1)
+
+# JPEGs are decoded at the smallest DCT scale whose short side is still >= this:
+# 2x the Resize(256) side, the same margin PIL's thumbnail() keeps (reducing_gap=2).
+# None decodes at full resolution.
+LADO_DECODIFICADO = 512
+# Part of the embedding cache key (funciones.embeddings_cacheados): bump it whenever decoding or
+# the transform changes the vectors, so cached embeddings are recomputed. 2: reduced-scale
+# JPEG decoding and EXIF orientation.
+VERSION_PREPROCESO = 2
+COSENO_DECODIFICACION = 0.995  # comprobar_decodificacion: minimum cosine, reduced vs full decode
+
+@traza.medido("decodificar")
+def _decodificar(path, completa=False):
+    lado = None if completa else LADO_DECODIFICADO
+    return carga_imagenes.abrir(path, (lado, lado) if lado else None)
+
+@traza.medido("transformar")
+def _transform(img, size=256, crop=224):
+    """
+    PIL RGB -> float32 (3, 224, 224) normalizado.
+    """
+    w, h = img.size
+    if w <= h:
+        nw, nh = size, int(size * h / w)
+    else:
+        nw, nh = int(size * w / h), size
+    img = img.resize((nw, nh), Image.BILINEAR)
+    top = int(round((nh - crop) / 2.0))
+    left = int(round((nw - crop) / 2.0))
+    img = img.crop((left, top, left + crop, top + crop))
+    x = np.asarray(img, dtype=np.float32).transpose(2, 0, 1) / 255.0
+    return (x - _MEAN) / _STD
+
+def _torch():
+    import torch
+    if HILOS:
+        torch.set_num_threads(HILOS)
+    return torch
+
+def _get_device():
+    global _device
+    if _device is None:
+        _device = "cuda" if _torch().cuda.is_available() else "cpu"
+    return _device
 
 def _load_model():
     global _model
     if _model is not None:
         return _model
+    from torchvision import models
+    from torchvision.models import MobileNet_V3_Small_Weights
     # Loads MobileNetV3 Small with recommended weights
     weights = MobileNet_V3_Small_Weights.DEFAULT
-    base = models.mobilenet_v3_small(weights=weights).to(device)
+    base = models.mobilenet_v3_small(weights=weights).to(_get_device())
     base.eval()
     _model = base
     return _model
 
+def _features_module():
+    # features + global avg pool only: the classifier head is never needed
+    torch = _torch()
+
+    class _Features(torch.nn.Module):
+        def __init__(self, features):
+            super().__init__()
+            self.features = features
+
+        def forward(self, x):
+            return torch.flatten(torch.nn.functional.adaptive_avg_pool2d(self.features(x), 1), 1)
+
+    return _Features(_load_model().features).eval()
+
+def _ruta_modelo(nombre):
+    os.makedirs(MODELS_DIR, exist_ok=True)
+    return os.path.join(MODELS_DIR, nombre)
+
+@contextmanager
+def _escritura_atomica(path):
+    # exported under a temporary name in the same folder and renamed into place: a crash or
+    # two processes exporting at once never leave a truncated model at `path`
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+class _BackendTorch:
+    def __init__(self, script):
+        torch = _torch()
+        self.torch = torch
+        self.device = _get_device()
+        if not script:
+            self.m = _features_module()
+            return
+        path = _ruta_modelo(f"mobilenet_v3_small_features_{self.device}.pt")
+        if os.path.exists(path):
+            # loading a saved TorchScript module does not import torchvision
+            self.m = torch.jit.load(path, map_location=self.device)
+        else:
+            ejemplo = torch.zeros(1, 3, 224, 224, device=self.device)
+            with torch.inference_mode():
+                traced = torch.jit.trace(_features_module(), ejemplo)
+            traced = torch.jit.freeze(traced)
+            with _escritura_atomica(path) as tmp:
+                traced.save(tmp)
+            self.m = traced
+        self.m = torch.jit.optimize_for_inference(self.m)
+
+    def __call__(self, x):
+        with self.torch.inference_mode():
+            return self.m(self.torch.from_numpy(x).to(self.device)).cpu().numpy()
+
+class _BackendONNX:
+    def __init__(self, int8):
+        import onnxruntime as ort
+        path = _ruta_modelo("mobilenet_v3_small_features.onnx")
+        if not os.path.exists(path):
+            torch = _torch()
+            # a copy: moving the shared module would take the torch backend off the GPU
+            m = copy.deepcopy(_features_module()).to("cpu")
+            kw = dict(opset_version=17, input_names=["x"], output_names=["emb"],
+                      dynamic_axes={"x": {0: "n"}, "emb": {0: "n"}})
+            with _escritura_atomica(path) as tmp:
+                try:
+                    # TorchScript-based exporter: no onnxscript dependency on torch >= 2.5
+                    torch.onnx.export(m, torch.zeros(1, 3, 224, 224), tmp, dynamo=False, **kw)
+                except TypeError:
+                    torch.onnx.export(m, torch.zeros(1, 3, 224, 224), tmp, **kw)
+        if int8:
+            q_path = _ruta_modelo("mobilenet_v3_small_features.int8.onnx")
+            if not os.path.exists(q_path):
+                from onnxruntime.quantization import quantize_dynamic, QuantType
+                with _escritura_atomica(q_path) as tmp:
+                    quantize_dynamic(path, tmp, weight_type=QuantType.QUInt8)
+            path = q_path
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = HILOS or os.cpu_count() or 1
+        opts.inter_op_num_threads = 1
+        opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.sess = ort.InferenceSession(path, opts, providers=["CPUExecutionProvider"])
+
+    def __call__(self, x):
+        return self.sess.run(None, {"x": x})[0]
+
+def _crear_backend(nombre):
+    if nombre == "eager":
+        return _BackendTorch(script=False)
+    if nombre == "torchscript":
+        return _BackendTorch(script=True)
+    if nombre in ("onnx", "onnx-int8"):
+        return _BackendONNX(int8=(nombre == "onnx-int8"))
+    raise ValueError(f"backend desconocido: {nombre}")
+
+def _get_backend():
+    global _backend
+    if _backend is not None:
+        return _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = _elegir_backend()
+    return _backend
+
+def _elegir_backend():
+    if BACKEND == "auto":
+        try:
+            import onnxruntime  # noqa: F401
+            candidatos = ["onnx", "torchscript", "eager"]
+        except ImportError:
+            candidatos = ["torchscript", "eager"]
+    else:
+        candidatos = [BACKEND]
+    for i, nombre in enumerate(candidatos):
+        try:
+            return _crear_backend(nombre)
+        except Exception as e:
+            if i == len(candidatos) - 1:
+                raise
+            print(f"Backend {nombre} no disponible ({e}); probando {candidatos[i+1]}")
+
+def _forward(x):
+    # x: float32 (N,C,H,W) numpy -> pooled features -> L2 norm per row
+    backend = _get_backend()
+    with traza.tramo("forward", n=len(x)):
+        arr = np.asarray(backend(np.ascontiguousarray(x, dtype=np.float32)), dtype=np.float32)
+    norms = np.linalg.norm(arr, axis=1, keepdims=True)
+    norms[norms==0] = 1.0
+    arr = arr / norms
+    return arr.astype(np.float32)
+
+def calentar():
+    """
+    Carga el backend y ejecuta una inferencia con una imagen vacia, para que
+    la primera consulta real no pague la inicializacion.
+    """
+    _forward(np.zeros((1, 3, 224, 224), dtype=np.float32))
+
 def imagen_a_embedding(path):
     """
     Devuelve embedding L2-normalizado como numpy float32 vector (1d).
     """
-    model = _load_model()
-    img = Image.open(path).convert("RGB")
-    x = _transform(img).unsqueeze(0).to(device)  # 1,C,H,W
-    with torch.no_grad():
-        # forward through features, then global avg pool
-        features = model.features(x)  # N, C, H, W
-        pooled = torch.nn.functional.adaptive_avg_pool2d(features, 1).squeeze(-1).squeeze(-1)  # N, C
-        emb = pooled.cpu().numpy().reshape(-1)
-    # normalize
-    norm = np.linalg.norm(emb)
-    if norm > 0:
-        emb = emb / norm
-    return emb.astype(np.float32)
+    return _forward(_transform(_decodificar(path))[None])[0]
+
+def medir_decodificacion(paths):
+    """
+    Compara, imagen a imagen, la decodificacion reducida con la completa: coseno
+    entre ambos embeddings, tiempo de decodificar + transformar y MB del bitmap
+    decodificado (lo que ocupa la imagen en memoria). Retorna un dict con
+    coseno_min, coseno_medio y las medias de ms_* y mb_* de cada variante.
+    """
+    cosenos, tiempos, megas = [], {False: [], True: []}, {False: [], True: []}
+    for path in paths:
+        embs = {}
+        for completa in (False, True):
+            t0 = time.perf_counter()
+            img = _decodificar(path, completa)
+            x = _transform(img)
+            tiempos[completa].append(time.perf_counter() - t0)
+            megas[completa].append(img.width * img.height * len(img.getbands()) / 1e6)
+            embs[completa] = _forward(x[None])[0]
+        cosenos.append(float(np.dot(embs[False], embs[True])))
+    if not cosenos:
+        return None
+    return {"imagenes": len(cosenos), "coseno_min": min(cosenos), "coseno_medio": float(np.mean(cosenos)),
+            "ms_completa": 1000 * float(np.mean(tiempos[True])), "ms_reducida": 1000 * float(np.mean(tiempos[False])),
+            "mb_completa": float(np.mean(megas[True])), "mb_reducida": float(np.mean(megas[False]))}
+
+def comprobar_decodificacion(coseno_min=COSENO_DECODIFICACION, tam=(4000, 3000)):
+    """
+    Comprobacion sin coleccion ni pesos: genera fotos JPEG sinteticas de `tam`
+    (derecha y girada por EXIF) y compara la entrada del modelo (_transform)
+    con decodificacion reducida y completa. Retorna la lista de fallos.
+    """
+    fallos = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for giro in (1, 6):
+            path = os.path.join(tmp, f"foto_{giro}.jpg")
+            carga_imagenes._jpeg_foto(path, giro, tam)
+            reducida, completa = _decodificar(path), _decodificar(path, completa=True)
+            if reducida.width * reducida.height >= completa.width * completa.height:
+                fallos.append(f"foto {giro}: la decodificacion no se redujo ({reducida.size})")
+                continue
+            a, b = _transform(reducida).ravel(), _transform(completa).ravel()
+            coseno = float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b)))
+            if coseno < coseno_min:
+                fallos.append(f"foto {giro}: coseno {coseno:.5f} con la completa (minimo {coseno_min})")
+    return fallos
 
 def batch_imagenes_a_embeddings(paths):
     """
-    Procesa una lista de rutas en batches y devuelve matriz (N, D) float32.
+    Procesa una lista de rutas (o imagenes PIL ya decodificadas, p.ej.
+    fotogramas de video) en batches y devuelve matriz (N, D) float32.
     """
-    model = _load_model()
-    batch_tensors = []
-    device_local = device
-    import torch
     imgs = []
     for p in paths:
-        img = Image.open(p).convert("RGB")
-        imgs.append(_transform(img))
+        imgs.append(_transform(p if isinstance(p, Image.Image) else _decodificar(p)))
     if not imgs:
         return np.empty((0,0), dtype=np.float32)
-    tensor = torch.stack(imgs).to(device_local)  # N,C,H,W
-    with torch.no_grad():
-        features = model.features(tensor)
-        pooled = torch.nn.functional.adaptive_avg_pool2d(features, 1).squeeze(-1).squeeze(-1)
-        arr = pooled.cpu().numpy()
-    # normalize per-row
-    norms = np.linalg.norm(arr, axis=1, keepdims=True)
-    norms[norms==0] = 1.0
-    arr = arr / norms
-    return arr.astype(np.float32)
+    return _forward(np.stack(imgs))
+
+# ----------------- Streaming pipeline -----------------
+# Decode + _transform run in worker processes while the main process runs the
+# model, so PIL work overlaps with inference. Only a bounded number of batches
+# is in flight, so memory does not grow with the number of paths.
+LOTE_MIN = 4
+LOTE_MAX = 256
+LOTE_INICIAL = 16
+_OBJETIVO_LOTE_S = 0.5   # adaptive batch size aims for ~this forward time per batch
+
+def _preprocesar_lote(paths):
+    # runs in a worker (numpy/PIL only): returns float32 array (N,C,H,W)
+    return np.stack([_transform(_decodificar(p)) for p in paths])
+
+def _preprocesar_lote_trazado(paths):
+    # pool entry point: a worker never runs atexit, so its spans travel back with the batch
+    return _preprocesar_lote(paths), traza.extraer()
+
+def _siguiente_lote(bs, n_imgs, elapsed):
+    # scale towards the target forward time, staying on powers of two
+    if elapsed <= 0:
+        return bs
+    ideal = _OBJETIVO_LOTE_S * n_imgs / elapsed
+    nuevo = bs
+    while nuevo * 2 <= min(ideal, LOTE_MAX):
+        nuevo *= 2
+    while nuevo > max(ideal, LOTE_MIN) and nuevo // 2 >= LOTE_MIN:
+        nuevo //= 2
+    return nuevo
+
+def iter_embeddings(paths, batch_size=None, workers=None, prefetch=2):
+    """
+    Generador: produce (rutas_del_lote, matriz (n, D) float32) en el orden de `paths`.
+    batch_size=None ajusta el tamano de lote segun el tiempo de inferencia.
+    workers: procesos de decodificacion (None = nucleos-1, 0 = en este hilo).
+    """
+    paths = list(paths)
+    if not paths:
+        return
+    adaptativo = batch_size is None
+    bs = LOTE_INICIAL if adaptativo else batch_size
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 2) - 1)
+    if workers == 0 or len(paths) <= bs:
+        for s in range(0, len(paths), bs):
+            lote = paths[s:s+bs]
+            yield lote, _forward(_preprocesar_lote(lote))
+        return
+    _get_backend()
+    en_vuelo = deque()
+    siguiente = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while siguiente < len(paths) or en_vuelo:
+            # keep every worker busy plus `prefetch` decoded batches waiting
+            while siguiente < len(paths) and len(en_vuelo) < workers + prefetch:
+                lote = paths[siguiente:siguiente+bs]
+                en_vuelo.append((lote, pool.submit(_preprocesar_lote_trazado, lote)))
+                siguiente += len(lote)
+            lote, fut = en_vuelo.popleft()
+            x, eventos = fut.result()
+            traza.incorporar(eventos)
+            t0 = time.perf_counter()
+            emb = _forward(x)
+            if adaptativo:
+                bs = _siguiente_lote(bs, len(lote), time.perf_counter() - t0)
+            yield lote, emb
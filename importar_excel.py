@@ -1,85 +1,263 @@
 # importar_excel.py
-import sqlite3
-import pandas as pd
+# Importa chapas desde .xlsx, .csv o .parquet. Las filas se leen por bloques sin
+# cargar el fichero entero; cada bloque se valida, se embebe y se confirma en la
+# BD junto con un checkpoint, asi una importacion interrumpida (fallo o Ctrl+C)
+# continua desde el ultimo bloque confirmado al volver a ejecutarla.
+#
+#   python importar_excel.py [chapas.xlsx] [--imagenes imagenes] [--desde-cero]
+import argparse
+import csv
 import os
+import time
+from itertools import islice
 import numpy as np
-from math import ceil
 import funciones_modelo as fm
 import funciones as fn
 
 EXCEL_FILE = "chapas.xlsx"
 IMAGES_DIR = "imagenes"
-BATCH_SIZE = 16  # ajustar según memoria/CPU
-
-# Ensure DB + column
-fn.crear_bd()
-fn.ensure_embedding_column()
-
-# Read excel
-df = pd.read_excel(EXCEL_FILE)
-
-# Get set of already stored image paths to avoid recalculating
-rows = fn.obtener_todas_chapas()
-existing_paths = set(r[3] for r in rows)  # imagen column
-
-# Prepare list of new items to insert (or update) with embedding
-to_process = []
-for _, row in df.iterrows():
-    if pd.isna(row.get("id")) or pd.isna(row.get("imagen")):
-        continue
-    imagen_name = str(row["imagen"])
-    imagen_path = os.path.join(IMAGES_DIR, imagen_name)
-    if not os.path.exists(imagen_path):
-        print("Imagen no encontrada:", imagen_path)
-        continue
-    # If image already exists and has an embedding, skip compute; but we will still ensure DB row exists
-    to_process.append((int(row["id"]), row["marca"], row["tipo"], imagen_path))
-
-# Process in batches: compute embeddings only for items that don't already have embedding
-# We'll query DB for embedding presence
-conn = sqlite3.connect(fn.DB_FILE)
-cur = conn.cursor()
-cur.execute("SELECT imagen, embedding FROM chapas")
-have_emb = {r[0]: r[1] for r in cur.fetchall() if r[1] is not None}
-conn.close()
-
-# Build list of paths to compute
-paths_to_compute = []
-indexes_to_compute = []  # indexes in to_process
-for idx, item in enumerate(to_process):
-    _, _, _, p = item
-    if p not in have_emb:
-        paths_to_compute.append(p)
-        indexes_to_compute.append(idx)
-
-# Batch compute embeddings
-if paths_to_compute:
-    n_batches = ceil(len(paths_to_compute) / BATCH_SIZE)
-    for b in range(n_batches):
-        start = b*BATCH_SIZE
-        end = start + BATCH_SIZE
-        batch_paths = paths_to_compute[start:end]
-        emb_batch = fm.batch_imagenes_a_embeddings(batch_paths)  # float32 (n,D)
+BATCH_SIZE = None  # None = adaptativo; o un entero fijo según memoria/CPU
+WORKERS = None     # procesos de decodificación (None = núcleos-1, 0 = sin pool)
+FILAS_BLOQUE = 4096  # rows per checkpoint
+COLUMNAS = ("id", "marca", "tipo", "imagen")
+MAX_AVISOS = 20    # missing-image messages printed before only counting them
+
+# ----------------- Readers: tuples (id, marca, tipo, imagen) in file order -----------------
+def _indices_columnas(cabecera):
+    nombres = [str(c).strip().lower() if c is not None else "" for c in cabecera]
+    faltan = [c for c in ("id", "imagen") if c not in nombres]
+    if faltan:
+        raise ValueError(f"faltan columnas en la cabecera: {', '.join(faltan)}")
+    return [nombres.index(c) if c in nombres else None for c in COLUMNAS]
+
+def _proyectar(filas, idx):
+    for f in filas:
+        yield tuple(f[i] if i is not None and i < len(f) else None for i in idx)
+
+def _leer_xlsx(path):
+    from openpyxl import load_workbook
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        filas = wb.active.iter_rows(values_only=True)
+        yield from _proyectar(filas, _indices_columnas(next(filas, ())))
+    finally:
+        wb.close()
+
+def _leer_csv(path):
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        filas = csv.reader(f)
+        for fila in _proyectar(filas, _indices_columnas(next(filas, []))):
+            # an empty CSV cell means the same as an empty Excel cell
+            yield tuple(None if v == "" else v for v in fila)
+
+def _leer_parquet(path):
+    import pyarrow.parquet as pq
+    pf = pq.ParquetFile(path)
+    nombres = pf.schema_arrow.names
+    idx = _indices_columnas(nombres)
+    for lote in pf.iter_batches(batch_size=FILAS_BLOQUE, columns=[nombres[i] for i in idx if i is not None]):
+        datos = lote.to_pydict()
+        yield from zip(*(datos[nombres[i]] if i is not None else [None] * lote.num_rows for i in idx))
+
+_LECTORES = {".xlsx": _leer_xlsx, ".xlsm": _leer_xlsx, ".csv": _leer_csv, ".parquet": _leer_parquet}
+
+def leer_filas(path):
+    """
+    Generador de tuplas (id, marca, tipo, imagen) segun la extension del fichero.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in _LECTORES:
+        raise ValueError(f"formato no soportado: {ext} (usa .xlsx, .csv o .parquet)")
+    return _LECTORES[ext](path)
+
+def total_filas(path):
+    """
+    Filas de datos del fichero, para el progreso; None si no se puede saber barato.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".xlsx", ".xlsm"):
+        from openpyxl import load_workbook
+        wb = load_workbook(path, read_only=True)
+        n = wb.active.max_row  # from the sheet dimension; None if the writer omitted it
+        wb.close()
+        return None if n is None else max(n - 1, 0)
+    if ext == ".parquet":
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    if ext == ".csv":
+        n = 0
+        with open(path, "rb") as f:
+            for trozo in iter(lambda: f.read(1 << 20), b""):
+                n += trozo.count(b"\n")
+        return max(n - 1, 0)
+    return None
+
+# ----------------- Validation -----------------
+def _listar_imagenes(images_dir):
+    # one directory walk instead of an os.path.exists per row. Returns (keys, names):
+    # the names as on disk and their os.path.normcase keys, sorted by key, so a lookup
+    # follows the filesystem's case rules (on Windows "cap1.jpg" finds "Cap1.JPG")
+    nombres = []
+    for raiz, _, ficheros in os.walk(images_dir):
+        rel = os.path.relpath(raiz, images_dir)
+        nombres += [os.path.normpath(os.path.join(rel, f)) for f in ficheros]
+    nombres = np.array(nombres, dtype=str)
+    claves = np.array([os.path.normcase(n) for n in nombres], dtype=str)
+    orden = np.argsort(claves, kind="stable")
+    return claves[orden], nombres[orden]
+
+def _a_numero(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return np.nan
+
+def validar(bloque, existentes, images_dir=IMAGES_DIR):
+    """
+    Retorna (validas [(id, marca, tipo, ruta_imagen)], sin_imagen [ruta]) para un
+    bloque de filas. Se descartan filas sin id entero, sin imagen o cuya imagen
+    no esta en `existentes` (de _listar_imagenes). La ruta guardada lleva el
+    nombre tal como esta en disco.
+    """
+    claves, en_disco = existentes
+    n = len(bloque)
+    ids = np.fromiter((_a_numero(f[0]) for f in bloque), dtype=np.float64, count=n)
+    nombres = np.array([os.path.normpath(str(f[3]).strip()) if f[3] not in (None, "") else ""
+                        for f in bloque], dtype=str)
+    ok_id = np.isfinite(ids) & (ids == np.floor(ids))
+    con_imagen = nombres != ""
+    buscadas = np.array([os.path.normcase(x) for x in nombres], dtype=str)
+    pos = np.minimum(np.searchsorted(claves, buscadas), max(len(claves) - 1, 0))
+    existe = claves[pos] == buscadas if len(claves) else np.zeros(n, dtype=bool)
+    validas = [(int(ids[i]), bloque[i][1], bloque[i][2], os.path.join(images_dir, en_disco[pos[i]]))
+               for i in np.flatnonzero(ok_id & con_imagen & existe)]
+    sin_imagen = [os.path.join(images_dir, nombres[i]) for i in np.flatnonzero(ok_id & con_imagen & ~existe)]
+    return validas, sin_imagen
+
+# ----------------- Pipeline -----------------
+def _importar_bloque(filas, batch_size, workers):
+    # Embeddings are keyed by content hash: renamed/moved files and photos shared by
+    # several caps reuse the stored vector, and files edited in place are re-embedded.
+    hashes = fn.hashes_de_ficheros(p for _, _, _, p in filas)
+    # files deleted or renamed since the folder was listed are reported, not fatal
+    desaparecidas = sorted({p for _, _, _, p in filas if p not in hashes})
+    filas = [f for f in filas if f[3] in hashes]
+    cache = fn.embeddings_cacheados(hashes.values())
+
+    # items grouped by hash; the model runs once per never-seen content
+    por_hash = {}
+    for item in filas:
+        por_hash.setdefault(hashes[item[3]], []).append(item)
+    pendientes = [items[0][3] for h, items in por_hash.items() if h not in cache]
+
+    # Batch compute embeddings: decode runs in a process pool, overlapped with inference
+    for batch_paths, emb_batch in fm.iter_embeddings(pendientes, batch_size=batch_size, workers=workers):
         # convert to float16 for storage
         emb_batch_f16 = emb_batch.astype(np.float16)
-        # write to DB per item
-        for j, path in enumerate(batch_paths):
-            emb_bytes = emb_batch_f16[j].tobytes()
-            # find corresponding to_process index
-            idx = indexes_to_compute[start + j]
-            id_, marca, tipo, imagen_path = to_process[idx]
-            fn.insertar_chapa(id_, marca, tipo, imagen_path, emb_bytes)
-
-# For items that had embeddings already or remained, ensure rows exist/updated
-for id_, marca, tipo, imagen_path in to_process:
-    if imagen_path in have_emb:
-        # re-insert preserving existing embedding
-        emb_blob = have_emb[imagen_path]
-        fn.insertar_chapa(id_, marca, tipo, imagen_path, emb_blob)
-    else:
-        # already inserted when computing batch
-        pass
-
-print("Importación completada.")
-# reload embeddings into RAM for fast search
-fn.reload_embeddings()
+        pares = [(hashes[p], emb_batch_f16[j].tobytes()) for j, p in enumerate(batch_paths)]
+        fn.guardar_embeddings_cache(pares)
+        # one transaction per embedded batch
+        fn.insertar_chapas_bulk((id_, marca, tipo, imagen_path, blob)
+                                for h, blob in pares
+                                for id_, marca, tipo, imagen_path in por_hash[h])
+
+    # Items whose content was already embedded: ensure rows exist/updated with the cached
+    # embedding; unchanged rows are skipped by insertar_chapas_bulk
+    fn.insertar_chapas_bulk((id_, marca, tipo, imagen_path, cache[hashes[imagen_path]])
+                            for id_, marca, tipo, imagen_path in filas
+                            if hashes[imagen_path] in cache)
+    return len(pendientes), desaparecidas
+
+class _Progreso:
+    def __init__(self, total, inicio):
+        self.total = total
+        self.inicio = inicio
+        self.embebidas = 0
+        self.t0 = time.perf_counter()
+
+    def informar(self, hechas, embebidas):
+        self.embebidas += embebidas
+        dt = max(time.perf_counter() - self.t0, 1e-9)
+        ritmo = (hechas - self.inicio) / dt
+        msg = f"{hechas}"
+        if self.total:
+            msg += f"/{self.total} filas ({100 * hechas / self.total:.1f}%)"
+        else:
+            msg += " filas"
+        msg += f", {ritmo:.0f} filas/s, {self.embebidas / dt:.1f} embeddings/s"
+        if self.total and ritmo > 0 and hechas < self.total:
+            m, s = divmod(int((self.total - hechas) / ritmo), 60)
+            h, m = divmod(m, 60)
+            msg += f", ETA {h:d}:{m:02d}:{s:02d}"
+        print(msg, flush=True)
+
+def importar(fuente=EXCEL_FILE, images_dir=IMAGES_DIR, reanudar=True, filas_bloque=FILAS_BLOQUE,
+             batch_size=BATCH_SIZE, workers=WORKERS):
+    """
+    Importa `fuente` por bloques de `filas_bloque` filas. Cada bloque confirmado
+    queda registrado; con reanudar=True se salta lo ya importado si el fichero
+    no ha cambiado. Retorna {"filas", "importadas", "sin_imagen", "embebidas"}.
+    """
+    # Ensure DB + column
+    fn.crear_bd()
+    fn.ensure_embedding_column()
+
+    clave = os.path.abspath(fuente)
+    st = os.stat(fuente)
+    firma = f"{st.st_size}:{st.st_mtime_ns}"
+    hechas = fn.progreso_importacion(clave, firma) if reanudar else 0
+    filas = leer_filas(fuente)
+    if hechas:
+        print(f"Reanudando desde la fila {hechas} (checkpoint de una ejecucion anterior)")
+        for _ in islice(filas, hechas):
+            pass
+    existentes = _listar_imagenes(images_dir)
+    progreso = _Progreso(total_filas(fuente), hechas)
+    stats = {"filas": hechas, "importadas": 0, "sin_imagen": 0, "embebidas": 0}
+    try:
+        while True:
+            bloque = list(islice(filas, filas_bloque))
+            if not bloque:
+                break
+            validas, sin_imagen = validar(bloque, existentes, images_dir)
+            embebidas, desaparecidas = _importar_bloque(validas, batch_size, workers) if validas else (0, [])
+            if desaparecidas:
+                fuera = set(desaparecidas)
+                validas = [v for v in validas if v[3] not in fuera]
+                sin_imagen += desaparecidas
+            for p in sin_imagen[:max(0, MAX_AVISOS - stats["sin_imagen"])]:
+                print("Imagen no encontrada:", p)
+            stats["filas"] += len(bloque)
+            stats["importadas"] += len(validas)
+            stats["sin_imagen"] += len(sin_imagen)
+            stats["embebidas"] += embebidas
+            fn.guardar_progreso_importacion(clave, firma, stats["filas"])
+            progreso.informar(stats["filas"], embebidas)
+    except KeyboardInterrupt:
+        print(f"\nInterrumpido: {stats['filas']} filas confirmadas; "
+              "la proxima ejecucion continua desde ahi.")
+        raise
+    if stats["sin_imagen"] > MAX_AVISOS:
+        print(f"... {stats['sin_imagen']} imagenes no encontradas en total")
+    fn.terminar_importacion(clave)
+
+    print("Importación completada.")
+    # reload embeddings into RAM for fast search
+    fn.reload_embeddings()
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Importa chapas desde Excel, CSV o Parquet")
+    parser.add_argument("fichero", nargs="?", default=EXCEL_FILE)
+    parser.add_argument("--imagenes", default=IMAGES_DIR, help="carpeta de las imagenes")
+    parser.add_argument("--desde-cero", action="store_true", help="ignora el checkpoint anterior")
+    parser.add_argument("--filas-bloque", type=int, default=FILAS_BLOQUE)
+    args = parser.parse_args(argv)
+    try:
+        importar(args.fichero, args.imagenes, reanudar=not args.desde_cero, filas_bloque=args.filas_bloque)
+    except KeyboardInterrupt:
+        raise SystemExit(130)
+
+# The guard matters: the decode pool re-imports this module in each worker on Windows (spawn)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,585 @@
+# indice_vectorial.py
+# Vector index layer used by funciones.buscar_por_imagen.
+#   - IndiceFlat: exact brute-force search (baseline)
+#   - IndiceIVF: k-means coarse quantizer + inverted lists, tunable with nprobe
+import heapq
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+import numpy as np
+import traza
+
+IVF_MIN_FILAS = 20000   # below this the flat scan is already fast enough
+NPROBE_DEFECTO = 8      # lists visited per query (recall/latency knob)
+REORDENAR_DEFECTO = 256 # PQ candidates re-ranked with the exact vectors
+CHUNK_PUNTUAR = 16384   # rows upcast to float32 at a time when scoring a float16 matrix
+FILTRO_EXACTO_MAX = 50000  # filtered subsets up to this size are always scanned exactly
+# Exact search shards. A multiple of the BLAS kernel's row block that divides CHUNK_PUNTUAR,
+# so every row is scored by the same kernel path as an unsharded puntuar(): identical floats.
+SHARD_FILAS = 8192
+HILOS_BUSQUEDA = None   # shard threads (None = all cores with threadpoolctl, else 1)
+
+
+def puntuar(matrix, q):
+    """
+    Similitudes matrix @ q en float32. Una matriz float16 (p.ej. el memmap del
+    sidecar) se convierte por bloques para no duplicarla entera en RAM.
+    """
+    if matrix.dtype == np.float32:
+        return (matrix @ q).astype(np.float32)
+    sims = np.empty(matrix.shape[0], dtype=np.float32)
+    for s in range(0, matrix.shape[0], CHUNK_PUNTUAR):
+        sims[s:s+CHUNK_PUNTUAR] = matrix[s:s+CHUNK_PUNTUAR].astype(np.float32) @ q
+    return sims
+
+
+_pool_shards = None
+_lock_shards = threading.Lock()   # one sharded search at a time owns the BLAS thread limit
+_blas = None
+
+
+def _limitar_blas():
+    # threadpoolctl (optional) caps BLAS at 1 thread inside each shard; without it, BLAS
+    # already threads each product and adding shard threads on top would oversubscribe
+    global _blas
+    if _blas is None:
+        try:
+            from threadpoolctl import ThreadpoolController
+            _blas = ThreadpoolController()
+        except ImportError:
+            _blas = False
+    return _blas
+
+
+def _hilos_shards():
+    # parallel shards only when the BLAS limit can be enforced; HILOS_BUSQUEDA forces a count
+    if HILOS_BUSQUEDA:
+        return HILOS_BUSQUEDA
+    return (os.cpu_count() or 1) if _limitar_blas() else 1
+
+
+@contextmanager
+def _blas_un_hilo():
+    ctl = _limitar_blas()
+    if not ctl:
+        yield
+        return
+    with ctl.limit(limits=1, user_api="blas"):
+        yield
+
+
+def _top_shard(matrix, q, a, b, k):
+    # candidates of rows [a, b): every row tied with the shard's k-th score is kept, so the
+    # merge can apply the tie rule (higher position first) exactly
+    sims = puntuar(matrix[a:b], q)
+    if k < sims.size:
+        cand = np.flatnonzero(sims >= np.partition(sims, -k)[-k])
+    else:
+        cand = np.arange(sims.size)
+    orden = np.lexsort((cand, sims[cand]))[::-1][:k]
+    return [(float(s), int(p)) for s, p in zip(sims[cand[orden]], cand[orden] + a)]
+
+
+def top_k_exacto(matrix, q, top_k):
+    """
+    Top-k exacto de matrix @ q por shards de SHARD_FILAS filas en un pool de
+    hilos; cada shard hace su argpartition y los parciales se mezclan con un
+    heap. Mismo orden que np.argsort(sims, kind="stable")[::-1][:top_k]
+    (similitud desc, en empate la posicion mayor primero) y mismos floats que
+    puntuar(). Retorna (posiciones, similitudes).
+    """
+    global _pool_shards
+    n = matrix.shape[0]
+    k = min(top_k, n)
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    hilos = _hilos_shards()
+    limites = [(a, min(a + SHARD_FILAS, n)) for a in range(0, n, SHARD_FILAS)]
+    with traza.tramo("producto", shards=len(limites)):
+        if hilos <= 1 or len(limites) == 1:
+            partes = [_top_shard(matrix, q, a, b, k) for a, b in limites]
+        else:
+            if _pool_shards is None:
+                _pool_shards = ThreadPoolExecutor(max_workers=hilos)
+            with _lock_shards, _blas_un_hilo():
+                futs = [_pool_shards.submit(_top_shard, matrix, q, a, b, k) for a, b in limites]
+                partes = [f.result() for f in futs]
+    with traza.tramo("ordenar"):
+        mejores = list(islice(heapq.merge(*partes, reverse=True), k))
+    return (np.array([p for _, p in mejores], dtype=np.int64),
+            np.array([s for s, _ in mejores], dtype=np.float32))
+
+
+def kmeans(muestra, k, iters=10, rng=None, esferico=False):
+    """
+    k-means en numpy sobre una muestra float32 (n, d). esferico=True usa
+    similitud coseno y mantiene los centroides normalizados.
+    """
+    rng = rng or np.random.default_rng(0)
+    cent = muestra[rng.choice(muestra.shape[0], k, replace=False)].astype(np.float32)
+    for _ in range(iters):
+        if esferico:
+            asign = np.argmax(muestra @ cent.T, axis=1)
+        else:
+            # argmin ||x - c||^2 == argmax (x.c - ||c||^2 / 2)
+            asign = np.argmax(muestra @ cent.T - 0.5 * (cent * cent).sum(axis=1), axis=1)
+        orden = np.argsort(asign, kind="stable")
+        presentes, inicios, cuenta = np.unique(asign[orden], return_index=True, return_counts=True)
+        nuevo = muestra[rng.integers(muestra.shape[0], size=k)].astype(np.float32)  # re-seed empty clusters
+        nuevo[presentes] = np.add.reduceat(muestra[orden], inicios, axis=0)
+        if esferico:
+            norms = np.linalg.norm(nuevo, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            nuevo /= norms
+        else:
+            nuevo[presentes] /= cuenta[:, None]
+        cent = nuevo
+    return cent
+
+
+def top_k_lote(matrix, Q, top_k, bloque=CHUNK_PUNTUAR):
+    """
+    Top-k exacto para varias consultas a la vez: producto matriz-matriz por
+    bloques de filas con argpartition por columna. Q es (m, D).
+    Retorna (posiciones (m, k), similitudes (m, k)) ordenadas desc por fila.
+    """
+    m = Q.shape[0]
+    k = min(top_k, matrix.shape[0])
+    Qt = np.ascontiguousarray(Q.T, dtype=np.float32)
+    mejor_pos = np.empty((0, m), dtype=np.int64)
+    mejor_sim = np.empty((0, m), dtype=np.float32)
+    for s in range(0, matrix.shape[0], bloque):
+        S = np.asarray(matrix[s:s+bloque], dtype=np.float32) @ Qt          # (b, m)
+        if S.shape[0] > k:
+            part = np.argpartition(S, -k, axis=0)[-k:]                       # (k, m)
+            S_top = np.take_along_axis(S, part, axis=0)
+        else:
+            part = np.broadcast_to(np.arange(S.shape[0])[:, None], S.shape)
+            S_top = S
+        # merge the block's candidates with the running best k per query
+        cand_pos = np.vstack([mejor_pos, part + s])
+        cand_sim = np.vstack([mejor_sim, S_top])
+        if cand_sim.shape[0] > k:
+            sel = np.argpartition(cand_sim, -k, axis=0)[-k:]
+            cand_pos = np.take_along_axis(cand_pos, sel, axis=0)
+            cand_sim = np.take_along_axis(cand_sim, sel, axis=0)
+        mejor_pos, mejor_sim = cand_pos, cand_sim
+    orden = np.argsort(-mejor_sim, axis=0, kind="stable")
+    return (np.take_along_axis(mejor_pos, orden, axis=0).T,
+            np.take_along_axis(mejor_sim, orden, axis=0).T)
+
+
+def pares_similares(matrix, umbral, bloque=2048):
+    """
+    Generador de pares (i, j, similitud) con i < j y similitud >= umbral. La
+    matriz N x N se recorre por teselas bloque x bloque (solo el triangulo
+    superior), asi que la memoria no depende de N.
+    """
+    n = matrix.shape[0]
+    for a in range(0, n, bloque):
+        A = np.asarray(matrix[a:a+bloque], dtype=np.float32)
+        for b in range(a, n, bloque):
+            B = A if b == a else np.asarray(matrix[b:b+bloque], dtype=np.float32)
+            S = A @ B.T
+            ii, jj = np.nonzero(S >= umbral)
+            if b == a:
+                # diagonal tile: upper triangle only
+                keep = ii < jj
+                ii, jj = ii[keep], jj[keep]
+            for i, j in zip(ii.tolist(), jj.tolist()):
+                yield a + i, b + j, float(S[i, j])
+
+
+class IndiceFlat:
+    """
+    Busqueda exacta: producto matriz-vector sobre todas las filas, por shards
+    en paralelo (top_k_exacto).
+    """
+    tipo = "flat"
+
+    def enlazar(self, ids, matrix):
+        self.n = len(ids)
+
+    def anadir(self, id_, vec, pos=None):
+        pass
+
+    def olvidar(self, ids):
+        pass
+
+    def buscar(self, matrix, q, top_k, nprobe=None):
+        """
+        Retorna (posiciones, similitudes) ordenadas desc.
+        """
+        return top_k_exacto(matrix, q, top_k)
+
+    def buscar_lote(self, matrix, Q, top_k, nprobe=None):
+        """
+        Retorna (posiciones (m, k), similitudes (m, k)) para las m filas de Q.
+        """
+        return top_k_lote(matrix, Q, top_k)
+
+    def guardar(self, path):
+        pass
+
+
+class IndiceIVF:
+    """
+    Indice IVF: cada embedding se asigna al centroide mas cercano (k-means
+    esferico) y la consulta solo recorre las `nprobe` listas mas proximas.
+    Las asignaciones se guardan por id de chapa, no por posicion, para que
+    el indice siga valido tras reload_embeddings.
+    """
+    tipo = "ivf"
+
+    def __init__(self, nlist=None, nprobe=NPROBE_DEFECTO):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroides = None              # float32 (nlist, D)
+        self._asignacion = {}               # chapa id -> list number
+        self._listas = []                   # list number -> np.int64 positions
+        self._pendientes = {}               # list number -> positions added after enlazar
+
+    # ---------- training ----------
+    def entrenar(self, matrix, iters=10, max_muestra=None, seed=0):
+        n = matrix.shape[0]
+        if self.nlist is None:
+            self.nlist = max(1, int(4 * np.sqrt(n)))
+        self.nlist = min(self.nlist, n)
+        rng = np.random.default_rng(seed)
+        max_muestra = max_muestra or min(64 * self.nlist, 100000)
+        if n > max_muestra:
+            muestra = matrix[np.sort(rng.choice(n, max_muestra, replace=False))]
+        else:
+            muestra = matrix
+        muestra = np.asarray(muestra, dtype=np.float32)
+        self.centroides = kmeans(muestra, self.nlist, iters, rng, esferico=True)
+        self._asignacion = {}
+
+    def _asignar(self, matrix, chunk=65536):
+        out = np.empty(matrix.shape[0], dtype=np.int64)
+        for s in range(0, matrix.shape[0], chunk):
+            bloque = np.asarray(matrix[s:s+chunk], dtype=np.float32)
+            out[s:s+chunk] = np.argmax(bloque @ self.centroides.T, axis=1)
+        return out
+
+    # ---------- binding to the in-RAM matrix ----------
+    def enlazar(self, ids, matrix):
+        """
+        Construye las listas de posiciones para la matriz actual. Las filas
+        sin asignacion previa (insertadas despues de entrenar) se asignan al
+        centroide mas cercano sin reentrenar.
+        """
+        asign = np.fromiter((self._asignacion.get(i, -1) for i in ids),
+                            dtype=np.int64, count=len(ids))
+        faltan = np.nonzero(asign < 0)[0]
+        if len(faltan):
+            asign[faltan] = self._asignar(matrix[faltan])
+        self._asignacion = dict(zip(ids, asign.tolist()))
+        orden = np.argsort(asign, kind="stable")
+        cortes = np.searchsorted(asign[orden], np.arange(self.nlist + 1))
+        self._listas = [orden[cortes[c]:cortes[c+1]] for c in range(self.nlist)]
+        self._pendientes = {}
+        return len(faltan)
+
+    def anadir(self, id_, vec, pos=None):
+        """
+        Registra un embedding nuevo sin reentrenar. Si `pos`
+        se indica, la fila ya esta en la matriz en RAM y pasa a ser buscable.
+        """
+        c = int(np.argmax(self.centroides @ np.asarray(vec, dtype=np.float32)))
+        self._asignacion[id_] = c
+        if pos is not None:
+            self._pendientes.setdefault(c, []).append(pos)
+
+    def olvidar(self, ids):
+        """
+        Descarta la asignacion de ids borrados o reemplazados; el siguiente
+        enlazar los reasigna si siguen existiendo.
+        """
+        for id_ in ids:
+            self._asignacion.pop(id_, None)
+
+    # ---------- search ----------
+    def buscar(self, matrix, q, top_k, nprobe=None):
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        with traza.tramo("listas"):
+            cs = np.argpartition(self.centroides @ q, -nprobe)[-nprobe:]
+            partes = [self._listas[c] for c in cs]
+            partes += [np.asarray(self._pendientes[c], dtype=np.int64) for c in cs if c in self._pendientes]
+            cand = np.concatenate(partes) if partes else np.empty(0, dtype=np.int64)
+        if cand.size == 0:
+            return cand, np.empty(0, dtype=np.float32)
+        with traza.tramo("producto"):
+            sims = np.asarray(matrix[cand], dtype=np.float32) @ q
+        with traza.tramo("ordenar"):
+            k = min(top_k, cand.size)
+            top = np.argpartition(sims, -k)[-k:]
+            top = top[np.argsort(sims[top])[::-1]]
+        return cand[top], sims[top]
+
+    def buscar_lote(self, matrix, Q, top_k, nprobe=None):
+        # each query visits its own lists; rows are padded with -1 if a query has < k candidates
+        k = min(top_k, matrix.shape[0])
+        pos = np.full((Q.shape[0], k), -1, dtype=np.int64)
+        sims = np.full((Q.shape[0], k), -np.inf, dtype=np.float32)
+        for r, q in enumerate(Q):
+            p, s = self.buscar(matrix, q, k, nprobe)
+            pos[r, :len(p)] = p
+            sims[r, :len(s)] = s
+        return pos, sims
+
+    # ---------- persistence ----------
+    def guardar(self, path):
+        ids = np.fromiter(self._asignacion.keys(), dtype=np.int64, count=len(self._asignacion))
+        listas = np.fromiter(self._asignacion.values(), dtype=np.int64, count=len(self._asignacion))
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, centroides=self.centroides, ids=ids, listas=listas,
+                 nprobe=np.int64(self.nprobe))
+        os.replace(tmp, path)
+
+    @classmethod
+    def cargar(cls, path):
+        with np.load(path) as data:
+            idx = cls(nlist=data["centroides"].shape[0], nprobe=int(data["nprobe"]))
+            idx.centroides = data["centroides"].astype(np.float32)
+            idx._asignacion = dict(zip(data["ids"].tolist(), data["listas"].tolist()))
+        return idx
+
+    def conocidos(self):
+        return len(self._asignacion)
+
+
+class IndicePQ:
+    """
+    Cuantizacion de producto: cada embedding se guarda como m codigos de 1 byte
+    (un centroide de 256 por subespacio de D/m dimensiones). La primera pasada
+    puntua toda la coleccion sumando tablas (LUT) de m x 256 productos escalares;
+    las `reordenar` mejores se puntuan de nuevo con los vectores float16 exactos.
+    Con D=576 y m=96, 96 bytes por chapa frente a 1152 (float16) o 2304 (float32).
+    """
+    tipo = "pq"
+
+    def __init__(self, m=None, reordenar=REORDENAR_DEFECTO):
+        self.m = m
+        self.reordenar = reordenar
+        self.codebooks = None                   # float32 (m, 256, D/m)
+        self._ids = np.empty(0, dtype=np.int64)  # chapa id per code row
+        self._codigos = np.empty((0, 0), dtype=np.uint8)  # (m, N): one row per subspace
+        self._olvidados = set()
+        self._pendientes = []                   # positions added after enlazar (scored exactly)
+
+    def _sub(self, X):
+        # (n, D) -> (m, n, D/m)
+        X = np.asarray(X, dtype=np.float32)
+        return X.reshape(X.shape[0], self.m, -1).transpose(1, 0, 2)
+
+    def entrenar(self, matrix, iters=8, max_muestra=20000, seed=0):
+        d = matrix.shape[1]
+        if self.m is None:
+            self.m = next(m for m in (96, 72, 64, 48, 32, 24, 16, 8, 4, 2, 1) if d % m == 0 and m <= d)
+        rng = np.random.default_rng(seed)
+        n = matrix.shape[0]
+        sel = np.sort(rng.choice(n, min(n, max_muestra), replace=False))
+        sub = self._sub(matrix[sel])
+        k = min(256, sub.shape[1])
+        self.codebooks = np.stack([kmeans(sub[j], k, iters, rng) for j in range(self.m)])
+        self._ids = np.empty(0, dtype=np.int64)
+        self._codigos = np.empty((self.m, 0), dtype=np.uint8)
+
+    def codificar(self, X, chunk=16384):
+        """
+        Codigos (m, n) uint8 del centroide mas cercano en cada subespacio.
+        """
+        out = np.empty((self.m, X.shape[0]), dtype=np.uint8)
+        normas = 0.5 * (self.codebooks * self.codebooks).sum(axis=2)    # (m, 256)
+        for s in range(0, X.shape[0], chunk):
+            sub = self._sub(X[s:s+chunk])
+            for j in range(self.m):
+                out[j, s:s+chunk] = np.argmax(sub[j] @ self.codebooks[j].T - normas[j], axis=1)
+        return out
+
+    def enlazar(self, ids, matrix):
+        ids = np.asarray(ids, dtype=np.int64)
+        codigos = np.empty((self.m, len(ids)), dtype=np.uint8)
+        faltan = np.ones(len(ids), dtype=bool)
+        if len(self._ids):
+            orden = np.argsort(self._ids)
+            ordenados = self._ids[orden]
+            donde = np.clip(np.searchsorted(ordenados, ids), 0, len(ordenados) - 1)
+            faltan = ordenados[donde] != ids
+            if self._olvidados:
+                faltan |= np.isin(ids, np.fromiter(self._olvidados, dtype=np.int64))
+            ok = ~faltan
+            codigos[:, ok] = self._codigos[:, orden[donde[ok]]]
+        pos = np.nonzero(faltan)[0]
+        if len(pos):
+            codigos[:, pos] = self.codificar(matrix[pos])
+        self._ids, self._codigos = ids, codigos
+        self._olvidados = set()
+        self._pendientes = []
+        return len(pos)
+
+    def anadir(self, id_, vec, pos=None):
+        if pos is not None:
+            self._pendientes.append(pos)
+
+    def olvidar(self, ids):
+        self._olvidados.update(ids)
+
+    def buscar(self, matrix, q, top_k, nprobe=None):
+        q = np.asarray(q, dtype=np.float32)
+        with traza.tramo("pq_aprox"):
+            lut = np.einsum("jkd,jd->jk", self.codebooks, q.reshape(self.m, -1))   # (m, 256)
+            aprox = np.zeros(self._codigos.shape[1], dtype=np.float32)
+            for j in range(self.m):
+                aprox += lut[j].take(self._codigos[j])
+            r = min(max(self.reordenar, top_k), aprox.size)
+            cand = np.argpartition(aprox, -r)[-r:] if r < aprox.size else np.arange(aprox.size)
+            if self._pendientes:
+                cand = np.union1d(cand, np.asarray(self._pendientes, dtype=np.int64))
+        # exact re-rank of the short list against the float16/float32 rows
+        with traza.tramo("producto"):
+            cand = np.sort(cand)  # ascending positions: sequential reads on the memmap
+            sims = np.asarray(matrix[cand], dtype=np.float32) @ q
+        with traza.tramo("ordenar"):
+            k = min(top_k, cand.size)
+            top = np.argpartition(sims, -k)[-k:]
+            top = top[np.argsort(sims[top])[::-1]]
+        return cand[top], sims[top]
+
+    def buscar_lote(self, matrix, Q, top_k, nprobe=None):
+        k = min(top_k, matrix.shape[0])
+        pos = np.full((Q.shape[0], k), -1, dtype=np.int64)
+        sims = np.full((Q.shape[0], k), -np.inf, dtype=np.float32)
+        for r, q in enumerate(Q):
+            p, s = self.buscar(matrix, q, k)
+            pos[r, :len(p)] = p
+            sims[r, :len(s)] = s
+        return pos, sims
+
+    def guardar(self, path):
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, codebooks=self.codebooks, ids=self._ids, codigos=self._codigos,
+                 reordenar=np.int64(self.reordenar))
+        os.replace(tmp, path)
+
+    @classmethod
+    def cargar(cls, path):
+        with np.load(path) as data:
+            idx = cls(m=data["codebooks"].shape[0], reordenar=int(data["reordenar"]))
+            idx.codebooks = data["codebooks"]
+            idx._ids = data["ids"]
+            idx._codigos = data["codigos"]
+        return idx
+
+    def conocidos(self):
+        return len(self._ids)
+
+
+def buscar_filtrado(indice, matrix, q, top_k, posiciones, nprobe=None):
+    """
+    Como indice.buscar pero solo entre las filas `posiciones` (int64 ordenadas).
+    Se puntuan unicamente esas filas, asi que un filtro selectivo abarata la
+    busqueda. Con un indice aproximado y un filtro que deja pasar muchas filas
+    se pide al indice una lista mas larga y se filtra, con la busqueda exacta
+    sobre el subconjunto como respaldo si no quedan top_k.
+    """
+    n, n_sel = matrix.shape[0], posiciones.size
+    k = min(top_k, n_sel)
+    if k == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    if indice.tipo != "flat" and n_sel > FILTRO_EXACTO_MAX:
+        permitido = np.zeros(n, dtype=bool)
+        permitido[posiciones] = True
+        cand, sims = indice.buscar(matrix, q, min(n, -(-2 * top_k * n // n_sel)), nprobe=nprobe)
+        keep = permitido[cand]
+        if np.count_nonzero(keep) >= k:
+            return cand[keep][:k], sims[keep][:k]
+    if 2 * n_sel > n:
+        # most rows pass: one contiguous scan, then drop the rest
+        with traza.tramo("producto"):
+            sims = puntuar(matrix, q)
+            excluido = np.ones(n, dtype=bool)
+            excluido[posiciones] = False
+            sims[excluido] = -np.inf
+        filas = np.arange(n)
+    else:
+        with traza.tramo("producto"):
+            sims = puntuar(matrix[posiciones], q)
+        filas = posiciones
+    with traza.tramo("ordenar"):
+        top = np.argpartition(sims, -k)[-k:]
+        top = top[np.argsort(sims[top])[::-1]]
+    return filas[top], sims[top]
+
+
+def medir_recall(indice, matrix, consultas, top_k=8, **kw):
+    """
+    Recall@k del indice frente a la busqueda exacta y latencia media por
+    consulta (ms): (recall, ms_indice, ms_exacto).
+    """
+    exacto = IndiceFlat()
+    aciertos = 0
+    t_idx = t_exacto = 0.0
+    for q in consultas:
+        t0 = time.perf_counter()
+        ref, _ = exacto.buscar(matrix, q, top_k)
+        t1 = time.perf_counter()
+        got, _ = indice.buscar(matrix, q, top_k, **kw)
+        t2 = time.perf_counter()
+        aciertos += len(set(ref.tolist()) & set(got.tolist()))
+        t_exacto += t1 - t0
+        t_idx += t2 - t1
+    n = max(len(consultas), 1)
+    return aciertos / (n * top_k), 1000 * t_idx / n, 1000 * t_exacto / n
+
+
+_CLASES = {"ivf": IndiceIVF, "pq": IndicePQ}
+
+
+def ruta_indice(db_file, tipo="ivf"):
+    """
+    Fichero del indice junto a la base de datos: chapas.db -> chapas.<tipo>.npz
+    """
+    return os.path.splitext(db_file)[0] + f".{tipo}.npz"
+
+
+def construir_indice(tipo, ids, matrix, db_file, nprobe=NPROBE_DEFECTO):
+    """
+    Devuelve un indice enlazado a `matrix`. tipo: "flat", "ivf", "pq" o "auto"
+    (ivf a partir de IVF_MIN_FILAS filas). Reutiliza el indice persistido si
+    existe y lo reentrena cuando las filas nuevas superan a las entrenadas.
+    """
+    n = matrix.shape[0]
+    if tipo == "auto":
+        tipo = "ivf" if n >= IVF_MIN_FILAS else "flat"
+    if tipo == "flat" or n == 0:
+        idx = IndiceFlat()
+        idx.enlazar(ids, matrix)
+        return idx
+    cls = _CLASES[tipo]
+    path = ruta_indice(db_file, tipo)
+    idx = None
+    if os.path.exists(path):
+        try:
+            idx = cls.cargar(path)
+        except Exception:
+            idx = None
+    if idx is not None:
+        conocidos = idx.conocidos()
+        nuevos = idx.enlazar(ids, matrix)
+        if nuevos > conocidos:
+            idx = None
+        elif nuevos:
+            idx.guardar(path)
+    if idx is None:
+        idx = cls()
+        idx.entrenar(matrix)
+        idx.enlazar(ids, matrix)
+        idx.guardar(path)
+    if tipo == "ivf":
+        idx.nprobe = nprobe
+    return idx
@@ -0,0 +1,115 @@
+# informe_similitud.py
+# CLI: compara un lote de imagenes nuevas con la coleccion, o busca duplicados
+# dentro de ella, y escribe un informe CSV.
+#
+#   python informe_similitud.py buscar nuevas/*.jpg --top-k 5
+#   python informe_similitud.py duplicados --umbral 0.95
+#   python informe_similitud.py recall --indice pq
+#   python informe_similitud.py decodificacion [imagenes...] --muestra 50
+import argparse
+import csv
+import glob
+import os
+import random
+from datetime import datetime
+import funciones as fn
+
+REPORTS_DIR = "informes"
+
+def _expandir(patrones):
+    # Windows shells do not expand globs; directories contribute their images
+    paths = []
+    for p in patrones:
+        if os.path.isdir(p):
+            paths += sorted(os.path.join(p, f) for f in os.listdir(p)
+                            if f.lower().endswith((".png", ".jpg", ".jpeg")))
+        else:
+            paths += sorted(glob.glob(p)) or [p]
+    return paths
+
+def informe_busqueda(paths, top_k, salida):
+    resultados = fn.buscar_por_imagenes(paths, top_k=top_k)
+    with open(salida, "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(["consulta", "rank", "id", "marca", "tipo", "imagen", "similitud"])
+        for path, res in zip(paths, resultados):
+            for rank, (row, score) in enumerate(res, 1):
+                w.writerow([path, rank, *row[:4], f"{score:.4f}"])
+    return len(paths)
+
+def informe_duplicados(umbral, salida):
+    pares = fn.buscar_duplicados(umbral)
+    with open(salida, "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(["id_a", "marca_a", "imagen_a", "id_b", "marca_b", "imagen_b", "similitud"])
+        for a, b, score in pares:
+            w.writerow([a[0], a[1], a[3], b[0], b[1], b[3], f"{score:.4f}"])
+    return len(pares)
+
+def muestra_coleccion(n, seed=0):
+    # images of the collection that exist on disk, sampled without loading the whole table
+    rutas = [r[1] for r in fn.iterar_chapas(("id", "imagen")) if r[1] and os.path.exists(r[1])]
+    rng = random.Random(seed)
+    return rng.sample(rutas, min(n, len(rutas)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Informes de similitud de chapas")
+    sub = parser.add_subparsers(dest="modo", required=True)
+    p_b = sub.add_parser("buscar", help="compara imagenes nuevas con la coleccion")
+    p_b.add_argument("imagenes", nargs="+", help="ficheros, patrones o carpetas")
+    p_b.add_argument("--top-k", type=int, default=5)
+    p_b.add_argument("--salida")
+    p_d = sub.add_parser("duplicados", help="pares casi identicos dentro de la coleccion")
+    p_d.add_argument("--umbral", type=float, default=0.95)
+    p_d.add_argument("--salida")
+    p_r = sub.add_parser("recall", help="recall@k y latencia de un indice frente a la busqueda exacta")
+    p_r.add_argument("--indice", default=None, help="flat, ivf o pq (por defecto el configurado)")
+    p_r.add_argument("--top-k", type=int, default=8)
+    p_r.add_argument("--consultas", type=int, default=200)
+    p_c = sub.add_parser("decodificacion",
+                         help="embeddings con decodificacion reducida frente a la completa")
+    p_c.add_argument("imagenes", nargs="*", help="por defecto, una muestra de la coleccion")
+    p_c.add_argument("--muestra", type=int, default=50)
+    p_c.add_argument("--tolerancia", type=float, default=0.995, help="coseno minimo aceptado")
+    args = parser.parse_args(argv)
+
+    if args.modo == "decodificacion":
+        import funciones_modelo as fm
+        fn.crear_bd()
+        paths = _expandir(args.imagenes) if args.imagenes else muestra_coleccion(args.muestra)
+        res = fm.medir_decodificacion(paths)
+        if res is None:
+            print("No hay imagenes que comparar.")
+            return
+        print(f"{res['imagenes']} imagenes: coseno min {res['coseno_min']:.5f}, medio {res['coseno_medio']:.5f}")
+        print(f"decodificar+transformar: completa {res['ms_completa']:.1f} ms, reducida {res['ms_reducida']:.1f} ms")
+        print(f"bitmap decodificado: completa {res['mb_completa']:.1f} MB, reducida {res['mb_reducida']:.1f} MB")
+        if res["coseno_min"] < args.tolerancia:
+            raise SystemExit(f"coseno minimo por debajo de {args.tolerancia}")
+        return
+
+    if args.modo == "recall":
+        fn.crear_bd()
+        res = fn.medir_recall_indice(args.indice, n_consultas=args.consultas, top_k=args.top_k)
+        if res is None:
+            print("No hay embeddings en la base de datos.")
+        else:
+            recall, ms_idx, ms_exacto = res
+            print(f"recall@{args.top_k} = {recall:.3f}  ({ms_idx:.2f} ms/consulta, exacto {ms_exacto:.2f} ms)")
+        return
+
+    fn.crear_bd()
+    salida = args.salida
+    if salida is None:
+        os.makedirs(REPORTS_DIR, exist_ok=True)
+        fecha_hora = datetime.now().strftime("%Y%m%d_%H%M%S")
+        salida = os.path.join(REPORTS_DIR, f"{args.modo}_{fecha_hora}.csv")
+    if args.modo == "buscar":
+        n = informe_busqueda(_expandir(args.imagenes), args.top_k, salida)
+        print(f"{n} consultas -> {salida}")
+    else:
+        n = informe_duplicados(args.umbral, salida)
+        print(f"{n} pares -> {salida}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# miniaturas.py
+# On-disk thumbnail cache for the card list + in-memory LRU of rendered images.
+import os
+import hashlib
+from collections import OrderedDict
+from PIL import Image, ImageOps
+import carga_imagenes
+import traza
+
+CACHE_DIR = "miniaturas"
+TAM = (92, 92)
+BORDE = 2
+BORDE_COLOR = "#151515"
+VERSION = 2  # part of the cache key: v1 thumbnails ignored the EXIF orientation
+
+def ruta_miniatura(path):
+    """
+    Fichero de cache para `path`; la clave incluye mtime y tamano, asi que una
+    imagen editada genera una miniatura nueva.
+    """
+    st = os.stat(path)
+    clave = f"{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}|{TAM[0]}|v{VERSION}"
+    h = hashlib.blake2b(clave.encode("utf-8"), digest_size=16).hexdigest()
+    return os.path.join(CACHE_DIR, h[:2], h + ".png")
+
+def cargar_miniatura(path):
+    """
+    Retorna la miniatura (PIL Image, ya con borde) desde la cache de disco o,
+    si no existe, la genera a partir de la imagen original y la guarda.
+    """
+    cache = ruta_miniatura(path)
+    if os.path.exists(cache):
+        traza.contar("miniatura_disco")
+        img = Image.open(cache)
+        img.load()
+        return img
+    traza.contar("miniatura_generada")
+    # decoded near 2x the thumbnail size, then LANCZOS down (what thumbnail() alone does)
+    img = carga_imagenes.abrir(path, (2 * TAM[0], 2 * TAM[1]), modo=None)
+    img.thumbnail(TAM, Image.LANCZOS)
+    if img.mode not in ("RGB", "RGBA", "L", "P"):
+        img = img.convert("RGB")  # e.g. CMYK JPEGs cannot be saved as PNG
+    thumb = ImageOps.expand(img, border=BORDE, fill=BORDE_COLOR)
+    os.makedirs(os.path.dirname(cache), exist_ok=True)
+    tmp = cache + ".tmp"
+    thumb.save(tmp, format="PNG")
+    os.replace(tmp, cache)
+    return thumb
+
+class LRU:
+    """
+    Cache LRU de tamano fijo (p.ej. PhotoImage por ruta de miniatura).
+    """
+    def __init__(self, capacidad=512):
+        self.capacidad = capacidad
+        self._datos = OrderedDict()
+
+    def get(self, clave):
+        valor = self._datos.get(clave)
+        if valor is not None:
+            self._datos.move_to_end(clave)
+        return valor
+
+    def put(self, clave, valor):
+        self._datos[clave] = valor
+        self._datos.move_to_end(clave)
+        while len(self._datos) > self.capacidad:
+            self._datos.popitem(last=False)
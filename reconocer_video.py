@@ -0,0 +1,284 @@
+# reconocer_video.py
+# Reconoce una bandeja de chapas en una pasada: lee un video o una carpeta de
+# fotogramas secuenciales (chapas pasando bajo una camara fija), descarta los
+# fotogramas casi iguales al ultimo analizado, embebe el resto en micro-lotes y
+# los compara con la matriz residente. Los fotogramas seguidos que reconocen la
+# misma chapa forman un segmento; el resultado es un CSV con un segmento por fila.
+#
+#   python reconocer_video.py bandeja.mp4 [--fps-objetivo 10] [--salida informes/bandeja.csv]
+#   python reconocer_video.py fotogramas/ --fps 30
+#   python reconocer_video.py 0                      (camara 0, o una URL rtsp://...)
+#
+# Los videos necesitan OpenCV (pip install opencv-python); las carpetas de
+# fotogramas solo Pillow. Una fuente en vivo no espera al modelo: si la
+# inferencia se retrasa se descartan los fotogramas mas antiguos en cola.
+import argparse
+import csv
+import os
+import queue
+import re
+import threading
+import time
+from datetime import datetime
+import numpy as np
+from PIL import Image
+import funciones as fn
+import funciones_modelo as fm
+import traza
+
+FPS_OBJETIVO = 10.0     # frames analysed per second of footage at most
+FPS_CARPETA = 25.0      # frame rate assumed for a folder of frames
+LADO_CAMBIO = 64        # change detection compares LADO_CAMBIO^2 grayscale frames
+UMBRAL_CAMBIO = 6.0     # mean abs difference (0-255) vs the last kept frame to keep a new one
+UMBRAL_SIMILITUD = 0.5  # below this the frame shows no known cap (background, hand, blur)
+HUECO_MAX = 2           # disagreeing frames tolerated inside a segment
+LOTE = fm.LOTE_INICIAL  # frames per forward pass
+VENTANA_LOTE_S = 0.05   # how long a partial batch waits for more frames
+REPORTS_DIR = "informes"
+EXTENSIONES = (".png", ".jpg", ".jpeg")
+
+# ----------------- Frame sources: (index, seconds, PIL RGB) -----------------
+def _orden_natural(nombre):
+    # frame_2.jpg before frame_10.jpg
+    return [int(t) if t.isdigit() else t.lower() for t in re.split(r"(\d+)", nombre)]
+
+def _fotogramas_carpeta(carpeta, fps, paso):
+    nombres = sorted((f for f in os.listdir(carpeta) if f.lower().endswith(EXTENSIONES)), key=_orden_natural)
+    for i in range(0, len(nombres), paso):
+        yield i, i / fps, fm._decodificar(os.path.join(carpeta, nombres[i]))
+
+def _fotogramas_video(path, paso):
+    try:
+        import cv2
+    except ImportError:
+        raise RuntimeError("leer video necesita OpenCV: pip install opencv-python") from None
+    cap = cv2.VideoCapture(int(path) if _es_camara(path) else path)
+    if not cap.isOpened():
+        raise RuntimeError(f"no se pudo abrir el video {path}")
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS) or FPS_CARPETA
+        paso = paso(fps)
+        i = 0
+        while True:
+            # grab() skips a frame without decoding its pixels
+            if i % paso:
+                if not cap.grab():
+                    return
+            else:
+                ok, bgr = cap.read()
+                if not ok:
+                    return
+                yield i, i / fps, Image.fromarray(cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB))
+            i += 1
+    finally:
+        cap.release()
+
+def _es_camara(fuente):
+    return fuente.isdigit() and not os.path.exists(fuente)
+
+def en_vivo(fuente):
+    """
+    True si `fuente` es una camara (su indice) o un stream (rtsp://, http://...),
+    que sigue produciendo fotogramas aunque nadie los lea.
+    """
+    return _es_camara(fuente) or "://" in fuente
+
+def fotogramas(fuente, fps_objetivo=FPS_OBJETIVO, fps=None):
+    """
+    Fotogramas de `fuente` (video o carpeta) muestreados a fps_objetivo como
+    mucho. fps: cadencia de una carpeta (por defecto FPS_CARPETA).
+    """
+    def paso(fps_fuente):
+        return max(1, int(round(fps_fuente / fps_objetivo))) if fps_objetivo else 1
+    if os.path.isdir(fuente):
+        fps = fps or FPS_CARPETA
+        return _fotogramas_carpeta(fuente, fps, paso(fps))
+    return _fotogramas_video(fuente, paso)
+
+def _firma(img):
+    return np.asarray(img.convert("L").resize((LADO_CAMBIO, LADO_CAMBIO), Image.BILINEAR), dtype=np.int16)
+
+def con_cambio(frames, umbral=UMBRAL_CAMBIO):
+    """
+    Filtra `frames` dejando pasar los que difieren del ultimo que paso
+    (diferencia media absoluta en gris >= umbral) y, tras un movimiento, el
+    primero en que la escena se asienta (una vista nitida de lo que entro).
+    Una escena quieta cuesta un solo fotograma.
+    """
+    ultima = previa = None
+    movimiento = False
+    for i, t, img in frames:
+        firma = _firma(img)
+        asentada = False
+        if previa is not None:
+            d = np.abs(firma - previa).mean()
+            movimiento = movimiento or d >= umbral
+            asentada = movimiento and d < umbral / 2
+        previa = firma
+        if ultima is None or asentada or np.abs(firma - ultima).mean() >= umbral:
+            ultima = firma
+            if asentada:
+                movimiento = False
+            yield i, t, img
+
+# ----------------- Segments -----------------
+class _Segmentos:
+    """
+    Agrupa los fotogramas seguidos con la misma chapa (o sin ninguna). Hasta
+    HUECO_MAX fotogramas discordantes dentro del segmento de una chapa se toman
+    por ruido (desenfoque, reflejos).
+    """
+    def __init__(self, hueco_max=HUECO_MAX):
+        self.hueco_max = hueco_max
+        self.cerrados = []
+        self.actual = None
+        self._pendientes = []
+
+    def anadir(self, t, fila, sim):
+        clave = fila[0] if fila else None
+        if self.actual is None:
+            self.actual = {"inicio_s": t, "fin_s": t, "id": clave, "fila": fila, "similitud": sim, "fotogramas": 1}
+            return
+        if clave == self.actual["id"]:
+            self.actual["fin_s"] = t
+            self.actual["fotogramas"] += 1
+            if sim > self.actual["similitud"]:
+                self.actual["similitud"] = sim
+            self._pendientes = []
+            return
+        self._pendientes.append((t, fila, sim))
+        # a recognized cap is never treated as noise inside a stretch with no match
+        if self.actual["id"] is None or len(self._pendientes) > self.hueco_max:
+            self._reabrir()
+
+    def _reabrir(self):
+        # the disagreeing frames start over after the current segment
+        pendientes, self._pendientes = self._pendientes, []
+        self.cerrados.append(self.actual)
+        self.actual = None
+        for p in pendientes:
+            self.anadir(*p)
+
+    def terminar(self):
+        while self.actual is not None:
+            self._reabrir()
+        return self.cerrados
+
+# ----------------- Pipeline -----------------
+def reconocer(fuente, fps_objetivo=FPS_OBJETIVO, fps=None, umbral=UMBRAL_SIMILITUD,
+              cambio=UMBRAL_CAMBIO, lote=LOTE):
+    """
+    Reconoce las chapas de `fuente`. La lectura y la deteccion de cambio van en
+    un hilo y el modelo consume micro-lotes de hasta `lote` fotogramas.
+    Retorna (segmentos, stats); cada segmento es un dict con inicio_s, fin_s,
+    fila (None si no se reconocio ninguna chapa), similitud y fotogramas.
+    En una fuente en vivo la cola llena descarta su fotograma mas antiguo en
+    lugar de frenar la lectura (stats["descartados"]).
+    """
+    fn._load_embeddings_to_ram()
+    cola = queue.Queue(maxsize=4 * lote)
+    stats = {"leidos": 0, "analizados": 0, "descartados": 0, "duracion_s": 0.0}
+    fin = object()
+    vivo = en_vivo(fuente)
+
+    def poner(f):
+        if not vivo:
+            cola.put(f)  # a file waits for the model: nothing is lost by blocking
+            return
+        # a camera does not wait: keep the newest frames and drop the oldest
+        while True:
+            try:
+                cola.put_nowait(f)
+                return
+            except queue.Full:
+                try:
+                    cola.get_nowait()
+                    stats["descartados"] += 1
+                except queue.Empty:
+                    pass
+
+    def leer():
+        try:
+            def contados(frames):
+                for f in frames:
+                    stats["leidos"] += 1
+                    stats["duracion_s"] = f[1]
+                    yield f
+            for f in con_cambio(contados(fotogramas(fuente, fps_objetivo, fps)), cambio):
+                poner(f)
+        except Exception as e:
+            cola.put(e)
+        cola.put(fin)
+
+    t0 = time.perf_counter()
+    threading.Thread(target=leer, daemon=True).start()
+    segmentos = _Segmentos()
+    terminado = False
+    while not terminado:
+        pendientes = []
+        item = cola.get()
+        while item is not fin:
+            if isinstance(item, Exception):
+                raise item
+            pendientes.append(item)
+            if len(pendientes) >= lote:
+                break
+            try:
+                item = cola.get(timeout=VENTANA_LOTE_S)
+            except queue.Empty:
+                break
+        terminado = item is fin
+        if not pendientes:
+            continue
+        with traza.tramo("video_lote", n=len(pendientes)):
+            Q = fm.batch_imagenes_a_embeddings([img for _, _, img in pendientes])
+            resultados = fn.buscar_por_embeddings(Q, top_k=1)
+        for (_, t, _), res in zip(pendientes, resultados):
+            if res and res[0][1] >= umbral:
+                segmentos.anadir(t, res[0][0], res[0][1])
+            else:
+                segmentos.anadir(t, None, res[0][1] if res else 0.0)
+        stats["analizados"] += len(pendientes)
+    stats["proceso_s"] = time.perf_counter() - t0
+    return segmentos.terminar(), stats
+
+def guardar_log(segmentos, salida):
+    with open(salida, "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(["segmento", "inicio_s", "fin_s", "fotogramas", "id", "marca", "tipo", "imagen", "similitud"])
+        for n, s in enumerate(segmentos, 1):
+            fila = s["fila"] or (None, None, None, None)
+            w.writerow([n, f"{s['inicio_s']:.2f}", f"{s['fin_s']:.2f}", s["fotogramas"], *fila[:4],
+                        f"{s['similitud']:.4f}"])
+    return salida
+
+def ruta_log(fuente):
+    os.makedirs(REPORTS_DIR, exist_ok=True)
+    nombre = os.path.splitext(os.path.basename(os.path.normpath(fuente)))[0]
+    return os.path.join(REPORTS_DIR, f"video_{nombre}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reconoce las chapas de un video o carpeta de fotogramas")
+    parser.add_argument("fuente", help="fichero de video, carpeta de fotogramas, indice de camara o URL")
+    parser.add_argument("--fps-objetivo", type=float, default=FPS_OBJETIVO,
+                        help="fotogramas analizados por segundo de video como mucho")
+    parser.add_argument("--fps", type=float, default=None, help="cadencia de una carpeta de fotogramas")
+    parser.add_argument("--umbral", type=float, default=UMBRAL_SIMILITUD, help="similitud minima de una chapa")
+    parser.add_argument("--cambio", type=float, default=UMBRAL_CAMBIO,
+                        help="diferencia minima con el ultimo fotograma analizado (0-255)")
+    parser.add_argument("--salida")
+    args = parser.parse_args(argv)
+    fn.crear_bd()
+    segmentos, stats = reconocer(args.fuente, args.fps_objetivo, args.fps, args.umbral, args.cambio)
+    salida = guardar_log(segmentos, args.salida or ruta_log(args.fuente))
+    for s in segmentos:
+        que = f"{s['fila'][1]} (id {s['fila'][0]})" if s["fila"] else "sin coincidencia"
+        print(f"{s['inicio_s']:8.2f}-{s['fin_s']:8.2f} s  {que}  {s['similitud']:.3f}  ({s['fotogramas']} fotogramas)")
+    ritmo = stats["leidos"] / max(stats["proceso_s"], 1e-9)
+    print(f"{stats['leidos']} fotogramas muestreados, {stats['analizados']} analizados, "
+          f"{stats['descartados']} descartados por retraso, {ritmo:.1f} fotogramas/s "
+          f"({stats['duracion_s'] / max(stats['proceso_s'], 1e-9):.1f}x tiempo real)")
+    print(f"{sum(1 for s in segmentos if s['fila'])} segmentos con chapa -> {salida}")
+
+if __name__ == "__main__":
+    main()
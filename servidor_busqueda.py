@@ -0,0 +1,284 @@
+# servidor_busqueda.py
+# Servicio local de busqueda: mantiene el modelo y la matriz de embeddings
+# cargados y responde peticiones JSON por HTTP en localhost, asi la GUI y los
+# scripts no pagan la carga en cada arranque.
+#
+#   python servidor_busqueda.py [--puerto 8765] [--db chapas.db] [--vigilar]
+#
+# Protocolo (cuerpo y respuesta JSON):
+#   GET  /estado                                   -> {"filas": N, "indice": "flat"}
+#   GET  /metricas                                 -> texto Prometheus (con CHAPAS_TRAZA=1)
+#   POST /imagen  {"paths": [...], "top_k": 8, "nprobe": null, "marca": null, "tipo": null}
+#                                                   -> {"resultados": [[[fila, similitud], ...], ...],
+#                                                       "tiempos": {etapa: segundos}}
+#   POST /embeddings {"embeddings": [[...], ...], "top_k": 8, "nprobe": null, "marca": null, "tipo": null}
+#                                                   -> como /imagen, con vectores ya calculados
+#   POST /marca   {"texto": "...", "limite": null}  -> {"filas": [fila, ...]}
+#   POST /recargar                                 -> {"filas": N}
+# Una fila es [id, marca, tipo, imagen]. "tiempos" es el desglose por etapa medido en
+# el servidor (vacio si no corre con CHAPAS_TRAZA=1); el Cliente lo suma al de la
+# consulta en curso, asi la barra de estado de la GUI muestra las etapas del servidor.
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import funciones as fn
+import traza
+
+HOST = "127.0.0.1"
+PUERTO = 8765
+VENTANA_LOTE_S = 0.005  # how long the batcher waits for more image queries
+LOTE_MAX = 16           # <= funciones_modelo.LOTE_INICIAL: one in-process forward pass
+RECARGA_S = 2.0         # at most this often, a batch first applies the DB delta
+
+class _Lotes:
+    """
+    Agrupa las consultas por imagen que llegan casi a la vez y las resuelve con
+    una sola llamada a funciones.buscar_por_imagenes (un forward para todas).
+    """
+    def __init__(self, ventana=VENTANA_LOTE_S, maximo=LOTE_MAX):
+        self.ventana = ventana
+        self.maximo = maximo
+        self._cola = queue.Queue()
+        self._ultima_recarga = time.monotonic()
+        threading.Thread(target=self._bucle, daemon=True).start()
+
+    def enviar(self, path, top_k, nprobe, marca=None, tipo=None):
+        fut = Future()
+        self._cola.put((path, top_k, (nprobe, marca, tipo), fut))
+        return fut
+
+    def _bucle(self):
+        while True:
+            lote = [self._cola.get()]
+            limite = time.monotonic() + self.ventana
+            while len(lote) < self.maximo:
+                resto = limite - time.monotonic()
+                if resto <= 0:
+                    break
+                try:
+                    lote.append(self._cola.get(timeout=resto))
+                except queue.Empty:
+                    break
+            self.recargar_si_toca()
+            # nprobe and the filters change which rows are scanned, so they split the batch
+            grupos = {}
+            for pet in lote:
+                grupos.setdefault(pet[2], []).append(pet)
+            for (nprobe, marca, tipo), pets in grupos.items():
+                self._resolver(pets, nprobe, marca, tipo)
+
+    def recargar_si_toca(self):
+        # at most every RECARGA_S, apply the DB delta before answering
+        if time.monotonic() - self._ultima_recarga > RECARGA_S:
+            try:
+                fn.reload_embeddings()
+            except Exception as e:
+                print(f"No se pudo recargar la coleccion: {e}")
+            self._ultima_recarga = time.monotonic()
+
+    def _resolver(self, pets, nprobe, marca, tipo):
+        try:
+            paths = list(dict.fromkeys(p[0] for p in pets))
+            top_k = max(p[1] for p in pets)
+            with traza.consulta() as desglose:
+                res = dict(zip(paths, fn.buscar_por_imagenes(paths, top_k=top_k, nprobe=nprobe,
+                                                             marca=marca, tipo=tipo)))
+        except Exception as e:
+            if len(paths) == 1:
+                for pet in pets:
+                    pet[3].set_exception(e)
+                return
+            # one bad image (missing, corrupt) must not fail its neighbours: retry each on its own
+            for path in paths:
+                self._resolver([p for p in pets if p[0] == path], nprobe, marca, tipo)
+            return
+        for path, k, _, fut in pets:
+            fut.set_result((res[path][:k], desglose))
+
+class _Manejador(BaseHTTPRequestHandler):
+    lotes = None
+    verbose = False
+
+    def _responder(self, codigo, datos):
+        cuerpo = json.dumps(datos).encode("utf-8")
+        self.send_response(codigo)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def _estado(self):
+        fn._load_embeddings_to_ram()
+        return {"filas": len(fn._emb_ids), "indice": fn._indice.tipo}
+
+    def do_GET(self):
+        if self.path == "/estado":
+            self._responder(200, self._estado())
+        elif self.path == "/metricas":
+            cuerpo = traza.texto_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+        else:
+            self._responder(404, {"error": f"ruta desconocida: {self.path}"})
+
+    def imagen(self, pet):
+        top_k = int(pet.get("top_k", 8))
+        futs = [self.lotes.enviar(p, top_k, pet.get("nprobe"), pet.get("marca"), pet.get("tipo"))
+                for p in pet["paths"]]
+        salidas = [f.result() for f in futs]
+        tiempos = {}
+        # paths answered by the same batch share its breakdown: counted once
+        for desglose in {id(d): d for _, d in salidas if d}.values():
+            for etapa, dur in desglose.items():
+                tiempos[etapa] = tiempos.get(etapa, 0.0) + dur
+        return {"resultados": [[[list(fila), s] for fila, s in res] for res, _ in salidas],
+                "tiempos": tiempos}
+
+    def embeddings(self, pet):
+        # no forward pass to share, so no micro-batching: scored straight away
+        self.lotes.recargar_si_toca()
+        Q = np.asarray(pet["embeddings"], dtype=np.float32).reshape(len(pet["embeddings"]), -1)
+        with traza.consulta() as desglose:
+            res = fn.buscar_por_embeddings(Q, int(pet.get("top_k", 8)), pet.get("nprobe"),
+                                           pet.get("marca"), pet.get("tipo"))
+        return {"resultados": [[[list(fila), s] for fila, s in r] for r in res], "tiempos": desglose or {}}
+
+    def marca(self, pet):
+        filas = fn.buscar_por_marca(pet["texto"], limite=pet.get("limite"))
+        return {"filas": [list(f) for f in filas]}
+
+    def recargar(self, pet):
+        fn.reload_embeddings()
+        return self._estado()
+
+    # method names, so subclasses (coordinador.py) can override each endpoint
+    _RUTAS_POST = {"/imagen": "imagen", "/embeddings": "embeddings", "/marca": "marca", "/recargar": "recargar"}
+
+    def do_POST(self):
+        try:
+            n = int(self.headers.get("Content-Length") or 0)
+            pet = json.loads(self.rfile.read(n) or b"{}")
+        except ValueError as e:
+            self._responder(400, {"error": f"JSON no valido: {e}"})
+            return
+        metodo = self._RUTAS_POST.get(self.path)
+        if metodo is None:
+            self._responder(404, {"error": f"ruta desconocida: {self.path}"})
+            return
+        try:
+            self._responder(200, getattr(self, metodo)(pet))
+        except KeyError as e:
+            self._responder(400, {"error": f"falta el campo {e}"})
+        except Exception as e:
+            self._responder(500, {"error": str(e)})
+
+    def log_message(self, formato, *args):
+        if self.verbose:
+            super().log_message(formato, *args)
+
+def servir(host=HOST, puerto=PUERTO, verbose=False, vigilar=False):
+    """
+    Carga coleccion y modelo y atiende peticiones hasta Ctrl+C. Con vigilar=True
+    las imagenes de IMAGES_DIR que usan las filas se reindexan al cambiar y
+    entran en la matriz residente.
+    """
+    fn.crear_bd()
+    t0 = time.perf_counter()
+    fn.calentar()
+    print(f"Coleccion y modelo cargados en {time.perf_counter() - t0:.1f} s")
+    if vigilar:
+        import vigilar_imagenes
+        vigilar_imagenes.Vigilante(al_indexar=lambda ps: print(f"Indexadas {len(ps)} imagenes")).iniciar()
+    _Manejador.lotes = _Lotes()
+    _Manejador.verbose = verbose
+    servidor = ThreadingHTTPServer((host, puerto), _Manejador)
+    servidor.daemon_threads = True
+    print(f"Escuchando en http://{host}:{puerto}")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+
+class Cliente:
+    """
+    Cliente del servicio. Los resultados tienen la misma forma que los de
+    funciones.buscar_por_imagen / buscar_por_marca.
+    """
+    def __init__(self, host=HOST, puerto=PUERTO, timeout=60):
+        self.url = f"http://{host}:{puerto}"
+        self.timeout = timeout
+
+    def _pedir(self, ruta, datos=None, timeout=None):
+        cuerpo = None if datos is None else json.dumps(datos).encode("utf-8")
+        req = urllib.request.Request(self.url + ruta, data=cuerpo,
+                                     headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(req, timeout=timeout or self.timeout) as r:
+                return json.loads(r.read())
+        except urllib.error.HTTPError as e:
+            try:
+                msg = json.loads(e.read()).get("error", str(e))
+            except ValueError:
+                msg = str(e)
+            raise RuntimeError(msg) from None
+
+    def estado(self, timeout=None):
+        return self._pedir("/estado", timeout=timeout)
+
+    def disponible(self):
+        try:
+            self.estado(timeout=0.5)
+            return True
+        except (OSError, RuntimeError):
+            return False
+
+    def buscar_por_imagenes(self, paths, top_k=8, nprobe=None, marca=None, tipo=None):
+        # the service may run from another directory
+        datos = {"paths": [os.path.abspath(p) for p in paths], "top_k": top_k, "nprobe": nprobe,
+                 "marca": marca, "tipo": tipo}
+        respuesta = self._pedir("/imagen", datos)
+        traza.sumar(respuesta.get("tiempos"))
+        return [[(tuple(fila), s) for fila, s in res] for res in respuesta["resultados"]]
+
+    def buscar_por_imagen(self, path, top_k=8, nprobe=None, marca=None, tipo=None):
+        return self.buscar_por_imagenes([path], top_k, nprobe, marca, tipo)[0]
+
+    def buscar_por_embeddings(self, Q, top_k=8, nprobe=None, marca=None, tipo=None):
+        datos = {"embeddings": np.asarray(Q, dtype=np.float32).tolist(), "top_k": top_k, "nprobe": nprobe,
+                 "marca": marca, "tipo": tipo}
+        respuesta = self._pedir("/embeddings", datos)
+        traza.sumar(respuesta.get("tiempos"))
+        return [[(tuple(fila), s) for fila, s in res] for res in respuesta["resultados"]]
+
+    def buscar_por_marca(self, texto, limite=None):
+        return [tuple(f) for f in self._pedir("/marca", {"texto": texto, "limite": limite})["filas"]]
+
+    def recargar(self):
+        return self._pedir("/recargar", {})
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Servicio local de busqueda de chapas")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--puerto", type=int, default=PUERTO)
+    parser.add_argument("--db", default=fn.DB_FILE)
+    parser.add_argument("--verbose", action="store_true", help="registra cada peticion")
+    parser.add_argument("--vigilar", action="store_true", help="reindexa las imagenes de la coleccion cuando cambian")
+    args = parser.parse_args(argv)
+    fn.DB_FILE = args.db
+    servir(args.host, args.puerto, args.verbose, args.vigilar)
+
+if __name__ == "__main__":
+    main()
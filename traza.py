@@ -0,0 +1,263 @@
+# traza.py
+# Lightweight timers and counters for the hot paths (decode, transform, forward,
+# scoring, sort, GUI display). Disabled unless CHAPAS_TRAZA is set, in which case
+# every tramo() is recorded and dumped at exit as a Chrome trace (chrome://tracing,
+# Perfetto), a JSON-lines log and a Prometheus text file in CHAPAS_TRAZA_DIR.
+#
+#   CHAPAS_TRAZA=1 python chapas_gui.py
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+ACTIVO = os.environ.get("CHAPAS_TRAZA", "") not in ("", "0")
+TRAZA_DIR = os.environ.get("CHAPAS_TRAZA_DIR", "trazas")
+MAX_EVENTOS = 200000    # oldest events are dropped beyond this
+# histogram buckets (seconds) for the Prometheus dump
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_T0 = time.perf_counter()
+_lock = threading.Lock()
+_eventos = deque(maxlen=MAX_EVENTOS)   # (nombre, inicio_s, dur_s, tid, args)
+_hist = {}                             # nombre -> [count, sum, [bucket counts]]
+_contadores = {}                       # nombre -> total
+_local = threading.local()
+
+
+class _Nulo:
+    # shared no-op context manager: the whole cost of a disabled tramo()
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULO = _Nulo()
+
+
+class _Tramo:
+    __slots__ = ("nombre", "args", "t0")
+
+    def __init__(self, nombre, args):
+        self.nombre = nombre
+        self.args = args
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        dur = time.perf_counter() - self.t0
+        registrar(self.nombre, self.t0, dur, self.args)
+        return False
+
+
+def tramo(nombre, **args):
+    """
+    Context manager que mide un bloque como la etapa `nombre`.
+    """
+    if not ACTIVO:
+        return _NULO
+    return _Tramo(nombre, args or None)
+
+
+def medido(nombre):
+    """
+    Decorador equivalente a envolver la funcion en tramo(nombre); con la traza
+    desactivada devuelve la funcion sin tocar.
+    """
+    def decorar(func):
+        if not ACTIVO:
+            return func
+
+        @functools.wraps(func)
+        def envuelta(*a, **kw):
+            t0 = time.perf_counter()
+            try:
+                return func(*a, **kw)
+            finally:
+                registrar(nombre, t0, time.perf_counter() - t0)
+        return envuelta
+    return decorar
+
+
+def registrar(nombre, inicio, dur, args=None):
+    """
+    Anade una medida ya tomada (inicio en perf_counter, dur en segundos).
+    """
+    if not ACTIVO:
+        return
+    with _lock:
+        _anotar(nombre, inicio - _T0, dur, threading.get_ident(), args)
+    desglose = getattr(_local, "desglose", None)
+    if desglose is not None:
+        desglose[nombre] = desglose.get(nombre, 0.0) + dur
+
+
+def _anotar(nombre, ini, dur, tid, args):
+    # caller holds _lock
+    _eventos.append((nombre, ini, dur, tid, args))
+    h = _hist.get(nombre)
+    if h is None:
+        h = _hist[nombre] = [0, 0.0, [0] * len(BUCKETS)]
+    h[0] += 1
+    h[1] += dur
+    for i, b in enumerate(BUCKETS):
+        if dur <= b:
+            h[2][i] += 1
+            break
+
+
+def extraer():
+    """
+    Saca los eventos registrados en este proceso para enviarlos a otro (un
+    worker de un pool no ejecuta atexit). Los inicios van en perf_counter
+    absoluto, que es el mismo reloj en todos los procesos de la maquina.
+    """
+    if not ACTIVO:
+        return []
+    pid = os.getpid()
+    with _lock:
+        eventos = [(n, ini + _T0, dur, pid, a) for n, ini, dur, _, a in _eventos]
+        _eventos.clear()
+        _hist.clear()
+    return eventos
+
+
+def incorporar(eventos):
+    """
+    Anade los eventos de extraer() de otro proceso; cada proceso sale como su
+    propio hilo (tid = pid) en la traza Chrome.
+    """
+    if not ACTIVO or not eventos:
+        return
+    with _lock:
+        for n, inicio, dur, pid, a in eventos:
+            _anotar(n, inicio - _T0, dur, pid, a)
+
+
+def sumar(desglose):
+    """
+    Suma a la consulta en curso de este hilo un desglose medido en otro sitio
+    (p.ej. el que devuelve el servicio de busqueda).
+    """
+    actual = getattr(_local, "desglose", None)
+    if actual is not None and desglose:
+        for nombre, dur in desglose.items():
+            actual[nombre] = actual.get(nombre, 0.0) + dur
+
+
+def contar(nombre, n=1):
+    if not ACTIVO:
+        return
+    with _lock:
+        _contadores[nombre] = _contadores.get(nombre, 0) + n
+
+
+@contextmanager
+def consulta():
+    """
+    Recoge en un dict {etapa: segundos} los tramos de este hilo mientras dura
+    el bloque (desglose por consulta para la barra de estado).
+    """
+    anterior = getattr(_local, "desglose", None)
+    _local.desglose = {} if ACTIVO else None
+    try:
+        yield _local.desglose
+    finally:
+        _local.desglose = anterior
+
+
+def resumen(desglose, orden=None):
+    """
+    "forward 41.2 ms · producto 1.3 ms ..." a partir de un desglose.
+    """
+    if not desglose:
+        return ""
+    claves = [k for k in (orden or ()) if k in desglose] + \
+             sorted((k for k in desglose if k not in (orden or ())), key=lambda k: -desglose[k])
+    return " · ".join(f"{k} {desglose[k] * 1000:.1f} ms" for k in claves)
+
+# ----------------- Export -----------------
+def exportar_chrome(path):
+    """
+    Trace Event Format (eventos "X" completos, microsegundos).
+    """
+    pid = os.getpid()
+    with _lock:
+        eventos = list(_eventos)
+    traza = [{"name": n, "ph": "X", "ts": ini * 1e6, "dur": dur * 1e6, "pid": pid, "tid": tid,
+              **({"args": a} if a else {})} for n, ini, dur, tid, a in eventos]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": traza, "displayTimeUnit": "ms"}, f)
+    return path
+
+
+def exportar_jsonl(path):
+    with _lock:
+        eventos = list(_eventos)
+    with open(path, "w", encoding="utf-8") as f:
+        for n, ini, dur, tid, a in eventos:
+            f.write(json.dumps({"etapa": n, "inicio_s": ini, "dur_ms": dur * 1000, "hilo": tid,
+                                **({"args": a} if a else {})}) + "\n")
+    return path
+
+
+def texto_prometheus():
+    """
+    Histogramas por etapa y contadores en formato de texto de Prometheus.
+    """
+    lineas = ["# HELP chapas_etapa_segundos Duracion de cada etapa instrumentada.",
+              "# TYPE chapas_etapa_segundos histogram"]
+    with _lock:
+        hist = {k: (v[0], v[1], list(v[2])) for k, v in _hist.items()}
+        contadores = dict(_contadores)
+    for nombre, (n, total, cubos) in sorted(hist.items()):
+        acumulado = 0
+        for b, c in zip(BUCKETS, cubos):
+            acumulado += c
+            lineas.append(f'chapas_etapa_segundos_bucket{{etapa="{nombre}",le="{b}"}} {acumulado}')
+        lineas.append(f'chapas_etapa_segundos_bucket{{etapa="{nombre}",le="+Inf"}} {n}')
+        lineas.append(f'chapas_etapa_segundos_sum{{etapa="{nombre}"}} {total:.6f}')
+        lineas.append(f'chapas_etapa_segundos_count{{etapa="{nombre}"}} {n}')
+    if contadores:
+        lineas += ["# HELP chapas_eventos_total Contadores de eventos.",
+                   "# TYPE chapas_eventos_total counter"]
+        lineas += [f'chapas_eventos_total{{evento="{k}"}} {v}' for k, v in sorted(contadores.items())]
+    return "\n".join(lineas) + "\n"
+
+
+def volcar(directorio=None):
+    """
+    Escribe traza Chrome, JSON-lines y texto Prometheus; retorna las rutas.
+    """
+    directorio = directorio or TRAZA_DIR
+    os.makedirs(directorio, exist_ok=True)
+    base = os.path.join(directorio, f"traza_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}")
+    prom = base + ".prom"
+    with open(prom, "w", encoding="utf-8") as f:
+        f.write(texto_prometheus())
+    return [exportar_chrome(base + ".trace.json"), exportar_jsonl(base + ".jsonl"), prom]
+
+
+def _reiniciar_en_hijo():
+    # a forked child starts with a copy of the parent's buffers (and maybe a held lock):
+    # without this, extraer() would send the parent's events back to it
+    global _lock
+    _lock = threading.Lock()
+    _eventos.clear()
+    _hist.clear()
+    _contadores.clear()
+
+
+if ACTIVO:
+    atexit.register(lambda: _eventos and volcar())
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=_reiniciar_en_hijo)
@@ -0,0 +1,250 @@
+# vigilar_imagenes.py
+# Modo vigilancia: detecta imagenes nuevas o modificadas en IMAGES_DIR, las
+# embebe por lotes y actualiza el embedding de las chapas que las usan sin
+# volver a importar el Excel. Dentro de la GUI o del servicio de busqueda los
+# vectores entran en la matriz en memoria con la recarga incremental.
+#
+# Las imagenes que ninguna fila usa se ignoran salvo con --crear, que les da
+# de alta una chapa en el rango de ids propio (fn.ID_AUTOMATICO en adelante,
+# lejos de los ids de la hoja); --existentes hace lo mismo con las que ya
+# estaban al arrancar.
+#
+#   python vigilar_imagenes.py [--imagenes imagenes] [--intervalo 1] [--espera 2] [--crear [--existentes]]
+import argparse
+import os
+import threading
+import time
+import numpy as np
+import funciones as fn
+import traza
+
+EXTENSIONES = (".png", ".jpg", ".jpeg")
+INTERVALO_S = 1.0   # polling period
+ESPERA_S = 2.0      # size and mtime must stay unchanged this long (file fully written)
+LOTE_MAX = 256      # files indexed per pass at most; the rest wait for the next one
+
+def escanear(directorio):
+    """
+    {ruta: (tamano, mtime_ns)} de las imagenes bajo `directorio`, recursivo.
+    """
+    out = {}
+    pila = [directorio]
+    while pila:
+        try:
+            with os.scandir(pila.pop()) as it:
+                for e in it:
+                    if e.is_dir(follow_symlinks=False):
+                        pila.append(e.path)
+                    elif e.name.lower().endswith(EXTENSIONES):
+                        try:
+                            st = e.stat()  # free on Windows (comes with the directory entry)
+                        except FileNotFoundError:
+                            continue
+                        out[e.path] = (st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            continue
+    return out
+
+def clave(path):
+    # one spelling per file: "imagenes/x.jpg", "./imagenes/x.jpg" and the absolute path
+    # match, and on Windows so does "Imagenes\X.JPG"
+    return os.path.normcase(os.path.abspath(path))
+
+class _Registradas:
+    """
+    Filas de chapas por clave() de su imagen. Se construye con una pasada por la
+    tabla y se pone al dia con el log chapas_cambios.
+    """
+    def __init__(self):
+        self._cargar()
+
+    def _cargar(self):
+        self.por_clave = {}   # clave -> {id: (id, marca, tipo, imagen)}
+        self._clave_de = {}   # id -> clave
+        self.seq = fn.ultimo_cambio()  # before the scan: changes made during it are replayed
+        for fila in fn.iterar_chapas(("id", "marca", "tipo", "imagen")):
+            self._poner(fila)
+
+    def _poner(self, fila):
+        if fila[3]:
+            k = clave(fila[3])
+            self.por_clave.setdefault(k, {})[fila[0]] = fila
+            self._clave_de[fila[0]] = k
+
+    def _quitar(self, id_):
+        k = self._clave_de.pop(id_, None)
+        if k is not None:
+            filas = self.por_clave[k]
+            del filas[id_]
+            if not filas:
+                del self.por_clave[k]
+
+    def actualizar(self):
+        hasta = fn.ultimo_cambio()
+        if hasta > self.seq:
+            cambios = list(fn.iterar_cambios(self.seq, hasta, ("id", "marca", "tipo", "imagen")))
+            # checked after reading: a prune that ran first may have taken part of the delta
+            if not fn.cambios_conservados(self.seq):
+                self._cargar()
+                return self.por_clave
+            for fila, borrada in cambios:
+                self._quitar(fila[0])
+                if not borrada:
+                    self._poner(fila)
+            self.seq = hasta
+        return self.por_clave
+
+class Vigilante:
+    """
+    Sondea `directorio` cada `intervalo` segundos. Un fichero nuevo o cambiado se
+    indexa cuando lleva `espera` segundos sin cambiar, junto con todos los que
+    esten listos en esa pasada (un solo lote para el modelo). Solo se actualizan
+    las filas que ya usan el fichero; con crear=True las imagenes sin fila dan
+    de alta una chapa con id >= fn.ID_AUTOMATICO.
+    al_indexar(rutas) se llama desde el hilo del vigilante tras cada lote.
+    """
+    def __init__(self, directorio=None, intervalo=INTERVALO_S, espera=ESPERA_S, al_indexar=None, crear=False):
+        self.directorio = directorio or fn.IMAGES_DIR
+        self.intervalo = intervalo
+        self.espera = espera
+        self.al_indexar = al_indexar
+        self.crear = crear
+        self._registradas = None
+        self.conocidos = {}      # path -> (size, mtime_ns) already indexed or present at start
+        self._pendientes = {}    # path -> ((size, mtime_ns), first seen with that signature)
+        self._parar = threading.Event()
+        self._hilo = None
+
+    def preparar(self, inicial=False):
+        """
+        Toma la foto inicial del directorio. Con inicial=True (y crear=True), las
+        imagenes que ninguna fila usa todavia quedan pendientes de dar de alta.
+        """
+        actual = escanear(self.directorio)
+        registradas = self._filas() if inicial and self.crear else None
+        ya = time.monotonic() - self.espera
+        for p, firma in actual.items():
+            if registradas is None or clave(p) in registradas:
+                self.conocidos[p] = firma
+            else:
+                self._pendientes[p] = (firma, ya)
+
+    def iniciar(self, inicial=False):
+        self.preparar(inicial)
+        self._hilo = threading.Thread(target=self._bucle, daemon=True)
+        self._hilo.start()
+        return self
+
+    def detener(self):
+        self._parar.set()
+        if self._hilo is not None:
+            self._hilo.join()
+
+    def _bucle(self):
+        while True:
+            try:
+                self.revisar()
+            except Exception as e:
+                print(f"Vigilancia de {self.directorio}: {e}")
+            if self._parar.wait(self.intervalo):
+                return
+
+    def revisar(self):
+        """
+        Una pasada: detecta cambios e indexa los ficheros ya estables.
+        Retorna las rutas indexadas.
+        """
+        actual = escanear(self.directorio)
+        ahora = time.monotonic()
+        for p, firma in actual.items():
+            if self.conocidos.get(p) == firma:
+                self._pendientes.pop(p, None)
+                continue
+            prev = self._pendientes.get(p)
+            if prev is None or prev[0] != firma:
+                self._pendientes[p] = (firma, ahora)  # still being written: restart the wait
+        for p in [p for p in self._pendientes if p not in actual]:
+            del self._pendientes[p]                   # deleted before it settled
+        listos = [p for p, (_, t) in self._pendientes.items() if ahora - t >= self.espera][:LOTE_MAX]
+        if not listos:
+            return []
+        indexados = self._indexar(listos)
+        for p in listos:
+            # unreadable files are not retried until they change again
+            self.conocidos[p] = self._pendientes.pop(p)[0]
+        if indexados and self.al_indexar is not None:
+            self.al_indexar(indexados)
+        return indexados
+
+    def _filas(self):
+        if self._registradas is None:
+            self._registradas = _Registradas()
+        return self._registradas.actualizar()
+
+    def _embeber(self, paths):
+        try:
+            return paths, fn.embeddings_de_imagenes(paths, guardar=True)
+        except Exception:
+            # one bad file must not block the batch: retry one by one
+            ok, embs = [], []
+            for p in paths:
+                try:
+                    embs.append(fn.embedding_de_imagen(p, guardar=True))
+                    ok.append(p)
+                except Exception as e:
+                    print(f"No se pudo indexar {p}: {e}")
+            return ok, np.array(embs, dtype=np.float32).reshape(len(ok), -1)
+
+    def _indexar(self, paths):
+        with traza.tramo("vigilar_indexar", n=len(paths)):
+            ok, emb = self._embeber(paths)
+            if not ok:
+                return []
+            existentes = self._filas()
+            siguiente = fn.siguiente_id_chapa(fn.ID_AUTOMATICO) if self.crear else None
+            filas, hechas = [], []
+            for p, e in zip(ok, emb.astype(np.float16)):
+                blob = e.tobytes()
+                usan = existentes.get(clave(p))
+                if usan:
+                    # the stored path is kept as written, whatever spelling the scan used
+                    filas += [(id_, marca, tipo, imagen, blob) for id_, marca, tipo, imagen in usan.values()]
+                elif self.crear:
+                    # new cap, in the watcher's own id range so it never takes an id the
+                    # spreadsheet may use; the file name stands in for the brand
+                    filas.append((siguiente, os.path.splitext(os.path.basename(p))[0], None, p, blob))
+                    siguiente += 1
+                else:
+                    continue  # no row uses this file: left to the spreadsheet import
+                hechas.append(p)
+            fn.insertar_chapas_bulk(filas)
+            if filas and fn._EMBEDDINGS_LOADED:
+                fn.reload_embeddings()  # delta: only the rows just written
+        return hechas
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Indexa automaticamente las imagenes nuevas")
+    parser.add_argument("--imagenes", default=fn.IMAGES_DIR)
+    parser.add_argument("--intervalo", type=float, default=INTERVALO_S)
+    parser.add_argument("--espera", type=float, default=ESPERA_S)
+    parser.add_argument("--crear", action="store_true",
+                        help=f"dar de alta las imagenes nuevas sin fila (ids desde {fn.ID_AUTOMATICO})")
+    parser.add_argument("--existentes", action="store_true",
+                        help="con --crear, tambien las imagenes sin fila que ya estaban al arrancar")
+    args = parser.parse_args(argv)
+    if args.existentes and not args.crear:
+        parser.error("--existentes necesita --crear")
+    fn.crear_bd()
+    v = Vigilante(args.imagenes, args.intervalo, args.espera,
+                  al_indexar=lambda ps: print(f"Indexadas {len(ps)} imagenes", flush=True), crear=args.crear)
+    v.iniciar(inicial=args.existentes)
+    print(f"Vigilando {args.imagenes} (Ctrl+C para salir)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        v.detener()
+
+# The guard matters: the decode pool re-imports this module in each worker on Windows (spawn)
+if __name__ == "__main__":
+    main()